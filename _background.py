@@ -0,0 +1,538 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Running many commands at once without a thread for each.
+
+A single reactor thread starts queued commands, reads the output of every
+running command as it arrives (using poll, or select where poll isn't
+available) and kills commands that time out or are cancelled. Callers get a
+BackgroundCommand to poll or wait on.
+
+A StreamingCommand instead hands its output to the caller as it arrives, so it
+never holds more than a chunk (or a line) of it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+from cloudsdk_test_driver import _output
+from cloudsdk_test_driver import _pool
+from cloudsdk_test_driver import error
+
+
+_CHUNK_SIZE = 64 * 1024
+
+# StreamingCommands split their output into lines unless a line gets longer
+# than this, in which case it's passed on in pieces.
+_MAX_LINE = 1024 * 1024
+
+# How often to check on things the reactor isn't woken up for: commands that
+# closed their output but haven't exited yet, and semaphores released elsewhere.
+_RECHECK_INTERVAL = 0.05
+
+
+class BackgroundCommand(object):
+  """A command running (or queued to run) in the background.
+
+  Returned by SDK.RunInBackground and SDK.RunGcloudInBackground.
+
+  Attributes:
+    command: [string], the command line.
+  """
+
+  def __init__(self, command, popen_args, timeout=None, semaphore=None,
+               parse=None):
+    self.command = command
+    self._popen_args = popen_args
+    self._timeout = timeout
+    self._semaphore = semaphore
+    self._parse = parse
+    self._future = _pool.Future()
+    self._process = None
+    self._deadline = None
+    self._pipes = {}
+    self._captures = {}
+    self._cancelled = False
+    self._killed_because = None
+
+  def Done(self):
+    """Returns whether the command has finished (or failed to start)."""
+    return self._future.Done()
+
+  def Poll(self):
+    """Returns the command's result if it has finished, or None.
+
+    Returns:
+      (stdout, stderr, returncode), as returned by the method that started the
+        command, or None if it's still running.
+
+    Raises:
+      error.SDKError: If the command couldn't be run, timed out or was
+        cancelled.
+    """
+    if not self._future.Done():
+      return None
+    return self._Result()
+
+  def Wait(self, timeout=None):
+    """Waits for the command to finish.
+
+    Args:
+      timeout: number, seconds to wait. None waits forever. The command keeps
+        running if this expires.
+
+    Returns:
+      (stdout, stderr, returncode), as returned by the method that started the
+        command.
+
+    Raises:
+      error.SDKError: If the command didn't finish in time, couldn't be run,
+        timed out or was cancelled.
+    """
+    try:
+      self._future.Wait(timeout)
+    except _pool.TimeoutError:
+      raise error.SDKError(
+          'Command [{cmd}] did not finish within {timeout} seconds.'.format(
+              cmd=' '.join(self.command), timeout=timeout))
+    return self._Result()
+
+  def Cancel(self):
+    """Kills the command (or stops it from starting) unless it has finished."""
+    self._cancelled = True
+    _Reactor.Get().Wake()
+
+  def _Result(self):
+    out, err, code = self._future.Result()
+    if self._parse:
+      return self._parse(out, err, code)
+    return out, err, code
+
+  # The rest is only called on the reactor thread.
+
+  def _Start(self):
+    """Starts the command. Returns whether it's now running."""
+    try:
+      self._process = subprocess.Popen(
+          self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+          close_fds=True, **self._popen_args)
+    except OSError as err:
+      self._Fail('Command [{cmd}] could not be run: {err}'.format(
+          cmd=' '.join(self.command), err=err))
+      return False
+    if self._timeout:
+      self._deadline = time.time() + self._timeout
+    for name, pipe in (('stdout', self._process.stdout),
+                       ('stderr', self._process.stderr)):
+      self._pipes[pipe.fileno()] = (name, pipe)
+      self._captures[name] = _output.Capture()
+    return True
+
+  def _Fds(self):
+    return list(self._pipes)
+
+  def _Read(self, fd):
+    name, pipe = self._pipes[fd]
+    data = os.read(fd, _CHUNK_SIZE)
+    if data:
+      self._captures[name].Write(data)
+    else:
+      pipe.close()
+      del self._pipes[fd]
+
+  def _Check(self, now):
+    """Kills the command if needed and finishes it once it has exited.
+
+    Returns:
+      bool, whether the command has finished.
+    """
+    if self._process is None:
+      if self._cancelled:
+        self._Fail('Command [{cmd}] was cancelled.'.format(
+            cmd=' '.join(self.command)))
+        return True
+      return False
+    if not self._killed_because:
+      if self._cancelled:
+        self._Kill('was cancelled')
+      elif self._deadline is not None and now >= self._deadline:
+        self._Kill('timed out after {0} seconds'.format(self._timeout))
+    if self._pipes:
+      return False
+    code = self._process.poll()
+    if code is None:
+      return False
+    if self._killed_because:
+      for capture in self._captures.values():
+        capture.Discard()
+      self._Fail('Command [{cmd}] {why}.'.format(
+          cmd=' '.join(self.command), why=self._killed_because))
+    else:
+      self._future._SetResult((  # pylint: disable=protected-access
+          self._captures['stdout'].Result(),
+          self._captures['stderr'].Result(), code))
+    return True
+
+  def _NeedsRecheck(self):
+    return self._process is not None and not self._pipes
+
+  def _Kill(self, why):
+    self._killed_because = why
+    try:
+      self._process.kill()
+    except OSError:
+      # It has already exited.
+      pass
+
+  def _Abandon(self, message):
+    """Kills the command (if it started), cleans up after it and fails it."""
+    if self._process is not None:
+      self._Kill('was abandoned')
+      self._process.wait()
+      for _, pipe in self._pipes.values():
+        pipe.close()
+      self._pipes.clear()
+      for capture in self._captures.values():
+        capture.Discard()
+      if self._semaphore:
+        self._semaphore.release()
+    self._Fail(message)
+
+  def _Fail(self, message):
+    # pylint: disable=protected-access
+    try:
+      raise error.SDKError(message)
+    except error.SDKError:
+      self._future._SetException(sys.exc_info())
+
+
+def WaitAny(commands, timeout=None):
+  """Waits for the first of several commands to finish.
+
+  Args:
+    commands: [BackgroundCommand], the commands to wait on.
+    timeout: number, seconds to wait. None waits forever.
+
+  Returns:
+    BackgroundCommand, one of the commands that has finished.
+
+  Raises:
+    error.SDKError: If none of the commands finished in time.
+  """
+  by_future = dict(
+      (command._future, command)  # pylint: disable=protected-access
+      for command in commands)
+  try:
+    for future in _pool.AsCompleted(list(by_future), timeout):
+      return by_future[future]
+  except _pool.TimeoutError:
+    pass
+  raise error.SDKError(
+      'No command finished within {0} seconds.'.format(timeout))
+
+
+def AsCompleted(commands, deadline=None):
+  """Yields commands as they finish.
+
+  Commands that haven't finished when the caller stops iterating (or when the
+  deadline passes) are cancelled.
+
+  Args:
+    commands: [BackgroundCommand], the commands to wait on.
+    deadline: number, the time.time() by which all of them must finish, or
+      None to wait forever.
+
+  Yields:
+    (int, BackgroundCommand), each command and its index in commands, in the
+      order they finish.
+
+  Raises:
+    error.SDKError: If the deadline passes first.
+  """
+  pending = list(enumerate(commands))
+  try:
+    while pending:
+      remaining = None
+      if deadline is not None:
+        remaining = max(0, deadline - time.time())
+      try:
+        done = WaitAny([command for _, command in pending], remaining)
+      except error.SDKError:
+        raise error.SDKError(
+            '{n} of {total} commands did not finish in time.'.format(
+                n=len(pending), total=len(commands)))
+      for i, (index, command) in enumerate(pending):
+        if command is done:
+          del pending[i]
+          break
+      yield index, done
+  finally:
+    for _, command in pending:
+      command.Cancel()
+
+
+class StreamingCommand(object):
+  """A command whose output is read as it arrives.
+
+  Returned by SDK.RunIter. Iterate over it (once) for (name, data) pairs as
+  the command writes them, where name is 'stdout' or 'stderr'. The command is
+  killed if iteration stops early.
+
+  Attributes:
+    command: [string], the command line.
+    returncode: int, the command's return code once iteration has finished,
+      None until then.
+  """
+
+  def __init__(self, command, popen_args, timeout=None, lines=True):
+    """Starts the command.
+
+    Args:
+      command: [string], the command line.
+      popen_args: dict, passed on to subprocess.Popen.
+      timeout: number, seconds to let the command run before killing it.
+      lines: bool, whether to split the output into lines (each ending with
+        its newline) rather than passing it on in chunks as it's read.
+
+    Raises:
+      error.SDKError: If the command couldn't be run.
+    """
+    self.command = command
+    self.returncode = None
+    self._timeout = timeout
+    self._lines = lines
+    try:
+      self._process = subprocess.Popen(
+          command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+          close_fds=True, **popen_args)
+    except OSError as err:
+      raise error.SDKError('Command [{cmd}] could not be run: {err}'.format(
+          cmd=' '.join(command), err=err))
+    self._deadline = time.time() + timeout if timeout else None
+
+  def __iter__(self):
+    return self._Iterate()
+
+  def _Remaining(self):
+    """Returns the seconds left to run, killing the command if there are none.
+
+    Raises:
+      error.SDKError: If the command timed out.
+    """
+    if self._deadline is None:
+      return None
+    remaining = self._deadline - time.time()
+    if remaining <= 0:
+      self.Close()
+      raise error.SDKError(
+          'Command [{cmd}] timed out after {timeout} seconds.'.format(
+              cmd=' '.join(self.command), timeout=self._timeout))
+    return remaining
+
+  def _Split(self, data, partial):
+    """Returns the complete lines in partial[0] + data, keeping the rest."""
+    lines = (partial[0] + data).split(b'\n')
+    partial[0] = lines.pop()
+    pieces = [line + b'\n' for line in lines]
+    if len(partial[0]) >= _MAX_LINE:
+      pieces.append(partial[0])
+      partial[0] = b''
+    return pieces
+
+  def _Iterate(self):
+    pipes = {}
+    for name, pipe in (('stdout', self._process.stdout),
+                       ('stderr', self._process.stderr)):
+      pipes[pipe.fileno()] = (name, pipe, [b''])
+    try:
+      while pipes:
+        for fd in _WaitForInput(list(pipes), self._Remaining()):
+          name, pipe, partial = pipes[fd]
+          data = os.read(fd, _CHUNK_SIZE)
+          if not data:
+            pipe.close()
+            del pipes[fd]
+            if partial[0]:
+              yield name, partial[0]
+          elif self._lines:
+            for line in self._Split(data, partial):
+              yield name, line
+          else:
+            yield name, data
+      # The command may outlive its output.
+      while self._process.poll() is None:
+        self._Remaining()
+        time.sleep(_RECHECK_INTERVAL)
+      self.returncode = self._process.returncode
+    finally:
+      if self.returncode is None:
+        self.Close()
+
+  def Close(self):
+    """Kills the command unless it has finished."""
+    if self._process.poll() is None:
+      try:
+        self._process.kill()
+      except OSError:
+        # It has already exited.
+        pass
+      self._process.wait()
+    for pipe in (self._process.stdout, self._process.stderr):
+      pipe.close()
+
+
+def _WaitForInput(fds, timeout):
+  """Returns the fds that can be read from without blocking."""
+  if hasattr(select, 'poll'):
+    poller = select.poll()
+    for fd in fds:
+      poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+    events = poller.poll(None if timeout is None else timeout * 1000)
+    return [fd for fd, _ in events]
+  readable, _, _ = select.select(fds, [], [], timeout)
+  return readable
+
+
+def _SetNonBlocking(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Reactor(object):
+  """The thread that runs every BackgroundCommand."""
+
+  _instance = None
+  _instance_lock = threading.Lock()
+
+  @classmethod
+  def Get(cls):
+    with cls._instance_lock:
+      if cls._instance is None:
+        cls._instance = cls()
+      return cls._instance
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._queued = collections.deque()
+    self._running = []
+    self._wakeup_read, self._wakeup_write = os.pipe()
+    _SetNonBlocking(self._wakeup_read)
+    _SetNonBlocking(self._wakeup_write)
+    thread = threading.Thread(target=self._Loop)
+    thread.daemon = True
+    thread.start()
+
+  def Submit(self, command):
+    with self._lock:
+      self._queued.append(command)
+    self.Wake()
+
+  def Wake(self):
+    try:
+      os.write(self._wakeup_write, b'x')
+    except OSError as err:
+      # The pipe is full, so the reactor is already due to wake up.
+      if err.errno != errno.EAGAIN:
+        raise
+
+  def _Loop(self):
+    while True:
+      try:
+        self._Step()
+      except Exception as err:  # pylint: disable=broad-except
+        # Don't leave anyone waiting forever on commands nobody is watching.
+        with self._lock:
+          abandoned = self._running + list(self._queued)
+          self._running = []
+          self._queued.clear()
+        for command in abandoned:
+          command._Abandon(  # pylint: disable=protected-access
+              'Command [{cmd}] was abandoned: {err}'.format(
+                  cmd=' '.join(command.command), err=err))
+
+  def _StartQueued(self):
+    """Starts queued commands whose semaphores allow it.
+
+    Returns:
+      bool, whether any commands are still queued.
+    """
+    with self._lock:
+      queued = list(self._queued)
+      self._queued.clear()
+    still_queued = []
+    for command in queued:
+      # pylint: disable=protected-access
+      if command._Check(time.time()):
+        continue
+      if command._semaphore and not command._semaphore.acquire(False):
+        still_queued.append(command)
+      elif command._Start():
+        self._running.append(command)
+      elif command._semaphore:
+        command._semaphore.release()
+    with self._lock:
+      self._queued.extendleft(reversed(still_queued))
+      return bool(self._queued)
+
+  def _Step(self):
+    waiting = self._StartQueued()
+
+    # pylint: disable=protected-access
+    owners = {}
+    for command in self._running:
+      for fd in command._Fds():
+        owners[fd] = command
+    now = time.time()
+    timeout = None
+    if waiting or any(command._NeedsRecheck() for command in self._running):
+      timeout = _RECHECK_INTERVAL
+    for command in self._running:
+      if command._deadline is not None:
+        remaining = max(0, command._deadline - now)
+        timeout = remaining if timeout is None else min(timeout, remaining)
+
+    for fd in _WaitForInput([self._wakeup_read] + list(owners), timeout):
+      if fd == self._wakeup_read:
+        try:
+          while os.read(self._wakeup_read, _CHUNK_SIZE):
+            pass
+        except OSError as err:
+          if err.errno != errno.EAGAIN:
+            raise
+      else:
+        owners[fd]._Read(fd)
+
+    now = time.time()
+    for command in list(self._running):
+      if command._Check(now):
+        self._running.remove(command)
+        if command._semaphore:
+          command._semaphore.release()
+
+
+def Submit(command):
+  """Queues a BackgroundCommand to run on the reactor thread."""
+  _Reactor.Get().Submit(command)
+  return command
@@ -0,0 +1,105 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service account credentials shared between SDK configurations.
+
+Activating a service account is the slowest part of setting up an SDK. Instead
+of activating it in every SDK's configuration, each distinct service account
+(email and key file contents) is activated once into a configuration folder of
+its own in the credential store. New configurations start out as copies of it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+
+from cloudsdk_test_driver import _digest
+from cloudsdk_test_driver import _lock
+from cloudsdk_test_driver import constants
+
+
+# Written into a stored configuration once its service account is activated.
+_ACTIVATED_MARKER = '.activated'
+
+# Not copied out of stored configurations.
+_SKIPPED = frozenset([_ACTIVATED_MARKER, 'logs'])
+
+
+def _Key(email, keyfile):
+  """Returns the name a service account is stored under.
+
+  Raises:
+    IOError: if keyfile can't be read.
+  """
+  key = hashlib.sha256()
+  key.update((email or '').encode('utf-8'))
+  key.update(b'\0')
+  key.update(_digest.FileDigest(keyfile).encode('utf-8'))
+  return key.hexdigest()
+
+
+def _Copy(source, destination):
+  """Copies the files under source into destination, which may exist."""
+  for directory, subdirectories, files in os.walk(source):
+    relative = os.path.relpath(directory, source)
+    if relative == os.curdir:
+      subdirectories[:] = [d for d in subdirectories if d not in _SKIPPED]
+      files = [f for f in files if f not in _SKIPPED]
+    target = os.path.normpath(os.path.join(destination, relative))
+    if not os.path.isdir(target):
+      os.makedirs(target)
+    for name in files:
+      shutil.copy2(os.path.join(directory, name), os.path.join(target, name))
+
+
+def Seed(store_directory, email, keyfile, activate, config_directory):
+  """Sets up a configuration with an activated service account.
+
+  The service account is activated into the store the first time it's seen
+  (by this or any other process sharing store_directory), and its credentials
+  are copied into config_directory.
+
+  Args:
+    store_directory: string, the credential store.
+    email: string, the service account's email, or None.
+    keyfile: string, the service account's key file.
+    activate: function(string), activates the service account in the given
+      configuration folder.
+    config_directory: string, the configuration folder to set up.
+
+  Raises:
+    IOError, OSError: if keyfile can't be read or the credentials can't be
+      copied.
+    Whatever activate raises.
+  """
+  stored = os.path.join(store_directory, _Key(email, keyfile))
+  if not os.path.isdir(store_directory):
+    try:
+      os.makedirs(store_directory)
+    except OSError:
+      if not os.path.isdir(store_directory):
+        raise
+  with _lock.FileLock(stored + constants.LOCK_SUFFIX, name='credentials'):
+    if not os.path.isfile(os.path.join(stored, _ACTIVATED_MARKER)):
+      # Start over from any earlier attempt that failed part way.
+      shutil.rmtree(stored, ignore_errors=True)
+      os.makedirs(stored)
+      activate(stored)
+      with open(os.path.join(stored, _ACTIVATED_MARKER), 'w'):
+        pass
+  _Copy(stored, config_directory)
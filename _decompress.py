@@ -0,0 +1,250 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opening compressed tars with the fastest decompressor available.
+
+The compression format is detected from the first bytes of the tar rather than
+its name. If one of the commands in constants.DECOMPRESS_COMMANDS is on the
+PATH, decompression runs in that command (e.g. pigz or zstd, which can use
+several cores and in any case run alongside extraction). Otherwise the standard
+library (or an optional module, for xz and zstd) is used.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import distutils.spawn
+import errno
+import signal
+import subprocess
+import tarfile
+import tempfile
+import threading
+
+from cloudsdk_test_driver import constants
+
+# pylint: disable=g-import-not-at-top
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+# pylint: enable=g-import-not-at-top
+
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+_MAGIC = [
+    (GZIP, b'\x1f\x8b'),
+    (BZIP2, b'BZh'),
+    (XZ, b'\xfd7zXZ\x00'),
+    (ZSTD, b'\x28\xb5\x2f\xfd'),
+]
+_MAGIC_SIZE = max(len(magic) for _, magic in _MAGIC)
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Once the tar itself has been read, up to this much trailing output from a
+# decompressor is drained so it can finish (and verify its checksums) normally.
+# Beyond that, the decompressor is stopped instead.
+_DRAIN_LIMIT = 1024 * 1024
+
+
+def DetectFormat(header):
+  """Returns the compression format of data starting with header, or None."""
+  for name, magic in _MAGIC:
+    if header.startswith(magic):
+      return name
+  return None
+
+
+def FindCommand(compression):
+  """Returns the first available decompression command for a format, or None."""
+  for command in constants.DECOMPRESS_COMMANDS.get(compression, []):
+    path = distutils.spawn.find_executable(command[0])
+    if path:
+      return [path] + command[1:]
+  return None
+
+
+class _PeekReader(object):
+  """Wraps a file object so its first bytes can be read without consuming them."""
+
+  def __init__(self, fileobj):
+    self._fileobj = fileobj
+    self._buffer = b''
+
+  def Peek(self, size):
+    while len(self._buffer) < size:
+      data = self._fileobj.read(size - len(self._buffer))
+      if not data:
+        break
+      self._buffer += data
+    return self._buffer[:size]
+
+  def read(self, size=-1):  # pylint: disable=invalid-name
+    if self._buffer:
+      if size < 0:
+        data, self._buffer = self._buffer + self._fileobj.read(), b''
+      else:
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+      return data
+    return self._fileobj.read(size)
+
+
+def _RestoreSigpipe():
+  # Python ignores SIGPIPE and children inherit that. Let decompressors die
+  # quietly when the pipe is closed early instead of reporting write errors.
+  signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def _Feed(reader, stdin):
+  """Copies everything from reader into a decompressor's stdin."""
+  try:
+    for chunk in iter(lambda: reader.read(_CHUNK_SIZE), b''):
+      stdin.write(chunk)
+  except IOError as err:
+    # The decompressor exited early. That's reported when it's waited on.
+    if err.errno != errno.EPIPE:
+      raise
+  finally:
+    try:
+      stdin.close()
+    except IOError:
+      pass
+
+
+@contextlib.contextmanager
+def _Pipe(command, reader, stdin=None):
+  """Runs a decompressor, yielding its stdout.
+
+  Args:
+    command: [string], the decompressor's command line.
+    reader: file-like, the compressed data, fed to the decompressor on another
+      thread. Ignored if stdin is given.
+    stdin: file, a real file to use as the decompressor's stdin.
+
+  Yields:
+    file, the decompressed data.
+
+  Raises:
+    tarfile.ReadError: if the decompressor fails.
+  """
+  stderr = tempfile.TemporaryFile()
+  process = subprocess.Popen(
+      command, stdin=stdin or subprocess.PIPE, stdout=subprocess.PIPE,
+      stderr=stderr, preexec_fn=_RestoreSigpipe, close_fds=True)
+  feeder = None
+  if not stdin:
+    feeder = threading.Thread(target=_Feed, args=(reader, process.stdin))
+    feeder.daemon = True
+    feeder.start()
+  try:
+    try:
+      yield process.stdout
+      drained = 0
+      while drained <= _DRAIN_LIMIT:
+        data = process.stdout.read(_CHUNK_SIZE)
+        if not data:
+          break
+        drained += len(data)
+    except:
+      # Don't wait for the feeder here. It may be blocked reading a stream that
+      # the caller is about to close.
+      process.kill()
+      raise
+    finally:
+      process.stdout.close()
+      process.wait()
+    if feeder:
+      feeder.join()
+    if process.returncode not in (0, -signal.SIGPIPE):
+      stderr.seek(0)
+      raise tarfile.ReadError('{command} failed: {err}'.format(
+          command=command[0], err=stderr.read().strip()))
+  finally:
+    stderr.close()
+
+
+def _StdlibStream(compression, reader):
+  """Returns (fileobj, mode) for reading with the standard library."""
+  if compression == GZIP:
+    return reader, 'r|gz'
+  if compression == BZIP2:
+    return reader, 'r|bz2'
+  if compression == XZ:
+    if lzma is None:
+      raise tarfile.CompressionError(
+          'xz compressed tars need the xz command or the lzma module.')
+    return lzma.LZMAFile(reader), 'r|'
+  if compression == ZSTD:
+    if zstandard is None:
+      raise tarfile.CompressionError(
+          'zstd compressed tars need the zstd command or the zstandard module.')
+    return zstandard.ZstdDecompressor().stream_reader(reader), 'r|'
+  return reader, 'r|'
+
+
+@contextlib.contextmanager
+def OpenTar(name=None, fileobj=None):
+  """Opens a (possibly compressed) tar for reading as a stream.
+
+  Args:
+    name: string, the path of the tar. Either this or fileobj must be given.
+    fileobj: file-like, the tar's data.
+
+  Yields:
+    tarfile.TarFile, opened in stream mode (so members must be read in order).
+
+  Raises:
+    tarfile.TarError: if the tar can't be decompressed or read.
+  """
+  if name:
+    with open(name, 'rb') as source:
+      with _OpenTar(source, local=True) as tar:
+        yield tar
+  else:
+    with _OpenTar(fileobj, local=False) as tar:
+      yield tar
+
+
+@contextlib.contextmanager
+def _OpenTar(source, local):
+  reader = _PeekReader(source)
+  compression = DetectFormat(reader.Peek(_MAGIC_SIZE))
+  command = compression and FindCommand(compression)
+  if command:
+    stdin = None
+    if local:
+      # Let the decompressor read the file itself.
+      source.seek(0)
+      stdin = source
+    with _Pipe(command, reader, stdin) as stream:
+      with tarfile.open(fileobj=stream, mode='r|') as tar:
+        yield tar
+  else:
+    stream, mode = _StdlibStream(compression, reader)
+    with tarfile.open(fileobj=stream, mode=mode) as tar:
+      yield tar
@@ -0,0 +1,122 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""File digests and the manifest that remembers them."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import tempfile
+
+from cloudsdk_test_driver import _lock
+from cloudsdk_test_driver import constants
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def FileDigest(path):
+  """Returns the hex sha256 digest of the file at path."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+class Manifest(object):
+  """A small JSON file recording the sha256 digests of other files.
+
+  Each entry is keyed by the file's real path and records the size and
+  modification time the file had when it was hashed. As long as those still
+  match, the recorded digest can be trusted without reading the file again. If
+  they don't, the file has changed since it was hashed.
+
+  Entries can also hold other details about the file (e.g. HTTP validators).
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def _Load(self):
+    try:
+      with open(self.path) as fp:
+        return json.load(fp)
+    except (IOError, ValueError):
+      return {}
+
+  def _Save(self, entries):
+    directory = os.path.dirname(self.path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.manifest')
+    with os.fdopen(fd, 'w') as fp:
+      json.dump(entries, fp, sort_keys=True, indent=1)
+    os.rename(temp_path, self.path)
+
+  def _Lock(self):
+    return _lock.FileLock(self.path + constants.LOCK_SUFFIX, name='manifest')
+
+  def Get(self, file_path):
+    """Returns the entry for file_path, or None if there isn't one."""
+    return self._Load().get(os.path.realpath(file_path))
+
+  def Status(self, file_path):
+    """Checks file_path against its entry.
+
+    Returns:
+      (string, dict), one of 'missing' (no entry), 'changed' (the file no longer
+        matches its entry) or 'valid', along with the entry (or None).
+    """
+    entry = self.Get(file_path)
+    if entry is None:
+      return 'missing', None
+    st = os.stat(file_path)
+    if entry.get('size') != st.st_size or entry.get('mtime') != st.st_mtime:
+      return 'changed', entry
+    return 'valid', entry
+
+  def Record(self, file_path, sha256, **details):
+    """Records the digest of file_path as of its current size and mtime."""
+    st = os.stat(file_path)
+    entry = dict(details, sha256=sha256, size=st.st_size, mtime=st.st_mtime)
+    with self._Lock():
+      entries = self._Load()
+      entries[os.path.realpath(file_path)] = entry
+      self._Save(entries)
+    return entry
+
+  def Update(self, file_path, **details):
+    """Adds details to the entry for file_path, if there is one."""
+    with self._Lock():
+      entries = self._Load()
+      key = os.path.realpath(file_path)
+      if key in entries:
+        entries[key].update(details)
+        self._Save(entries)
+
+  def Forget(self, file_path):
+    with self._Lock():
+      entries = self._Load()
+      if entries.pop(os.path.realpath(file_path), None) is not None:
+        self._Save(entries)
+
+  def Digest(self, file_path):
+    """Returns the digest of file_path, hashing it only if needed."""
+    status, entry = self.Status(file_path)
+    if status == 'valid':
+      return entry['sha256']
+    return self.Record(file_path, FileDigest(file_path))['sha256']
@@ -0,0 +1,199 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Single pass, multi-threaded tar extraction."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tarfile
+import threading
+
+from cloudsdk_test_driver import _pool
+from cloudsdk_test_driver import constants
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class _ByteBudget(object):
+  """Limits how many bytes of file contents are buffered at once."""
+
+  def __init__(self, limit):
+    self._limit = limit
+    self._in_use = 0
+    self._condition = threading.Condition()
+
+  def Acquire(self, size):
+    with self._condition:
+      # Always let one buffer through, however big, so nothing waits forever.
+      while self._in_use and self._in_use + size > self._limit:
+        self._condition.wait()
+      self._in_use += size
+
+  def Release(self, size):
+    with self._condition:
+      self._in_use -= size
+      self._condition.notify_all()
+
+
+def _ListFiles(directory):
+  """Returns the set of paths of everything under directory."""
+  existing = set()
+  for dirpath, dirnames, filenames in os.walk(directory):
+    for name in dirnames + filenames:
+      existing.add(os.path.join(dirpath, name))
+  return existing
+
+
+def _SafeJoin(directory, name):
+  """Joins a member name to directory, refusing names that escape it."""
+  path = os.path.normpath(os.path.join(directory, name))
+  if not (path + os.sep).startswith(os.path.normpath(directory) + os.sep):
+    raise tarfile.ExtractError(
+        'Refusing to extract [{name}] outside of [{dir}].'.format(
+            name=name, dir=directory))
+  return path
+
+
+def _ApplyMetadata(path, member):
+  os.chmod(path, member.mode)
+  os.utime(path, (member.mtime, member.mtime))
+
+
+def _WriteFile(path, chunks, member, budget, size):
+  """Writes a file, then returns its size to the budget."""
+  try:
+    with open(path, 'wb') as fp:
+      for chunk in chunks:
+        fp.write(chunk)
+    _ApplyMetadata(path, member)
+  finally:
+    budget.Release(size)
+
+
+class Extractor(object):
+  """Extracts tars without overwriting files that already exist.
+
+  Members are read in a single sequential pass, so tars opened as streams (mode
+  'r|*') work, and each member is written straight to the folder chosen for it
+  by route. Reading and decompressing happens on the calling thread while file
+  writes and metadata updates are handed off to a pool of worker threads.
+  Whether a file already exists is checked against a listing of each
+  destination folder taken once up front rather than a stat per member.
+  """
+
+  def __init__(self, workers=None, buffer_bytes=None):
+    self._workers = workers or constants.EXTRACT_WORKERS
+    self._budget = _ByteBudget(buffer_bytes or constants.EXTRACT_BUFFER_BYTES)
+    self._listings = {}
+
+  def _Exists(self, directory, path):
+    if directory not in self._listings:
+      self._listings[directory] = _ListFiles(directory)
+    listing = self._listings[directory]
+    if path in listing:
+      return True
+    listing.add(path)
+    return False
+
+  def Extract(self, tar, route, handlers=None):
+    """Extracts every member of an open tar.
+
+    Args:
+      tar: tarfile.TarFile, the open tar.
+      route: function(string) -> string, given a member name, returns the
+        folder to extract it into.
+      handlers: {string: function(file)}, members with these names aren't
+        extracted. Instead, the function is called with a file object holding
+        the member's contents (on the calling thread, in member order).
+
+    Returns:
+      int, the number of bytes of file contents extracted.
+
+    Raises:
+      tarfile.TarError: if the tar can't be read.
+      OSError, IOError: if the files can't be written.
+    """
+    handlers = handlers or {}
+    extracted_bytes = 0
+    directories = []
+    links = []
+    futures = []
+    with _pool.ThreadPool(self._workers) as pool:
+      for member in tar:
+        if member.isfile() and member.name in handlers:
+          handlers[member.name](tar.extractfile(member))
+          continue
+
+        directory = route(member.name)
+        path = _SafeJoin(directory, member.name)
+        if member.isdir():
+          if not os.path.isdir(path):
+            os.makedirs(path)
+          directories.append((path, member))
+          continue
+        if self._Exists(directory, path):
+          # This file already exists. Don't overwrite it.
+          continue
+
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+          os.makedirs(parent)
+        if member.issym():
+          os.symlink(member.linkname, path)
+        elif member.islnk():
+          # The target may still be in flight, so link once writes finish.
+          links.append((path, _SafeJoin(directory, member.linkname)))
+        elif member.isfile():
+          extracted_bytes += member.size
+          future = self._SubmitFile(pool, tar, member, path)
+          if future:
+            futures.append(future)
+        else:
+          # Devices, fifos and the like. Not expected, so do it the slow way.
+          tar.extract(member, path=directory)
+    for future in futures:
+      future.Result()
+
+    for path, target in links:
+      os.link(target, path)
+    # Directory metadata goes last, otherwise writing files would clobber the
+    # modification times (or fail on read-only directories).
+    for path, member in reversed(directories):
+      _ApplyMetadata(path, member)
+    return extracted_bytes
+
+  def _SubmitFile(self, pool, tar, member, path):
+    """Reads one member's contents and queues the write.
+
+    Returns:
+      _pool.Future, the queued write, or None if the file was written inline.
+    """
+    fileobj = tar.extractfile(member)
+    if member.size > constants.EXTRACT_INLINE_SIZE:
+      # Don't buffer big files. Write them as they're decompressed.
+      _WriteFile(path, iter(lambda: fileobj.read(_CHUNK_SIZE), b''), member,
+                 self._budget, 0)
+      return None
+    self._budget.Acquire(member.size)
+    try:
+      data = fileobj.read()
+    except:
+      self._budget.Release(member.size)
+      raise
+    return pool.Submit(
+        _WriteFile, path, [data], member, self._budget, member.size)
@@ -0,0 +1,209 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A long-lived Python process that runs gcloud commands.
+
+This is run as a script (by the Python the SDK uses, which may not be the one
+running the driver) so it mustn't import anything from the driver. See
+_worker.GcloudWorker for the other end.
+
+Usage: python _gcloud_worker.py [--fork] SDK_DIR [MODULE...]
+
+The given modules are imported once up front. Then each request (a line of
+JSON with the command's args, env and cwd, read from stdin) is answered on
+stdout with a line of JSON giving the return code and the sizes of the stdout
+and stderr that follow it. Requests run gcloud's own lib/gcloud.py as __main__,
+so everything it imports after the first command is already loaded.
+
+With --fork, each command runs in a child forked from the worker (which then
+acts as a "zygote") instead of in the worker itself. The child starts with
+everything the worker imported, and whatever the command changes or breaks
+goes away with it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import runpy
+import sys
+import tempfile
+import time
+import traceback
+
+
+def _Native(value):
+  """Returns value as the str type os.environ wants."""
+  if sys.version_info[0] == 2 and not isinstance(value, str):
+    return value.encode('utf-8')
+  return value
+
+
+def _Preload(sdk_dir, modules):
+  lib_directory = os.path.join(sdk_dir, 'lib')
+  sys.path[:0] = [lib_directory, os.path.join(lib_directory, 'third_party')]
+  for module in modules:
+    try:
+      __import__(module)
+    except Exception:  # pylint: disable=broad-except
+      # The command will import (and report problems with) whatever it needs.
+      pass
+
+
+def _ExitCode(code):
+  if code is None:
+    return 0
+  if isinstance(code, int):
+    return code
+  sys.stderr.write('{0}\n'.format(code))
+  return 1
+
+
+def _Prepare(gcloud_py, request):
+  """Sets up the environment, folder and arguments for a command."""
+  os.environ.clear()
+  os.environ.update(
+      (_Native(k), _Native(v)) for k, v in request['env'].items())
+  os.chdir(request['cwd'])
+  sys.argv = [gcloud_py] + [_Native(arg) for arg in request['args']]
+
+
+def _Execute(gcloud_py):
+  """Runs gcloud.
+
+  Returns:
+    (int, bool), the return code and whether the command crashed (rather than
+      exiting).
+  """
+  try:
+    runpy.run_path(gcloud_py, run_name='__main__')
+  except SystemExit as exit_:
+    return _ExitCode(exit_.code), False
+  except BaseException:  # pylint: disable=broad-except
+    traceback.print_exc()
+    return 1, True
+  finally:
+    sys.stdout.flush()
+    sys.stderr.flush()
+  return 0, False
+
+
+def _ReadCaptured(captured):
+  outputs = []
+  for fp in captured:
+    fp.seek(0)
+    outputs.append(fp.read())
+    fp.close()
+  return outputs
+
+
+def _Run(gcloud_py, request, unused_pipes):
+  """Runs one command in this process with fds 1 and 2 captured.
+
+  Returns:
+    (int, bytes, bytes, bool, float), the return code, stdout and stderr,
+      whether the command crashed and the seconds it took to start it.
+  """
+  start = time.time()
+  saved_path = list(sys.path)
+  captured = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+  saved_fds = [os.dup(1), os.dup(2)]
+  try:
+    _Prepare(gcloud_py, request)
+    os.dup2(captured[0].fileno(), 1)
+    os.dup2(captured[1].fileno(), 2)
+    launch_time = time.time() - start
+    code, crashed = _Execute(gcloud_py)
+  finally:
+    os.dup2(saved_fds[0], 1)
+    os.dup2(saved_fds[1], 2)
+    for fd in saved_fds:
+      os.close(fd)
+    sys.path[:] = saved_path
+  out, err = _ReadCaptured(captured)
+  return code, out, err, crashed, launch_time
+
+
+def _Fork(gcloud_py, request, pipes):
+  """Runs one command in a forked child with fds 1 and 2 captured.
+
+  Returns:
+    (int, bytes, bytes, bool, float), as _Run. A command that crashes only
+      takes its child down, so it's reported as failing rather than crashing.
+  """
+  captured = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+  start = time.time()
+  pid = os.fork()
+  if not pid:
+    code = 1
+    try:
+      for pipe in pipes:
+        pipe.close()
+      _Prepare(gcloud_py, request)
+      os.dup2(captured[0].fileno(), 1)
+      os.dup2(captured[1].fileno(), 2)
+      code, _ = _Execute(gcloud_py)
+    finally:
+      os._exit(code)  # pylint: disable=protected-access
+  launch_time = time.time() - start
+  _, status = os.waitpid(pid, 0)
+  if os.WIFSIGNALED(status):
+    code = -os.WTERMSIG(status)
+  else:
+    code = os.WEXITSTATUS(status)
+  out, err = _ReadCaptured(captured)
+  return code, out, err, False, launch_time
+
+
+def _Respond(responses, header, out=b'', err=b''):
+  responses.write(json.dumps(header).encode('utf-8') + b'\n')
+  responses.write(out)
+  responses.write(err)
+  responses.flush()
+
+
+def main(argv):
+  run = _Run
+  if argv[1:2] == ['--fork']:
+    run = _Fork
+    argv = argv[1:]
+  sdk_dir, modules = argv[1], argv[2:]
+  gcloud_py = os.path.join(sdk_dir, 'lib', 'gcloud.py')
+
+  # Keep the pipes to the driver to ourselves. Commands get /dev/null as stdin
+  # and temporary files as stdout and stderr.
+  requests = os.fdopen(os.dup(0), 'rb')
+  responses = os.fdopen(os.dup(1), 'wb')
+  devnull = os.open(os.devnull, os.O_RDWR)
+  os.dup2(devnull, 0)
+  os.dup2(devnull, 1)
+  os.close(devnull)
+
+  start = time.time()
+  _Preload(sdk_dir, modules)
+  _Respond(responses, {'ready': True, 'preload_time': time.time() - start})
+
+  for line in iter(requests.readline, b''):
+    request = json.loads(line.decode('utf-8'))
+    code, out, err, crashed, launch_time = run(
+        gcloud_py, request, (requests, responses))
+    _Respond(responses, {'code': code, 'crashed': crashed,
+                         'launch_time': launch_time, 'stdout': len(out),
+                         'stderr': len(err)}, out, err)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,199 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""urllib2 handlers that reuse HTTP connections.
+
+urllib2 opens a new connection (and for HTTPS, does a new TLS handshake) for
+every request. The handlers here keep finished connections in a pool and reuse
+them for later requests to the same host, while leaving everything else
+(redirects, proxies, error handling) to urllib2.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import httplib
+import socket
+import threading
+import urllib2
+
+from cloudsdk_test_driver import constants
+
+
+class ConnectionPool(object):
+  """Idle keep-alive connections, keyed by scheme and host."""
+
+  def __init__(self, max_idle=None):
+    self._max_idle = max_idle or constants.HTTP_POOL_SIZE
+    self._lock = threading.Lock()
+    self._idle = collections.defaultdict(list)
+
+  def Get(self, key):
+    """Returns an idle connection for key, or None."""
+    with self._lock:
+      idle = self._idle.get(key)
+      return idle.pop() if idle else None
+
+  def Put(self, key, connection):
+    """Returns a connection to the pool once its response has been read."""
+    with self._lock:
+      idle = self._idle[key]
+      if len(idle) < self._max_idle:
+        idle.append(connection)
+        return
+    connection.close()
+
+  def Clear(self):
+    with self._lock:
+      idle, self._idle = self._idle, collections.defaultdict(list)
+    for connections in idle.values():
+      for connection in connections:
+        connection.close()
+
+
+class _PooledResponse(object):
+  """The response to a pooled request, in the form urllib2 expects.
+
+  The connection goes back to the pool once the whole body has been read, or is
+  closed if the response is closed before that.
+  """
+
+  def __init__(self, response, url, release):
+    self._response = response
+    self._release = release
+    self.url = url
+    self.code = response.status
+    self.msg = response.reason
+    self.headers = response.msg
+    if response.length == 0:
+      # Bodiless responses (e.g. 304) are done already. Reading marks them so.
+      response.read()
+    self._ReleaseIfDone()
+
+  def _ReleaseIfDone(self):
+    if self._release and self._response.isclosed():
+      release, self._release = self._release, None
+      release(not self._response.will_close)
+
+  def read(self, size=-1):  # pylint: disable=invalid-name
+    data = self._response.read() if size < 0 else self._response.read(size)
+    self._ReleaseIfDone()
+    return data
+
+  def readline(self):  # pylint: disable=invalid-name
+    line = []
+    while not line or line[-1] != '\n':
+      char = self.read(1)
+      if not char:
+        break
+      line.append(char)
+    return ''.join(line)
+
+  def close(self):  # pylint: disable=invalid-name
+    if self._release:
+      # The rest of the body is still on the connection, so it can't be reused.
+      release, self._release = self._release, None
+      self._response.close()
+      release(False)
+
+  def info(self):  # pylint: disable=invalid-name
+    return self.headers
+
+  def geturl(self):  # pylint: disable=invalid-name
+    return self.url
+
+  def getcode(self):  # pylint: disable=invalid-name
+    return self.code
+
+
+def _Headers(request):
+  headers = dict(request.unredirected_hdrs)
+  headers.update((k, v) for k, v in request.headers.items()
+                 if k not in headers)
+  return dict((name.title(), value) for name, value in headers.items())
+
+
+def _OpenPooled(pool, connection_class, request, **connection_args):
+  """Sends request on a pooled connection, opening a new one if needed."""
+  host = request.get_host()
+  if not host:
+    raise urllib2.URLError('no host given')
+  key = (connection_class, host)
+  headers = _Headers(request)
+
+  while True:
+    connection = pool.Get(key)
+    reused = connection is not None
+    if not reused:
+      connection = connection_class(
+          host, timeout=request.timeout, **connection_args)
+    try:
+      connection.request(request.get_method(), request.get_selector(),
+                         request.data, headers)
+      response = connection.getresponse(buffering=True)
+      break
+    except (httplib.HTTPException, socket.error) as err:
+      connection.close()
+      # An idle connection may have been closed by the server in the meantime.
+      # Retry those on a new connection.
+      if not reused:
+        raise urllib2.URLError(err)
+
+  def Release(reusable):
+    if reusable:
+      pool.Put(key, connection)
+    else:
+      connection.close()
+
+  return _PooledResponse(response, request.get_full_url(), Release)
+
+
+class KeepAliveHTTPHandler(urllib2.HTTPHandler):
+
+  def __init__(self, pool):
+    urllib2.HTTPHandler.__init__(self)
+    self._pool = pool
+
+  def http_open(self, req):  # pylint: disable=invalid-name
+    return _OpenPooled(self._pool, httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+
+  def __init__(self, pool):
+    urllib2.HTTPSHandler.__init__(self)
+    self._pool = pool
+
+  def https_open(self, req):  # pylint: disable=invalid-name
+    if req._tunnel_host:  # pylint: disable=protected-access
+      # Leave HTTPS through a proxy to urllib2.
+      return urllib2.HTTPSHandler.https_open(self, req)
+    return _OpenPooled(self._pool, httplib.HTTPSConnection, req,
+                       context=self._context)
+
+
+_pool = ConnectionPool()
+_opener = urllib2.build_opener(
+    KeepAliveHTTPHandler(_pool), KeepAliveHTTPSHandler(_pool))
+
+
+def Open(request):
+  """Like urllib2.urlopen, but reusing connections between requests.
+
+  The response must be read to the end (or closed) for its connection to be
+  reused.
+  """
+  return _opener.open(request)
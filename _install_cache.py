@@ -0,0 +1,203 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of installed SDK trees.
+
+Each entry in the cache is a copy of a google-cloud-sdk folder as left behind by
+install.sh. Entries are keyed by the digest of the tar they were installed from
+and the additional components that were installed with it, so an Init with the
+same inputs can skip unpacking and running the installer entirely.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from cloudsdk_test_driver import constants
+
+
+def CacheKey(tar_digest, additional_components):
+  """Computes the cache key for an installation.
+
+  Args:
+    tar_digest: string, the sha256 digest of the SDK tar.
+    additional_components: [string] or None, the additional components
+      installed with the SDK.
+
+  Returns:
+    string, a key identifying the installation.
+  """
+  key = json.dumps({
+      'tar': tar_digest,
+      'components': sorted(additional_components or []),
+  }, sort_keys=True)
+  return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def Fingerprint(directory):
+  """Computes a fingerprint of the metadata of a directory tree.
+
+  The fingerprint covers the path, type, mode, size and modification time (to
+  the precision the filesystem keeps) of every entry in the tree. It doesn't
+  read file contents, so it's cheap enough to verify on every cache hit. It
+  catches files that were added, removed or rewritten normally (e.g. through a
+  hardlink from an installation) since the entry was stored, but it's not an
+  integrity check: a file rewritten in place with the same size that then has
+  its modification time set back goes unnoticed.
+
+  Args:
+    directory: string, the root of the tree.
+
+  Returns:
+    string, the hex digest of the tree's metadata.
+  """
+  digest = hashlib.sha256()
+  for dirpath, dirnames, filenames in os.walk(directory):
+    dirnames.sort()
+    for name in sorted(dirnames + filenames):
+      path = os.path.join(dirpath, name)
+      relpath = os.path.relpath(path, directory)
+      st = os.lstat(path)
+      if stat.S_ISLNK(st.st_mode):
+        line = 'l {path} {target}'.format(path=relpath, target=os.readlink(path))
+      elif stat.S_ISDIR(st.st_mode):
+        line = 'd {path} {mode:o}'.format(path=relpath, mode=st.st_mode)
+      else:
+        line = 'f {path} {mode:o} {size} {mtime!r}'.format(
+            path=relpath, mode=st.st_mode, size=st.st_size,
+            mtime=st.st_mtime)
+      digest.update(line.encode('utf-8') + b'\n')
+  return digest.hexdigest()
+
+
+def _EntryDirectory(cache_directory, key):
+  return os.path.join(cache_directory, key)
+
+
+def Lookup(cache_directory, key):
+  """Finds a valid cached installation.
+
+  An entry whose fingerprint (see Fingerprint) no longer matches its manifest
+  has been modified and is removed so it can be rebuilt.
+
+  Args:
+    cache_directory: string, the root of the installation cache.
+    key: string, the key returned by CacheKey.
+
+  Returns:
+    string, the path of the cached google-cloud-sdk folder or None if there is
+      no valid entry for key.
+  """
+  entry = _EntryDirectory(cache_directory, key)
+  manifest_path = os.path.join(entry, constants.INSTALL_CACHE_MANIFEST)
+  tree = os.path.join(entry, constants.SDK_FOLDER)
+  try:
+    with open(manifest_path) as fp:
+      manifest = json.load(fp)
+  except (IOError, ValueError):
+    manifest = None
+
+  if manifest is not None and os.path.isdir(tree):
+    if manifest.get('fingerprint') == Fingerprint(tree):
+      return tree
+
+  if os.path.exists(entry):
+    shutil.rmtree(entry, ignore_errors=True)
+  return None
+
+
+def Store(cache_directory, key, sdk_dir, **details):
+  """Adds an installed SDK to the cache.
+
+  The tree is copied into a temporary folder in the cache and then renamed into
+  place, so a partially written entry is never visible to Lookup. If another
+  process stored the same entry first, this copy is discarded.
+
+  Args:
+    cache_directory: string, the root of the installation cache.
+    key: string, the key returned by CacheKey.
+    sdk_dir: string, the installed google-cloud-sdk folder.
+    **details: extra values to record in the entry's manifest.
+  """
+  if not os.path.isdir(cache_directory):
+    os.makedirs(cache_directory)
+  staging = tempfile.mkdtemp(prefix='.staging-', dir=cache_directory)
+  try:
+    tree = os.path.join(staging, constants.SDK_FOLDER)
+    shutil.copytree(sdk_dir, tree, symlinks=True)
+    manifest = dict(details, key=key, fingerprint=Fingerprint(tree))
+    with open(os.path.join(staging, constants.INSTALL_CACHE_MANIFEST), 'w') as fp:
+      json.dump(manifest, fp, sort_keys=True)
+    try:
+      os.rename(staging, _EntryDirectory(cache_directory, key))
+    except OSError as err:
+      # Someone else stored this entry first. Theirs is just as good.
+      if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+        raise
+  finally:
+    if os.path.exists(staging):
+      shutil.rmtree(staging, ignore_errors=True)
+
+
+def _IsCopied(relpath):
+  """Returns whether a file in a cached tree must be copied, not linked."""
+  parts = relpath.split(os.sep)
+  return any(parts[:len(path.split('/'))] == path.split('/')
+             for path in constants.INSTALL_CACHE_COPIED_PATHS)
+
+
+def Materialize(tree, destination):
+  """Recreates a cached tree at destination.
+
+  Files are hardlinked where possible and copied otherwise (e.g. when the cache
+  is on a different filesystem). Files gcloud may write to (see
+  constants.INSTALL_CACHE_COPIED_PATHS) are always copied, so writing to them
+  doesn't change the cache. Existing files in destination are left alone.
+
+  Args:
+    tree: string, a path returned by Lookup.
+    destination: string, where to recreate the tree.
+  """
+  use_links = True
+  for dirpath, dirnames, filenames in os.walk(tree):
+    target_dir = os.path.join(destination, os.path.relpath(dirpath, tree))
+    if not os.path.isdir(target_dir):
+      os.makedirs(target_dir)
+      shutil.copystat(dirpath, target_dir)
+    for name in filenames + [d for d in dirnames
+                             if os.path.islink(os.path.join(dirpath, d))]:
+      source = os.path.join(dirpath, name)
+      target = os.path.join(target_dir, name)
+      if os.path.lexists(target):
+        continue
+      if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        continue
+      if use_links and not _IsCopied(os.path.relpath(source, tree)):
+        try:
+          os.link(source, target)
+          continue
+        except OSError as err:
+          if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+          use_links = False
+      shutil.copy2(source, target)
@@ -0,0 +1,278 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parsing the JSON list a gcloud command writes, one item at a time.
+
+gcloud lists resources as a single JSON array. Rather than reading all of it
+and then parsing all of it, the items of the array are parsed (and handed over)
+as soon as each one has arrived, so only one item is held in memory at a time.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import codecs
+import json
+import re
+
+from cloudsdk_test_driver import error
+
+
+# Values starting with one of these end at a matching bracket or quote, so
+# their end can be found before decoding them.
+_OPENING_CHARACTERS = frozenset(u'[{"')
+
+# What the end of a value depends on, outside of and inside strings.
+_STRUCTURE = re.compile(u'[][{}"]')
+_STRING_SPECIAL = re.compile(u'["\\\\]')
+
+
+def _ScanEnd(text, pos, state):
+  """Looks for the end of an array, object or string.
+
+  Args:
+    text: unicode, text holding (part of) the value.
+    pos: int, where in text to carry on scanning from.
+    state: [int, bool, bool], the bracket depth, whether pos is in a string
+      and whether it follows a backslash there. Starts as [0, False, False] at
+      the start of the value; updated if the value doesn't end in text, so
+      scanning can carry on in the next text.
+
+  Returns:
+    int, the index in text just past the end of the value, or None if it
+      doesn't end in text.
+  """
+  depth, in_string, escaped = state
+  while True:
+    if escaped:
+      if pos >= len(text):
+        break
+      pos += 1
+      escaped = False
+    match = (_STRING_SPECIAL if in_string else _STRUCTURE).search(text, pos)
+    if not match:
+      break
+    pos = match.end()
+    character = match.group()
+    if character == u'\\':
+      escaped = True
+    elif character == u'"':
+      in_string = not in_string
+      if not in_string and not depth:
+        return pos
+    elif character in u'[{':
+      depth += 1
+    else:
+      depth -= 1
+      if not depth:
+        return pos
+  state[:] = [depth, in_string, escaped]
+  return None
+
+
+class _Reader(object):
+  """JSON text read from chunks of UTF-8 as it's needed."""
+
+  def __init__(self, chunks):
+    self._chunks = iter(chunks)
+    self._utf8 = codecs.getincrementaldecoder('utf-8')()
+    self._json_decoder = json.JSONDecoder()
+    self._text = u''
+    self._pos = 0
+    self._eof = False
+
+  def _Read(self):
+    """Returns the next chunk as text, or None if there was nothing left."""
+    if self._eof:
+      return None
+    chunk = next(self._chunks, None)
+    if chunk is None:
+      self._eof = True
+      return self._utf8.decode(b'', True)
+    return self._utf8.decode(chunk)
+
+  def _Fill(self):
+    """Reads another chunk.
+
+    Returns:
+      bool, False if there was nothing left to read.
+    """
+    text = self._Read()
+    if text is None:
+      return False
+    # Drop what's been parsed already.
+    self._text = self._text[self._pos:] + text
+    self._pos = 0
+    return True
+
+  def SkipSpace(self):
+    """Skips whitespace.
+
+    Returns:
+      bool, False if the text ended first.
+    """
+    while True:
+      while self._pos < len(self._text) and self._text[self._pos].isspace():
+        self._pos += 1
+      if self._pos < len(self._text):
+        return True
+      if not self._Fill():
+        return False
+
+  def Next(self):
+    """Returns the next character (after SkipSpace returned True)."""
+    self._pos += 1
+    return self._text[self._pos - 1]
+
+  def Peek(self):
+    return self._text[self._pos]
+
+  def Value(self):
+    """Returns the next JSON value (after SkipSpace returned True).
+
+    Raises:
+      ValueError: if it isn't valid JSON.
+    """
+    if self.Peek() in _OPENING_CHARACTERS:
+      self._ReadToEnd()
+      value, self._pos = self._json_decoder.raw_decode(self._text, self._pos)
+      return value
+    # Numbers and literals are short, so they're just decoded again as they
+    # grow, until something follows them.
+    while True:
+      try:
+        value, end = self._json_decoder.raw_decode(self._text, self._pos)
+      except ValueError:
+        # It may just not have arrived yet.
+        if not self._Fill():
+          raise
+        continue
+      if end < len(self._text) or self._eof:
+        self._pos = end
+        return value
+      self._Fill()
+
+  def _ReadToEnd(self):
+    """Reads until the array, object or string at the position has ended.
+
+    The chunks are scanned once each and joined once, however many chunks the
+    value spans. If the text ends first, decoding the value reports it.
+    """
+    state = [0, False, False]
+    if _ScanEnd(self._text, self._pos, state) is not None:
+      return
+    pieces = [self._text[self._pos:]]
+    while True:
+      text = self._Read()
+      if text is None:
+        break
+      pieces.append(text)
+      if _ScanEnd(text, 0, state) is not None:
+        break
+    self._text = u''.join(pieces)
+    self._pos = 0
+
+
+def Items(chunks):
+  """Yields the items of a JSON array as each one has been read.
+
+  Args:
+    chunks: iterable of bytes, the array as UTF-8.
+
+  Yields:
+    Each item of the array. If the JSON isn't an array, it's yielded as a
+      whole. Empty text yields nothing.
+
+  Raises:
+    ValueError: if the text isn't valid JSON.
+  """
+  reader = _Reader(chunks)
+  if not reader.SkipSpace():
+    return
+  if reader.Peek() != u'[':
+    yield reader.Value()
+  else:
+    reader.Next()
+    if not reader.SkipSpace():
+      raise ValueError('Unterminated array')
+    if reader.Peek() == u']':
+      reader.Next()
+    else:
+      while True:
+        if not reader.SkipSpace():
+          raise ValueError('Unterminated array')
+        yield reader.Value()
+        if not reader.SkipSpace():
+          raise ValueError('Unterminated array')
+        separator = reader.Next()
+        if separator == u']':
+          break
+        if separator != u',':
+          raise ValueError('Expecting , delimiter')
+  if reader.SkipSpace():
+    raise ValueError('Extra data')
+
+
+class JsonItems(object):
+  """The items of the JSON list a command writes, as the command writes them.
+
+  Returned by SDK.RunGcloudIter. Iterate over it (once) for the items. The
+  command is killed if iteration stops early.
+
+  Attributes:
+    stderr: string, what the command wrote to stderr, once iteration has
+      finished. None until then.
+    returncode: int, the command's return code once iteration has finished,
+      None until then.
+  """
+
+  def __init__(self, streaming):
+    """Reads the output of a command.
+
+    Args:
+      streaming: _background.StreamingCommand, the command.
+    """
+    self._streaming = streaming
+    self.stderr = None
+    self.returncode = None
+
+  def __iter__(self):
+    return self._Iterate()
+
+  def _Iterate(self):
+    stderr = []
+
+    def Stdout():
+      for name, data in self._streaming:
+        if name == 'stdout':
+          yield data
+        else:
+          stderr.append(data)
+
+    try:
+      for item in Items(Stdout()):
+        yield item
+    except ValueError as err:
+      raise error.SDKError(
+          'Output of command [{cmd}] is not valid JSON: {err}'.format(
+              cmd=' '.join(self._streaming.command), err=err))
+    finally:
+      self._streaming.Close()
+    self.stderr = b''.join(stderr)
+    self.returncode = self._streaming.returncode
+
+  def Close(self):
+    """Kills the command unless it has finished."""
+    self._streaming.Close()
@@ -0,0 +1,133 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Advisory file locks for sharing work between processes."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import errno
+import fcntl
+import os
+import threading
+import time
+
+
+_wait_times = collections.defaultdict(float)
+_wait_times_lock = threading.Lock()
+
+
+def WaitTimes():
+  """Returns {string: float}, seconds spent waiting on each named lock."""
+  with _wait_times_lock:
+    return dict(_wait_times)
+
+
+def ResetWaitTimes():
+  with _wait_times_lock:
+    _wait_times.clear()
+
+
+class FileLock(object):
+  """An fcntl based lock on a file, usable as a context manager.
+
+  The lock is advisory, so it only excludes other FileLocks on the same path.
+  Separate FileLock objects exclude each other even within one process, so the
+  same path can safely be locked from several threads.
+
+  Attributes:
+    path: string, the lock file.
+    name: string, the name time spent waiting is recorded under.
+    wait_time: float, seconds spent waiting for the most recent Acquire.
+  """
+
+  def __init__(self, path, name=None, shared=False):
+    """Creates a lock. The lock file is created when it's first acquired.
+
+    Args:
+      path: string, the file to lock.
+      name: string, the name to record time spent waiting under in WaitTimes.
+        Defaults to path.
+      shared: bool, whether to take a shared lock rather than an exclusive
+        lock. Any number of shared locks can be held at once, but not together
+        with an exclusive lock.
+    """
+    self.path = path
+    self.name = name or path
+    self.wait_time = 0.0
+    self._shared = shared
+    self._fp = None
+
+  def Acquire(self, blocking=True):
+    """Acquires the lock.
+
+    Args:
+      blocking: bool, whether to wait for the lock if it's held elsewhere.
+
+    Returns:
+      bool, whether the lock was acquired (always True if blocking).
+    """
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError as err:
+        if err.errno != errno.EEXIST:
+          raise
+    fp = open(self.path, 'a')
+    operation = fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX
+    start = time.time()
+    try:
+      fcntl.flock(fp.fileno(), operation | fcntl.LOCK_NB)
+    except IOError as err:
+      if err.errno not in (errno.EAGAIN, errno.EACCES) or not blocking:
+        fp.close()
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+          return False
+        raise
+      fcntl.flock(fp.fileno(), operation)
+    self.wait_time = time.time() - start
+    with _wait_times_lock:
+      _wait_times[self.name] += self.wait_time
+    self._fp = fp
+    return True
+
+  def IsCurrent(self):
+    """Returns whether the acquired lock is on the file now at path.
+
+    If the lock file is removed (or replaced) while a process waits for it, the
+    process ends up holding a lock on a file no one else can open.
+    """
+    try:
+      current = os.stat(self.path)
+    except OSError:
+      return False
+    held = os.fstat(self._fp.fileno())
+    return (current.st_dev, current.st_ino) == (held.st_dev, held.st_ino)
+
+  def Release(self):
+    if self._fp:
+      fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+      self._fp.close()
+      self._fp = None
+
+  def __enter__(self):
+    self.Acquire()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Release()
+    return False
@@ -0,0 +1,175 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeping oversized command output on disk instead of in memory.
+
+Once spilling is enabled (see driver.EnableOutputSpilling), output collected
+for a command is written to a temporary file as soon as it grows past the
+threshold, and the command's result holds a SpilledOutput instead of a string.
+Spilled files are kept until they're closed or the driver is destroyed, since
+errors raised for a command refer to them by path.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mmap
+import os
+import tempfile
+import threading
+
+
+_threshold = None
+_directory = None
+# The paths of the files that haven't been closed yet.
+_spilled = set()
+_spilled_lock = threading.Lock()
+
+
+def Enable(threshold, directory=None):
+  """Spills output bigger than threshold bytes into files in directory."""
+  global _threshold, _directory
+  _threshold = threshold
+  _directory = directory
+
+
+def Disable():
+  global _threshold, _directory
+  _threshold = None
+  _directory = None
+
+
+def Enabled():
+  return _threshold is not None
+
+
+def _Remove(path):
+  with _spilled_lock:
+    _spilled.discard(path)
+  if os.path.exists(path):
+    os.remove(path)
+
+
+def DeleteAll():
+  """Deletes every spilled file that hasn't been closed."""
+  with _spilled_lock:
+    paths = list(_spilled)
+  for path in paths:
+    try:
+      _Remove(path)
+    except OSError:
+      pass
+
+
+class SpilledOutput(object):
+  """A command's stdout or stderr, kept in a temporary file.
+
+  The file is deleted by Close, or by driver.Destroy if it's still around then.
+  It isn't deleted when this is garbage collected: an error raised for the
+  command may give its path after the result has been dropped.
+
+  Attributes:
+    path: string, the file holding the output.
+  """
+
+  def __init__(self, path, size):
+    self.path = path
+    self._size = size
+
+  def __len__(self):
+    return self._size
+
+  def __repr__(self):
+    return '<SpilledOutput of {size} bytes in {path}>'.format(
+        size=self._size, path=self.path)
+
+  def Head(self, size):
+    """Returns the first size bytes of the output."""
+    with open(self.path, 'rb') as fp:
+      return fp.read(size)
+
+  def Tail(self, size):
+    """Returns the last size bytes of the output."""
+    with open(self.path, 'rb') as fp:
+      fp.seek(max(0, self._size - size))
+      return fp.read()
+
+  def Read(self):
+    """Returns all of the output. This reads it all into memory."""
+    with open(self.path, 'rb') as fp:
+      return fp.read()
+
+  def View(self):
+    """Returns a read-only memory map of the output.
+
+    It can be sliced (or searched with the re module) like a string, without
+    reading the whole output into memory. It stays valid after Close.
+    """
+    with open(self.path, 'rb') as fp:
+      return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def Close(self):
+    """Deletes the file."""
+    _Remove(self.path)
+
+
+class Capture(object):
+  """Collects a stream of output, spilling it to disk if it gets too big."""
+
+  def __init__(self):
+    self._threshold = _threshold
+    self._directory = _directory
+    self._chunks = []
+    self._size = 0
+    self._file = None
+    self._path = None
+
+  def Write(self, data):
+    self._size += len(data)
+    if self._file:
+      self._file.write(data)
+      return
+    self._chunks.append(data)
+    if self._threshold is not None and self._size > self._threshold:
+      fd, self._path = tempfile.mkstemp(
+          prefix='cloudsdk-driver-output', dir=self._directory)
+      with _spilled_lock:
+        _spilled.add(self._path)
+      self._file = os.fdopen(fd, 'wb')
+      for chunk in self._chunks:
+        self._file.write(chunk)
+      self._chunks = []
+
+  def Result(self):
+    """Returns the output: a string, or a SpilledOutput if it was spilled."""
+    if not self._file:
+      return b''.join(self._chunks)
+    self._file.close()
+    return SpilledOutput(self._path, self._size)
+
+  def Discard(self):
+    """Deletes whatever has been spilled."""
+    if self._file:
+      self._file.close()
+      _Remove(self._path)
+      self._file = None
+    self._chunks = []
+
+
+def Limit(data):
+  """Returns data, spilled if it's bigger than the threshold."""
+  capture = Capture()
+  capture.Write(data)
+  return capture.Result()
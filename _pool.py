@@ -0,0 +1,262 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A minimal thread pool and future, for running work in the background."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import sys
+import threading
+import time
+
+
+class CancelledError(Exception):
+  """Raised when the result of a cancelled Future is requested."""
+  pass
+
+
+class TimeoutError(Exception):  # pylint: disable=redefined-builtin
+  """Raised when waiting on a Future takes longer than the given timeout."""
+  pass
+
+
+# Shared by every Future so AsCompleted can wait on several at once.
+_DONE_CONDITION = threading.Condition()
+
+
+class Future(object):
+  """The eventual result of a call submitted to a ThreadPool."""
+
+  def __init__(self):
+    self._done = False
+    self._cancelled = False
+    self._running = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def Done(self):
+    """Returns whether the call has finished or was cancelled."""
+    return self._done
+
+  def Cancelled(self):
+    return self._cancelled
+
+  def Cancel(self):
+    """Cancels the call if it hasn't started yet.
+
+    Returns:
+      bool, whether the call was cancelled.
+    """
+    with _DONE_CONDITION:
+      if self._running or self._done:
+        return self._cancelled
+      self._cancelled = True
+    self._Finish()
+    return True
+
+  def Result(self, timeout=None):
+    """Waits for the call to finish and returns its result.
+
+    Args:
+      timeout: number, seconds to wait. None waits forever.
+
+    Returns:
+      The value returned by the call.
+
+    Raises:
+      CancelledError: if the call was cancelled.
+      TimeoutError: if the call didn't finish in time.
+      Exception: whatever the call raised.
+    """
+    self.Wait(timeout)
+    if self._cancelled:
+      raise CancelledError()
+    if self._exc_info:
+      # Keep the traceback from the thread that ran the call.
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def Exception(self, timeout=None):
+    """Waits for the call to finish and returns what it raised, if anything."""
+    self.Wait(timeout)
+    if self._cancelled:
+      raise CancelledError()
+    return self._exc_info[1] if self._exc_info else None
+
+  def Wait(self, timeout=None):
+    """Waits for the call to finish.
+
+    Raises:
+      TimeoutError: if the call didn't finish in time.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with _DONE_CONDITION:
+      while not self._done:
+        if deadline is None:
+          # Waiting with a timeout keeps the wait interruptible.
+          _DONE_CONDITION.wait(1)
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise TimeoutError()
+          _DONE_CONDITION.wait(remaining)
+
+  def AddDoneCallback(self, callback):
+    """Calls callback(future) once the call finishes (or now if it has)."""
+    with _DONE_CONDITION:
+      if not self._done:
+        self._callbacks.append(callback)
+        return
+    callback(self)
+
+  def _Start(self):
+    with _DONE_CONDITION:
+      if self._cancelled:
+        return False
+      self._running = True
+      return True
+
+  def _SetResult(self, result):
+    self._result = result
+    self._Finish()
+
+  def _SetException(self, exc_info):
+    self._exc_info = exc_info
+    self._Finish()
+
+  def _Finish(self):
+    with _DONE_CONDITION:
+      self._done = True
+      self._running = False
+      callbacks, self._callbacks = self._callbacks, []
+      _DONE_CONDITION.notify_all()
+    for callback in callbacks:
+      callback(self)
+
+
+def AsCompleted(futures, timeout=None):
+  """Yields futures as they finish.
+
+  Args:
+    futures: [Future], the futures to wait on.
+    timeout: number, seconds to wait for all of them. None waits forever.
+
+  Yields:
+    Future, each of futures in the order they finish.
+
+  Raises:
+    TimeoutError: if some futures haven't finished when timeout expires.
+  """
+  deadline = None if timeout is None else time.time() + timeout
+  pending = list(futures)
+  while pending:
+    with _DONE_CONDITION:
+      finished = [f for f in pending if f.Done()]
+      if not finished:
+        if deadline is None:
+          _DONE_CONDITION.wait(1)
+          continue
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise TimeoutError()
+        _DONE_CONDITION.wait(remaining)
+        continue
+    for future in finished:
+      pending.remove(future)
+      yield future
+
+
+class ThreadPool(object):
+  """Runs submitted calls on a fixed number of daemon threads.
+
+  Can be used as a context manager, in which case leaving the block waits for
+  all submitted calls to finish.
+  """
+
+  def __init__(self, max_workers):
+    if max_workers < 1:
+      raise ValueError('max_workers must be at least 1.')
+    self._max_workers = max_workers
+    self._queue = collections.deque()
+    self._condition = threading.Condition()
+    self._threads = []
+    self._shutdown = False
+
+  def Submit(self, function, *args, **kwargs):
+    """Schedules function(*args, **kwargs) and returns its Future."""
+    future = Future()
+    with self._condition:
+      if self._shutdown:
+        raise RuntimeError('Cannot submit to a pool that has been shut down.')
+      self._queue.append((future, function, args, kwargs))
+      if len(self._threads) < self._max_workers:
+        thread = threading.Thread(target=self._Work)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+      self._condition.notify()
+    return future
+
+  def Map(self, function, iterable):
+    """Submits function for every item and returns the futures in order."""
+    return [self.Submit(function, item) for item in iterable]
+
+  def Shutdown(self, wait=True, cancel_pending=False):
+    """Stops accepting work.
+
+    Args:
+      wait: bool, whether to wait for the worker threads to finish.
+      cancel_pending: bool, whether to cancel calls that haven't started yet.
+    """
+    with self._condition:
+      self._shutdown = True
+      if cancel_pending:
+        pending = list(self._queue)
+        self._queue.clear()
+      else:
+        pending = []
+      self._condition.notify_all()
+    for future, _, _, _ in pending:
+      future.Cancel()
+    if wait:
+      for thread in self._threads:
+        thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Shutdown(wait=True)
+    return False
+
+  def _Work(self):
+    while True:
+      with self._condition:
+        while not self._queue and not self._shutdown:
+          self._condition.wait()
+        if not self._queue:
+          return
+        future, function, args, kwargs = self._queue.popleft()
+      if not future._Start():  # pylint: disable=protected-access
+        continue
+      try:
+        result = function(*args, **kwargs)
+      except BaseException:  # pylint: disable=broad-except
+        future._SetException(sys.exc_info())  # pylint: disable=protected-access
+      else:
+        future._SetResult(result)  # pylint: disable=protected-access
@@ -0,0 +1,153 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Setting gcloud properties without running gcloud.
+
+Each `gcloud config set` pays for a whole gcloud start up. Properties that
+gcloud wouldn't check or act on when they're set (see
+constants.DIRECT_PROPERTIES) are instead written straight into the active
+configuration's properties file, in the INI format gcloud reads.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ConfigParser
+import os
+import tempfile
+import types
+
+from cloudsdk_test_driver import constants
+
+
+_CONFIGURATIONS_FOLDER = 'configurations'
+_ACTIVE_CONFIG_FILE = 'active_config'
+_DEFAULT_CONFIGURATION = 'default'
+
+_BOOLEAN_VALUES = ('0', '1', 'false', 'true', 'off', 'on', 'no', 'yes', 'n',
+                   'y')
+
+
+def _FullName(name):
+  """Returns section/name for a property (properties in core can omit it)."""
+  return name if '/' in name else 'core/' + name
+
+
+def _DirectValue(name, value):
+  """Returns what to write for a property, or None if gcloud has to set it."""
+  if name in constants.DIRECT_BOOLEAN_PROPERTIES:
+    if isinstance(value, bool):
+      return str(value).lower()
+    if (isinstance(value, types.StringTypes) and
+        value.lower() in _BOOLEAN_VALUES):
+      return value.lower()
+  elif name in constants.DIRECT_PROPERTIES:
+    if isinstance(value, types.StringTypes) and value:
+      return value
+  return None
+
+
+def Split(properties):
+  """Splits properties into those that can be written directly and the rest.
+
+  Args:
+    properties: [(string, ...)], property names and values, in the order
+      they'd be set (so later values win).
+
+  Returns:
+    ({string: string}, [(string, ...)]), the properties to pass to Write (keyed
+      by section/name) and the properties gcloud needs to set, as given.
+  """
+  direct = {}
+  remaining = []
+  remaining_names = set()
+  for name, value in properties:
+    full_name = _FullName(name)
+    stored = _DirectValue(full_name, value)
+    # Written values are set before gcloud runs, so once gcloud has to set a
+    # property, later values for it have to go through gcloud as well.
+    if stored is None or full_name in remaining_names:
+      remaining.append((name, value))
+      remaining_names.add(full_name)
+      direct.pop(full_name, None)
+    else:
+      direct[full_name] = stored
+  return direct, remaining
+
+
+def _ActiveConfiguration(config_directory, name=None):
+  """Returns the name of the active configuration, making 'default' active.
+
+  Args:
+    config_directory: string, the folder CLOUDSDK_CONFIG points to.
+    name: string, the configuration gcloud is told to use instead (e.g. by
+      CLOUDSDK_ACTIVE_CONFIG_NAME), if any.
+
+  Returns:
+    string, the name of the configuration gcloud will read.
+  """
+  if name:
+    return name
+  path = os.path.join(config_directory, _ACTIVE_CONFIG_FILE)
+  try:
+    with open(path) as fp:
+      name = fp.read().strip()
+    if name:
+      return name
+  except IOError:
+    pass
+  with open(path, 'w') as fp:
+    fp.write(_DEFAULT_CONFIGURATION)
+  return _DEFAULT_CONFIGURATION
+
+
+def Write(config_directory, properties, active_configuration=None):
+  """Sets properties in the active configuration of a gcloud config folder.
+
+  Properties already in the file (e.g. the account set by `gcloud auth`) are
+  kept. The file is replaced atomically.
+
+  Args:
+    config_directory: string, the folder CLOUDSDK_CONFIG points to.
+    properties: {string: string}, values keyed by section/name (see Split).
+    active_configuration: string, the value of CLOUDSDK_ACTIVE_CONFIG_NAME in
+      gcloud's environment, if any. It overrides the active_config file.
+
+  Raises:
+    IOError, OSError: if the file can't be written.
+  """
+  configurations = os.path.join(config_directory, _CONFIGURATIONS_FOLDER)
+  if not os.path.isdir(configurations):
+    os.makedirs(configurations)
+  path = os.path.join(
+      configurations,
+      'config_' + _ActiveConfiguration(config_directory, active_configuration))
+
+  parser = ConfigParser.RawConfigParser()
+  parser.read(path)
+  for full_name, value in sorted(properties.items()):
+    section, name = full_name.split('/', 1)
+    if not parser.has_section(section):
+      parser.add_section(section)
+    parser.set(section, name, value)
+
+  fd, temp_path = tempfile.mkstemp(dir=configurations, prefix='.config')
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      parser.write(fp)
+    os.rename(temp_path, path)
+  except:
+    os.remove(temp_path)
+    raise
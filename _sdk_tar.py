@@ -18,12 +18,27 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import hashlib
+import json
+import httplib
 import os
+import Queue
 import shutil
+import socket
+import sys
 import tarfile
+import threading
+import time
 import urllib2
 import urlparse
 
+from cloudsdk_test_driver import _decompress
+from cloudsdk_test_driver import _digest
+from cloudsdk_test_driver import _extract
+from cloudsdk_test_driver import _http
+from cloudsdk_test_driver import _lock
+from cloudsdk_test_driver import _pool
 from cloudsdk_test_driver import constants
 from cloudsdk_test_driver import error
 
@@ -31,70 +46,591 @@ from cloudsdk_test_driver import error
 # TODO(magimaster): Verify that unusual conditions don't result in bad behavior.
 
 
+_CHUNK_SIZE = 64 * 1024
+
+# Errors that may be resolved by retrying the download.
+_RETRYABLE_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error,
+                     IOError)
+
+
+def _OpenUrl(url, start=None, end=None, headers=None):
+  """Opens url, asking for bytes [start, end) if start is given.
+
+  Connections are kept alive and reused for later requests to the same host.
+  """
+  request = urllib2.Request(url, headers=headers or {})
+  if start is not None:
+    request.add_header('Range', 'bytes={start}-{end}'.format(
+        start=start, end='' if end is None else end - 1))
+  return _http.Open(request)
+
+
+def _Validators(response):
+  """Returns the headers that identify the version of a response's body."""
+  headers = response.info()
+  validators = {
+      'etag': headers.getheader('ETag'),
+      'last_modified': headers.getheader('Last-Modified'),
+  }
+  return dict((k, v) for k, v in validators.items() if v)
+
+
+def _IfRange(validators):
+  """Returns the If-Range header value for validators, or None if unusable.
+
+  Weak ETags can't be used with If-Range, so Last-Modified is used instead.
+  """
+  etag = validators.get('etag')
+  if etag and not etag.startswith('W/'):
+    return etag
+  return validators.get('last_modified')
+
+
+class _ChangedError(IOError):
+  """The file on the server changed while (part of) it was downloaded."""
+
+
+@contextlib.contextmanager
+def _NoPhase(unused_name):
+  yield {}
+
+
+def _ParseTotalSize(content_range):
+  """Returns the total size from a 'bytes a-b/total' header, if known."""
+  if not content_range or '/' not in content_range:
+    return None
+  total = content_range.rsplit('/', 1)[1].strip()
+  return int(total) if total.isdigit() else None
+
+
+def _SegmentBounds(total_size):
+  """Splits [0, total_size) into the byte ranges to fetch concurrently."""
+  count = max(1, min(constants.DOWNLOAD_SEGMENTS,
+                     total_size // constants.DOWNLOAD_MIN_SEGMENT_SIZE))
+  return [(total_size * i // count, total_size * (i + 1) // count)
+          for i in range(count)]
+
+
+def _SegmentPath(download_path, index):
+  return '{path}{suffix}{index}'.format(
+      path=download_path, suffix=constants.PARTIAL_SUFFIX, index=index)
+
+
+def _ValidatorsPath(download_path):
+  """Returns where the validators of a partial download are kept.
+
+  The name starts like the segments' names, so _RemoveSegments removes it too.
+  """
+  return download_path + constants.PARTIAL_SUFFIX + '.json'
+
+
+def _ReadValidators(download_path):
+  try:
+    with open(_ValidatorsPath(download_path)) as fp:
+      return json.load(fp)
+  except (IOError, ValueError):
+    return None
+
+
+def _FileSize(path):
+  return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def _RemoveSegments(download_path):
+  directory, name = os.path.split(download_path)
+  prefix = name + constants.PARTIAL_SUFFIX
+  for filename in os.listdir(directory):
+    if filename.startswith(prefix):
+      os.remove(os.path.join(directory, filename))
+
+
+def _CopyResponse(response, path, length=None, append=True, digest=None):
+  """Writes up to length bytes (or everything) from response to path.
+
+  If digest is given, it's updated with every byte written.
+  """
+  with open(path, 'ab' if append else 'wb') as fp:
+    while length is None or length > 0:
+      size = _CHUNK_SIZE if length is None else min(_CHUNK_SIZE, length)
+      chunk = response.read(size)
+      if not chunk:
+        break
+      fp.write(chunk)
+      if digest:
+        digest.update(chunk)
+      if length is not None:
+        length -= len(chunk)
+  if length:
+    raise IOError('Connection closed with {n} bytes left to read.'.format(
+        n=length))
+
+
+def _FetchSegment(url, path, start, end, validators):
+  """Fetches bytes [start, end) of url into path, resuming a partial fetch.
+
+  Raises:
+    _ChangedError: if the file on the server no longer matches validators.
+  """
+  done = _FileSize(path)
+  if done > end - start:
+    os.remove(path)
+    done = 0
+  if done == end - start:
+    return
+  if_range = _IfRange(validators)
+  response = _OpenUrl(url, start + done, end,
+                      headers={'If-Range': if_range} if if_range else None)
+  try:
+    if response.getcode() == 200 and if_range:
+      raise _ChangedError('The file changed on the server.')
+    if response.getcode() != 206:
+      raise IOError('Server ignored the range request.')
+    if _Validators(response) != validators:
+      raise _ChangedError('The file changed on the server.')
+    _CopyResponse(response, path, end - start - done)
+  finally:
+    response.close()
+
+
+def _DownloadAttempt(url, download_path):
+  """Makes one attempt at downloading url, resuming earlier attempts.
+
+  Partial downloads are only resumed if the file on the server hasn't changed
+  since they were started: the validators of the first response are kept next
+  to them and every range request is conditional on them (If-Range).
+
+  Returns:
+    (string, string, dict), the path of the complete temporary file, its sha256
+      digest and its validators (see _Validators). The digest is computed as
+      the bytes are written, so only bytes left over from an earlier attempt
+      are read back from disk.
+  """
+  first_segment = _SegmentPath(download_path, 0)
+  stored = _ReadValidators(download_path)
+  if_range = _IfRange(stored) if stored else None
+  if not if_range:
+    # There's no telling which version leftover segments came from.
+    _RemoveSegments(download_path)
+  resume_from = _FileSize(first_segment)
+  try:
+    response = _OpenUrl(url, resume_from,
+                        headers={'If-Range': if_range} if if_range else None)
+  except urllib2.HTTPError as err:
+    if err.code == 416:
+      # The partial file doesn't match what's on the server (anymore).
+      _RemoveSegments(download_path)
+    raise
+
+  digest = hashlib.sha256()
+  validators = _Validators(response)
+  try:
+    if response.getcode() == 206 and stored and validators != stored:
+      # The server ignored If-Range.
+      _RemoveSegments(download_path)
+      raise _ChangedError('The file changed on the server.')
+    if response.getcode() != 206:
+      # A 200 is the whole (possibly changed) file, so segments can't be kept.
+      _RemoveSegments(download_path)
+      resume_from = 0
+    total_size = None
+    if response.getcode() == 206:
+      total_size = _ParseTotalSize(response.info().getheader('Content-Range'))
+    if total_size is None:
+      # The server doesn't support ranges. Fetch everything in one pass.
+      _RemoveSegments(download_path)
+      length = response.info().getheader('Content-Length')
+      _CopyResponse(response, first_segment,
+                    int(length) if length and length.isdigit() else None,
+                    append=False, digest=digest)
+      bounds = [(0, _FileSize(first_segment))]
+    else:
+      bounds = _SegmentBounds(total_size)
+      if resume_from > bounds[0][1]:
+        _RemoveSegments(download_path)
+        raise IOError('Partial download does not match the server.')
+      # Later attempts (and calls) only resume segments of this version.
+      with open(_ValidatorsPath(download_path), 'w') as fp:
+        json.dump(validators, fp)
+      if resume_from:
+        with open(first_segment, 'rb') as fp:
+          for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+      try:
+        with _pool.ThreadPool(max(1, len(bounds) - 1)) as pool:
+          futures = [
+              pool.Submit(_FetchSegment, url, _SegmentPath(download_path, i),
+                          start, end, validators)
+              for i, (start, end) in enumerate(bounds) if i > 0]
+          # The response that's already open covers the first segment.
+          _CopyResponse(response, first_segment, bounds[0][1] - resume_from,
+                        digest=digest)
+          for future in futures:
+            future.Result()
+      except _ChangedError:
+        # Don't mix bytes from two versions of the file.
+        _RemoveSegments(download_path)
+        raise
+  finally:
+    response.close()
+
+  # Stitch the segments together, hashing them on the way.
+  with open(first_segment, 'ab') as fp:
+    for i in range(1, len(bounds)):
+      segment = _SegmentPath(download_path, i)
+      with open(segment, 'rb') as segment_fp:
+        for chunk in iter(lambda: segment_fp.read(_CHUNK_SIZE), b''):
+          digest.update(chunk)
+          fp.write(chunk)
+      os.remove(segment)
+  if os.path.exists(_ValidatorsPath(download_path)):
+    os.remove(_ValidatorsPath(download_path))
+  return first_segment, digest.hexdigest(), validators
+
+
+def _Download(url, download_path, expected_sha256=None):
+  """Downloads url to download_path through a temporary file.
+
+  The download is split into concurrent range requests when the server supports
+  them. Partial downloads are left next to download_path so that a retry (or a
+  later call) can resume them, and the complete file is only renamed into place
+  once every byte has been fetched (and its digest matches, if one is given).
+
+  Returns:
+    (string, dict), the sha256 digest of the downloaded file and its
+      validators (see _Validators).
+
+  Raises:
+    error.InitError: if the download doesn't match expected_sha256.
+  """
+  for attempt in range(constants.DOWNLOAD_RETRIES + 1):
+    try:
+      temp_path, sha256, validators = _DownloadAttempt(url, download_path)
+      break
+    except _RETRYABLE_ERRORS as err:
+      # Client errors won't go away by asking again, except for a partial
+      # download that no longer matches (which has been removed by now).
+      if (isinstance(err, urllib2.HTTPError) and 400 <= err.code < 500 and
+          err.code != 416):
+        raise
+      if attempt == constants.DOWNLOAD_RETRIES:
+        raise
+      time.sleep(constants.DOWNLOAD_RETRY_DELAY * 2 ** attempt)
+  if expected_sha256 and sha256 != expected_sha256:
+    _RemoveSegments(download_path)
+    _RaiseDigestMismatch(url, expected_sha256, sha256)
+  os.rename(temp_path, download_path)
+  return sha256, validators
+
+
+def _Revalidate(url, download_path, entry):
+  """Checks whether a downloaded tar is still current, replacing it if not.
+
+  Sends a conditional request using the validators recorded when the tar was
+  downloaded. If the server has a newer tar, it's downloaded from the same
+  response and atomically replaces the old one. If the server can't be
+  reached, the downloaded tar is kept.
+
+  Args:
+    url: string, the tar's URL.
+    download_path: string, where the tar was downloaded to.
+    entry: {string: ...}, the tar's manifest entry.
+
+  Returns:
+    (string, dict), the digest and validators of the replacement tar, or None
+      if the downloaded tar was kept.
+  """
+  headers = {}
+  if entry.get('etag'):
+    headers['If-None-Match'] = entry['etag']
+  if entry.get('last_modified'):
+    headers['If-Modified-Since'] = entry['last_modified']
+  temp_path = _SegmentPath(download_path, 0)
+  try:
+    try:
+      response = _OpenUrl(url, headers=headers)
+    except urllib2.HTTPError as err:
+      err.close()
+      if err.code == 304:
+        return None
+      raise
+    digest = hashlib.sha256()
+    try:
+      length = response.info().getheader('Content-Length')
+      _CopyResponse(response, temp_path,
+                    int(length) if length and length.isdigit() else None,
+                    append=False, digest=digest)
+    finally:
+      response.close()
+  except _RETRYABLE_ERRORS as err:
+    _RemoveSegments(download_path)
+    sys.stderr.write(
+        'Warning: unable to check [{url}] for updates, using the downloaded '
+        'copy: {err}\n'.format(url=url, err=err))
+    return None
+  os.rename(temp_path, download_path)
+  return digest.hexdigest(), _Validators(response)
+
+
+def _RaiseDigestMismatch(tar_location, expected, actual):
+  error.RaiseTarError(
+      'verifying', tar_location,
+      'expected sha256 {expected} but got {actual}'.format(
+          expected=expected, actual=actual))
+
+
+def _ExpectedDigest(tar_location, sha256):
+  """Resolves the sha256 argument of DownloadTar to a digest (or None)."""
+  if sha256 != constants.SHA256_SIDECAR:
+    return sha256.lower() if sha256 else None
+
+  sidecar = tar_location + constants.SHA256_SIDECAR_SUFFIX
+  try:
+    if urlparse.urlsplit(tar_location).scheme:
+      response = _OpenUrl(sidecar)
+      try:
+        contents = response.read(4096)
+      finally:
+        response.close()
+    else:
+      with open(sidecar) as fp:
+        contents = fp.read(4096)
+  except urllib2.URLError as err:
+    error.RaiseTarError('downloading', sidecar, err.reason)
+  except _RETRYABLE_ERRORS as err:
+    error.RaiseTarError('downloading', sidecar, str(err))
+  # Sidecars are usually in sha256sum format: '<digest>  <filename>'.
+  fields = contents.split()
+  if not fields or len(fields[0]) != hashlib.sha256().digest_size * 2:
+    error.RaiseTarError('verifying', tar_location,
+                        'no sha256 digest found in [{path}]'.format(
+                            path=sidecar))
+  return fields[0].lower()
+
+
+def _Manifest(download_directory):
+  return _digest.Manifest(os.path.join(
+      download_directory, constants.DOWNLOAD_FOLDER,
+      constants.DIGEST_MANIFEST_FILE))
+
+
+def TarDigest(tar_path, download_directory):
+  """Returns the sha256 digest of a tar returned by DownloadTar.
+
+  The digest recorded when the tar was downloaded (or last hashed) is reused if
+  the file hasn't changed since.
+
+  Args:
+    tar_path: string, the path returned by DownloadTar.
+    download_directory: string, the download_directory given to DownloadTar.
+
+  Returns:
+    string, the hex sha256 digest.
+  """
+  return _Manifest(download_directory).Digest(tar_path)
+
+
+def DownloadPath(tar_location, download_directory):
+  """Returns where tar_location is downloaded to, or None if it's local.
+
+  Creates the downloads folder if needed.
+  """
+  url_parts = urlparse.urlsplit(tar_location)
+  if not url_parts.scheme:
+    return None
+  download_directory = os.path.join(
+      download_directory, constants.DOWNLOAD_FOLDER)
+  if not os.path.exists(download_directory):
+    os.makedirs(download_directory)
+  return os.path.join(download_directory, os.path.basename(url_parts.path))
+
+
+def _DownloadLock(download_path):
+  return _lock.FileLock(download_path + constants.LOCK_SUFFIX, name='download')
+
+
+def UseLock(download_path):
+  """Returns a lock to hold while a downloaded tar is being read.
+
+  The lock is shared, so any number of processes can hold it at once.
+  EvictDownloads skips tars whose lock is held, so holding it from before
+  DownloadTar until the tar has been unpacked keeps another process from
+  evicting the tar in the meantime.
+  """
+  return _lock.FileLock(download_path + constants.USE_LOCK_SUFFIX,
+                        name='download', shared=True)
+
+
+def _IsDownload(name):
+  """Checks whether a file in the downloads folder is a downloaded tar."""
+  return not (name.startswith('.') or name.endswith(constants.LOCK_SUFFIX) or
+              constants.PARTIAL_SUFFIX in name or
+              name == constants.DIGEST_MANIFEST_FILE)
+
+
+def _TryEvict(download_path, manifest):
+  """Removes a downloaded tar unless another process is using it.
+
+  Returns:
+    bool, whether the tar was removed.
+  """
+  use_lock = _lock.FileLock(
+      download_path + constants.USE_LOCK_SUFFIX, name='evict')
+  if not use_lock.Acquire(blocking=False):
+    return False
+  try:
+    download_lock = _lock.FileLock(
+        download_path + constants.LOCK_SUFFIX, name='evict')
+    if not download_lock.Acquire(blocking=False):
+      return False
+    try:
+      os.remove(download_path)
+      manifest.Forget(download_path)
+    finally:
+      download_lock.Release()
+  finally:
+    use_lock.Release()
+  return True
+
+
+def EvictDownloads(download_directory, max_bytes, keep=None):
+  """Removes the least recently used tars until the downloads fit max_bytes.
+
+  Tars are ordered by when DownloadTar last returned them (or when they were
+  last modified, if that wasn't recorded). Tars that are being downloaded or
+  read by other processes (see UseLock) are skipped, so this is safe to run
+  while the downloads folder is shared.
+
+  Args:
+    download_directory: string, the download_directory given to DownloadTar.
+    max_bytes: int, the most bytes of tars to keep.
+    keep: string, the path of a tar to never remove.
+
+  Returns:
+    [string], the paths of the tars that were removed.
+  """
+  folder = os.path.join(download_directory, constants.DOWNLOAD_FOLDER)
+  manifest = _Manifest(download_directory)
+  downloads = []
+  for name in os.listdir(folder):
+    path = os.path.join(folder, name)
+    if not _IsDownload(name) or not os.path.isfile(path):
+      continue
+    st = os.stat(path)
+    entry = manifest.Get(path) or {}
+    downloads.append((entry.get('last_used', st.st_mtime), st.st_size, path))
+
+  total = sum(size for _, size, _ in downloads)
+  evicted = []
+  for _, size, path in sorted(downloads):
+    if total <= max_bytes:
+      break
+    if path != keep and _TryEvict(path, manifest):
+      total -= size
+      evicted.append(path)
+  return evicted
+
+
 # TODO(magimaster): Make sure this behavior is covered in documentation.
-def DownloadTar(tar_location, download_directory):
+def DownloadTar(tar_location, download_directory, sha256=None,
+                max_bytes=None):
   """Downloads the given tar if needed.
 
   If tar_location is a url, download the requested file. If the file already
-  exists, it won't download it again.
+  exists, it won't download it again. Interrupted downloads are resumed.
 
   If tar_location is a local path, verify it exists and then return the path
   unchanged (no need to make another copy of the file).
 
+  The sha256 digest of every downloaded file is recorded in a manifest in the
+  downloads folder, along with its ETag and Last-Modified headers. When a
+  downloaded file is reused, a conditional request checks whether the server
+  has a newer version (unless an expected digest is given), in which case the
+  file is replaced. A previously downloaded file that no longer matches the
+  size and modification time recorded there is downloaded again. If an expected
+  digest is given, the tar is verified against it without reading the file
+  again if the manifest already has a matching entry.
+
+  The download folder may be shared between root directories and processes.
+  If max_bytes is given, the least recently used tars are evicted to keep the
+  folder within that size (see EvictDownloads). Callers should hold the tar's
+  UseLock until they're done reading it.
+
   Args:
     tar_location: string, URL or path to the tar file.
     download_directory: string, path to download to.
+    sha256: string, the expected hex sha256 digest of the tar, or
+      constants.SHA256_SIDECAR to read it from the '.sha256' file next to
+      tar_location. If None, the tar isn't verified.
+    max_bytes: int, the most bytes of downloaded tars to keep in
+      download_directory, or None for no limit.
 
   Returns:
     string, The local path of the tar file.
 
   Raises:
-    error.InitError: If there was a problem when downloading the file.
+    error.InitError: If there was a problem when downloading the file or it
+      doesn't match the expected digest.
     ValueError: If tar_location is a local file that does not exist.
   """
-  url_parts = urlparse.urlsplit(tar_location)
+  download_path = DownloadPath(tar_location, download_directory)
 
   # Check if the tar file points to something that needs to be downloaded.
   # TODO(magimaster): Make things downloadable from gs:// (?).
-  # TODO(magimaster): Retry failed downloads.
-  if url_parts.scheme:
-    # Prepare the download directory.
-    download_directory = os.path.join(
-        download_directory, constants.DOWNLOAD_FOLDER)
-    if not os.path.exists(download_directory):
-      os.makedirs(download_directory)
-
-    tar_name = os.path.basename(url_parts.path)
-    # TODO(magimaster): Make sure this all works with multiple processes.
-    download_path = os.path.join(download_directory, tar_name)
-    # Don't redownload the same file if it already exists.
-    if not os.path.isfile(download_path):
-      try:
-        req = urllib2.urlopen(tar_location)
-        with open(download_path, 'wb') as fp:
-          shutil.copyfileobj(req, fp)
-      except urllib2.URLError as err:
-        error.RaiseTarError('downloading', tar_location, err.reason)
-      except shutil.Error as err:
-        error.RaiseTarError('downloading', tar_location, err.message)
+  if download_path:
+    expected_sha256 = _ExpectedDigest(tar_location, sha256)
+    manifest = _Manifest(download_directory)
+    # Don't redownload the same file if it already exists. Only complete
+    # downloads are ever moved to download_path. The lock makes other processes
+    # wait for an in progress download rather than starting their own.
+    with _DownloadLock(download_path):
+      replacement = None
+      if os.path.isfile(download_path):
+        status, entry = manifest.Status(download_path)
+        if status == 'missing' and expected_sha256:
+          entry = manifest.Record(
+              download_path, _digest.FileDigest(download_path))
+        if status == 'changed' or (
+            expected_sha256 and entry['sha256'] != expected_sha256):
+          # The cached tar was corrupted or is out of date.
+          os.remove(download_path)
+          manifest.Forget(download_path)
+        elif not expected_sha256 and entry and (
+            entry.get('etag') or entry.get('last_modified')):
+          # A tar matching the expected digest can't be out of date, but
+          # otherwise the URL (e.g. RELEASE_TAR) may point to a newer tar now.
+          replacement = _Revalidate(tar_location, download_path, entry)
+
+      if not os.path.isfile(download_path):
+        try:
+          replacement = _Download(
+              tar_location, download_path, expected_sha256)
+        except urllib2.URLError as err:
+          error.RaiseTarError('downloading', tar_location, err.reason)
+        except (httplib.HTTPException, socket.error, IOError,
+                shutil.Error) as err:
+          error.RaiseTarError('downloading', tar_location, str(err))
+      if replacement:
+        digest, validators = replacement
+        manifest.Record(
+            download_path, digest, last_used=time.time(), **validators)
+      else:
+        manifest.Update(download_path, last_used=time.time())
+      if max_bytes is not None:
+        EvictDownloads(download_directory, max_bytes, keep=download_path)
     return download_path
   else:
     # Tar location points to a local directory. Verify it exists and return it.
     if not os.path.isfile(tar_location):
       raise ValueError('[{tar}] does not exist'.format(tar=tar_location))
+    expected_sha256 = _ExpectedDigest(tar_location, sha256)
+    if expected_sha256:
+      actual = TarDigest(tar_location, download_directory)
+      if actual != expected_sha256:
+        _RaiseDigestMismatch(tar_location, expected_sha256, actual)
     return tar_location
 
 
-def ExtractWithoutOverwrite(tar, directory):
-  """Extract an open tar to directory without overwriting existing files."""
-  for member in tar.getmembers():
-    if member.isfile() and os.path.isfile(os.path.join(directory, member.name)):
-      # This file already exists. Don't overwrite it.
-      continue
-    tar.extract(member, path=directory)
-
-
-def UnpackTar(download_path, tar_location, root_directory):
+def UnpackTar(download_path, tar_location, root_directory, phase=None):
   """Unpacks the tar file and the installer if needed.
 
   Unpacks the given tar file and checks whether it was a tar of the full repo or
@@ -102,10 +638,15 @@ def UnpackTar(download_path, tar_location, root_directory):
   the components json with it. For a lone installer, unpack it and return a url
   pointing to the components json located at the original tar location.
 
+  Tars may be gzip, bzip2, xz or zstd compressed (see _decompress.OpenTar).
+
   Args:
     download_path: string, Path to the tar file to unpack.
     tar_location: string, the original location of the tar file.
     root_directory: string, path to install to.
+    phase: function(string), returns a context manager timing the named step
+      of unpacking (see driver.InitProgress.Phase). Steps are 'extract' and,
+      within it, 'installer'.
 
   Returns:
     string, the URL for the components json for this installation or None if
@@ -114,55 +655,274 @@ def UnpackTar(download_path, tar_location, root_directory):
   Raises:
     error.InitError: if something went wrong when unpacking the tar.
   """
-  # TODO(magimaster): Windows.
-  # TODO(magimaster): Make sure paths work with multiple installs/threads.
-  repo_directory = os.path.join(root_directory, constants.REPO_FOLDER)
-  if not os.path.exists(repo_directory):
-    os.makedirs(repo_directory)
   try:
-    with tarfile.open(name=download_path) as tar:
-      ExtractWithoutOverwrite(tar, repo_directory)
+    with _decompress.OpenTar(download_path) as tar:
+      return _UnpackOpenTar(tar, download_path, tar_location, root_directory,
+                            phase or _NoPhase)
   except tarfile.TarError as err:
     error.RaiseTarError('extracting', download_path, err.message)
+  except (OSError, IOError) as err:
+    error.RaiseTarError('extracting', download_path, str(err))
+
+
+def _UnpackOpenTar(tar, download_path, tar_location, root_directory, phase):
+  """Unpacks an open tar in a single pass. See UnpackTar.
+
+  Everything under the SDK folder is extracted straight into root_directory and
+  everything else into the repo folder. If the tar contains the installer tar
+  (i.e. it's a repo tar), the installer is extracted into root_directory as it's
+  read rather than being written out and reopened.
+  """
+  repo_directory = _RepoDirectory(root_directory)
+  extractor = _extract.Extractor()
+  installer_extracted = []
+
+  def ExtractInstaller(fileobj):
+    with phase('installer') as record:
+      with _decompress.OpenTar(fileobj=fileobj) as installer:
+        record['bytes'] = extractor.Extract(
+            installer, lambda _: root_directory)
+    installer_extracted.append(True)
+
+  def Route(name):
+    if name.split('/', 1)[0] == constants.SDK_FOLDER:
+      return root_directory
+    return repo_directory
+
+  with phase('extract') as record:
+    record['bytes'] = extractor.Extract(tar, Route, handlers=dict(
+        (name, ExtractInstaller) for name in constants.INSTALLER_FILES))
 
   # TODO(magimaster): Make sure documentation covers this carefully.
   # If there's a components json file in the tar, assume it's a full repo.
   # Otherwise, assume it's only an installer.
   components_json = os.path.join(repo_directory, constants.COMPONENTS_FILE)
   if os.path.isfile(components_json):
-    # tar_location pointed to a repo tar. Extract the installer and return a url
-    # to the components json from the repo.
-    snapshot_url = 'file://{path}'.format(path=components_json)
-    try:
-      with tarfile.open(
-          name=os.path.join(repo_directory, constants.INSTALLER_FILE)) as tar:
-        ExtractWithoutOverwrite(tar, root_directory)
-    except tarfile.TarError as err:
-      error.RaiseTarError('extracting', download_path, err.message)
-  else:
-    # tar_location pointed to an installer tar. If the tar_location was a local
-    # path, try and find the corresponding component file. (Particularly, if
-    # someone unzipped a repo tar and tried to use the installer from within
-    # that.) Otherwise, leave the components location unset and let the
-    # installer use the default.
-    # TODO(magimaster): This probably misses a few corner cases.
-    url_parts = urlparse.urlparse(tar_location)
-    if not url_parts.scheme:  # Local path
-      components_json = os.path.join(
-          os.path.dirname(tar_location), constants.COMPONENTS_FILE)
-      if os.path.isfile(components_json):
-        snapshot_url = urlparse.urljoin('file://', components_json)
-      else:
-        snapshot_url = None
+    # tar_location pointed to a repo tar. Return a url to the components json
+    # from the repo.
+    if not installer_extracted:
+      error.RaiseTarError('extracting', download_path,
+                          'the repo does not contain an installer')
+    return 'file://{path}'.format(path=components_json)
+
+  return _FinishInstallerTar(download_path, tar_location, root_directory)
+
+
+def _RepoDirectory(root_directory):
+  """Returns the folder tars are extracted into, creating it if needed."""
+  # TODO(magimaster): Windows.
+  # TODO(magimaster): Make sure paths work with multiple installs/threads.
+  repo_directory = os.path.join(root_directory, constants.REPO_FOLDER)
+  if not os.path.exists(repo_directory):
+    os.makedirs(repo_directory)
+  return repo_directory
+
+
+def _FinishInstallerTar(download_path, tar_location, root_directory):
+  """Finishes unpacking a tar that turned out to be a lone installer.
+
+  Args:
+    download_path: string, Path to the tar file that was unpacked.
+    tar_location: string, the original location of the tar file.
+    root_directory: string, path to install to.
+
+  Returns:
+    string, the URL for the components json for this installation or None if
+      the installer should use its default location for the components.
+
+  Raises:
+    error.InitError: if something went wrong when moving the files.
+  """
+  repo_directory = _RepoDirectory(root_directory)
+
+  # tar_location pointed to an installer tar. If the tar_location was a local
+  # path, try and find the corresponding component file. (Particularly, if
+  # someone unzipped a repo tar and tried to use the installer from within
+  # that.) Otherwise, leave the components location unset and let the
+  # installer use the default.
+  # TODO(magimaster): This probably misses a few corner cases.
+  url_parts = urlparse.urlparse(tar_location)
+  if not url_parts.scheme:  # Local path
+    components_json = os.path.join(
+        os.path.dirname(tar_location), constants.COMPONENTS_FILE)
+    if os.path.isfile(components_json):
+      snapshot_url = urlparse.urljoin('file://', components_json)
     else:
       snapshot_url = None
+  else:
+    snapshot_url = None
 
-    # This wasn't a repo, so move the files up a level for consistency.
-    try:
-      for filename in os.listdir(repo_directory):
-        if not os.path.exists(os.path.join(root_directory, filename)):
-          shutil.move(os.path.join(repo_directory, filename), root_directory)
-    except (OSError, shutil.Error) as err:
-      error.RaiseTarError('extracting', download_path, err.message)
+  # This wasn't a repo, so move anything that wasn't already extracted into
+  # root_directory up a level for consistency.
+  try:
+    for filename in os.listdir(repo_directory):
+      if not os.path.exists(os.path.join(root_directory, filename)):
+        shutil.move(os.path.join(repo_directory, filename), root_directory)
+  except (OSError, shutil.Error) as err:
+    error.RaiseTarError('extracting', download_path, err.message)
 
   return snapshot_url
+
+
+class _StreamReader(object):
+  """A file-like view of an HTTP response that's read on another thread.
+
+  A producer thread reads the response into a bounded queue, optionally copying
+  every chunk to a file, while the consumer decompresses and extracts whatever
+  has arrived so far. This overlaps the network transfer with decompression and
+  file writes. The sha256 digest of the response is computed on the way.
+  """
+
+  _EOF = object()
+
+  def __init__(self, response, tee_path=None):
+    self._response = response
+    self._tee_path = tee_path
+    self._queue = Queue.Queue(maxsize=constants.STREAM_BUFFER_CHUNKS)
+    self._buffer = b''
+    self._eof = False
+    self._closed = False
+    self.bytes_read = 0
+    self.digest = hashlib.sha256()
+    self._thread = threading.Thread(target=self._Produce)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Produce(self):
+    tee = None
+    try:
+      if self._tee_path:
+        tee = open(self._tee_path, 'wb')
+      while True:
+        chunk = self._response.read(_CHUNK_SIZE)
+        if not chunk:
+          break
+        if tee:
+          tee.write(chunk)
+        self.digest.update(chunk)
+        self._Put(chunk)
+      self._Put(self._EOF)
+    except _RETRYABLE_ERRORS as err:
+      self._Put(err)
+    finally:
+      if tee:
+        tee.close()
+
+  def _Put(self, item):
+    # Give up once the consumer has gone away rather than blocking forever.
+    while not self._closed:
+      try:
+        self._queue.put(item, timeout=0.1)
+        return
+      except Queue.Full:
+        pass
+
+  def read(self, size=-1):  # pylint: disable=invalid-name
+    """Reads up to size bytes, blocking until they arrive."""
+    while not self._eof and (size < 0 or len(self._buffer) < size):
+      item = self._queue.get()
+      if item is self._EOF:
+        self._eof = True
+      elif isinstance(item, Exception):
+        self._eof = True
+        raise item
+      else:
+        self._buffer += item
+    if size < 0:
+      size = len(self._buffer)
+    data, self._buffer = self._buffer[:size], self._buffer[size:]
+    self.bytes_read += len(data)
+    return data
+
+  def Finish(self):
+    """Drains anything the consumer didn't need and waits for the producer."""
+    while self.read(_CHUNK_SIZE):
+      pass
+    self._thread.join()
+
+  def Close(self):
+    """Stops the producer without waiting for the rest of the response."""
+    self._closed = True
+
+
+def StreamTar(tar_location, root_directory, sha256=None,
+              download_directory=None, max_bytes=None, phase=None):
+  """Downloads and unpacks a remote tar in a single pass.
+
+  Equivalent to DownloadTar followed by UnpackTar, but the tar is extracted
+  while it downloads rather than being written to disk and read back. For repo
+  tars, the nested installer is extracted straight out of the stream as well.
+  The downloaded bytes are still copied to the usual download location so later
+  calls can reuse them, and their digest is recorded as DownloadTar would.
+
+  Since extraction can't wait for the whole tar, a tar that doesn't match sha256
+  has already been unpacked when the mismatch is found. It's still reported as
+  an error and isn't kept for later calls.
+
+  Args:
+    tar_location: string, URL of the tar file.
+    root_directory: string, path to download and install to.
+    sha256: string, the expected digest of the tar (see DownloadTar).
+    download_directory: string, where to save the tar (see DownloadTar).
+      Defaults to root_directory.
+    max_bytes: int, the most bytes of downloaded tars to keep in
+      download_directory (see DownloadTar), or None for no limit.
+    phase: function(string), times the steps of unpacking (see UnpackTar).
+
+  Returns:
+    (string, string), the local path the tar was saved to and the URL for the
+      components json (see UnpackTar).
+
+  Raises:
+    error.InitError: if something went wrong when downloading or unpacking.
+  """
+  download_directory = download_directory or root_directory
+  download_path = DownloadPath(tar_location, download_directory)
+  expected_sha256 = _ExpectedDigest(tar_location, sha256)
+  with _DownloadLock(download_path):
+    download_path, snapshot_url, digest, validators = _StreamTar(
+        tar_location, download_path, root_directory, expected_sha256,
+        phase or _NoPhase)
+    _Manifest(download_directory).Record(
+        download_path, digest, last_used=time.time(), **validators)
+    if max_bytes is not None:
+      EvictDownloads(download_directory, max_bytes, keep=download_path)
+  return download_path, snapshot_url
+
+
+def _StreamTar(tar_location, download_path, root_directory, expected_sha256,
+               phase):
+  """Does the work of StreamTar while holding the download lock."""
+  tee_path = _SegmentPath(download_path, 0)
+  _RemoveSegments(download_path)
+
+  try:
+    response = _OpenUrl(tar_location)
+    reader = _StreamReader(response, tee_path)
+    try:
+      with _decompress.OpenTar(fileobj=reader) as tar:
+        snapshot_url = _UnpackOpenTar(
+            tar, tee_path, tar_location, root_directory, phase)
+      reader.Finish()
+    finally:
+      reader.Close()
+      response.close()
+    length = response.info().getheader('Content-Length')
+    if length and length.isdigit() and int(length) != reader.bytes_read:
+      raise IOError('Connection closed after {n} of {total} bytes.'.format(
+          n=reader.bytes_read, total=length))
+  except urllib2.URLError as err:
+    error.RaiseTarError('downloading', tar_location, err.reason)
+  except tarfile.TarError as err:
+    error.RaiseTarError('extracting', tar_location, err.message)
+  except _RETRYABLE_ERRORS as err:
+    error.RaiseTarError('downloading', tar_location, str(err))
+  except OSError as err:
+    # Writing the extracted files failed.
+    error.RaiseTarError('extracting', tar_location, str(err))
+  digest = reader.digest.hexdigest()
+  if expected_sha256 and digest != expected_sha256:
+    _RemoveSegments(download_path)
+    _RaiseDigestMismatch(tar_location, expected_sha256, digest)
+  os.rename(tee_path, download_path)
+  return download_path, snapshot_url, digest, _Validators(response)
@@ -0,0 +1,150 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prebuilt archives of installed SDKs.
+
+An installation snapshot is a compressed tar holding a google-cloud-sdk folder
+as left behind by install.sh, preceded by a small JSON manifest describing how
+it was installed. Restoring a snapshot skips unpacking the SDK tar and running
+the installer.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import re
+import tarfile
+import tempfile
+
+from cloudsdk_test_driver import _decompress
+from cloudsdk_test_driver import _extract
+from cloudsdk_test_driver import constants
+from cloudsdk_test_driver import error
+
+
+_FORMAT_VERSION = 1
+
+# Per-SDK configuration folders created by SDKFromConfig. These aren't part of
+# the installation, so they're left out of snapshots.
+_CONFIG_FOLDER = re.compile(r'^{prefix}[a-z0-9]{{{n}}}$'.format(
+    prefix=constants.CONFIG_NAME_PREFIX,
+    n=constants.CONFIG_NAME_LENGTH - len(constants.CONFIG_NAME_PREFIX)))
+
+
+def Export(sdk_dir, path, marker):
+  """Packs an installed SDK into a snapshot archive.
+
+  The archive is written next to path and renamed into place once complete, so
+  a half written snapshot is never left at path.
+
+  Args:
+    sdk_dir: string, the installed google-cloud-sdk folder.
+    path: string, where to write the snapshot.
+    marker: {string: ...}, how the SDK was installed (see driver.Init). Stored
+      in the snapshot's manifest.
+  """
+  manifest = json.dumps(
+      dict(marker, format=_FORMAT_VERSION), sort_keys=True).encode('utf-8')
+  directory = os.path.dirname(os.path.abspath(path))
+  fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot')
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      with tarfile.open(fileobj=fp, mode='w:gz') as tar:
+        # The manifest goes first so it can be read without decompressing the
+        # rest of the archive.
+        info = tarfile.TarInfo(constants.SNAPSHOT_MANIFEST)
+        info.size = len(manifest)
+        tar.addfile(info, _BytesReader(manifest))
+        tar.add(sdk_dir, arcname=constants.SDK_FOLDER, filter=_ExcludeConfigs)
+    # mkstemp only lets the owner read the file. Give it the mode open() would.
+    os.chmod(temp_path, 0o666 & ~_Umask())
+    os.rename(temp_path, path)
+  except:
+    os.remove(temp_path)
+    raise
+
+
+def _Umask():
+  umask = os.umask(0)
+  os.umask(umask)
+  return umask
+
+
+def _ExcludeConfigs(info):
+  parts = info.name.split('/')
+  if (len(parts) == 2 and info.isdir() and
+      _CONFIG_FOLDER.match(parts[1])):
+    return None
+  return info
+
+
+class _BytesReader(object):
+  """The minimal file interface tarfile.addfile needs."""
+
+  def __init__(self, data):
+    self._data = data
+
+  def read(self, size=-1):  # pylint: disable=invalid-name
+    if size < 0:
+      size = len(self._data)
+    data, self._data = self._data[:size], self._data[size:]
+    return data
+
+
+def ReadManifest(path):
+  """Reads the manifest of a snapshot archive.
+
+  Args:
+    path: string, the snapshot.
+
+  Returns:
+    {string: ...}, the manifest (the marker passed to Export).
+
+  Raises:
+    error.InitError: if path isn't a snapshot.
+  """
+  try:
+    with _decompress.OpenTar(path) as tar:
+      member = tar.next()
+      if member is None or member.name != constants.SNAPSHOT_MANIFEST:
+        raise ValueError('no manifest found')
+      manifest = json.loads(tar.extractfile(member).read().decode('utf-8'))
+  except (tarfile.TarError, IOError, OSError, ValueError) as err:
+    error.RaiseTarError('reading', path, str(err))
+  if manifest.pop('format', None) != _FORMAT_VERSION:
+    error.RaiseTarError('reading', path, 'unsupported snapshot format')
+  return manifest
+
+
+def Restore(path, root_directory):
+  """Unpacks a snapshot archive into root_directory.
+
+  Args:
+    path: string, the snapshot.
+    root_directory: string, the folder to restore the google-cloud-sdk folder
+      into.
+
+  Raises:
+    error.InitError: if the snapshot can't be unpacked.
+  """
+  try:
+    with _decompress.OpenTar(path) as tar:
+      _extract.Extractor().Extract(
+          tar, lambda unused_name: root_directory,
+          handlers={constants.SNAPSHOT_MANIFEST: lambda unused_fileobj: None})
+  except (tarfile.TarError, IOError, OSError) as err:
+    error.RaiseTarError('restoring', path, str(err))
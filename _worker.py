@@ -0,0 +1,282 @@
+# Copyright 2016 The Cloud SDK Test Driver Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Running gcloud commands in a long-lived Python process.
+
+Every gcloud command normally starts a new Python interpreter, which then
+imports most of the SDK before doing any work. Once enabled, gcloud commands
+are instead sent to a worker process (see _gcloud_worker.py) that keeps the SDK
+imported between commands. There's one worker for each installation, Python and
+gcloud configuration (as gcloud caches what it reads from the configuration),
+running one command at a time.
+
+Workers either run commands themselves or, in fork mode, fork a child from
+themselves for each one (a "zygote"). Forked commands still don't pay for
+starting Python and importing the SDK, but each runs in a process of its own,
+so any command can run there.
+
+Run returns None whenever a command should run in a new process instead: when
+the worker is busy, when the command changes state a (non-forking) worker
+would hold on to, and when the command (or the worker) crashes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import threading
+import time
+
+from cloudsdk_test_driver import constants
+
+
+_WORKER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '_gcloud_worker.py')
+
+# Release tracks come before the command group they belong to.
+_RELEASE_TRACKS = frozenset(['alpha', 'beta', 'preview'])
+
+
+class GcloudWorker(object):
+  """A worker process for one installation.
+
+  Attributes:
+    fork: bool, whether the worker forks a child for each command.
+    preload_time: float, seconds the worker took to import the SDK.
+    cold_start_time: float, seconds from starting the worker until it was
+      ready: roughly what starting gcloud in a new process costs.
+  """
+
+  def __init__(self, sdk_dir, python, preload, fork=False):
+    self.fork = fork
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+      self._process = subprocess.Popen(
+          [python, _WORKER_SCRIPT] + (['--fork'] if fork else []) +
+          [sdk_dir] + list(preload),
+          stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull,
+          close_fds=True)
+    self._lock = threading.Lock()
+    header = self._ReadHeader()
+    if not header or not header.get('ready'):
+      self.Close()
+      raise OSError('The gcloud worker for [{0}] did not start.'.format(
+          sdk_dir))
+    self.preload_time = header['preload_time']
+    self.cold_start_time = time.time() - start
+
+  def _ReadHeader(self):
+    line = self._process.stdout.readline()
+    try:
+      return json.loads(line.decode('utf-8'))
+    except ValueError:
+      return None
+
+  def _Read(self, size):
+    data = self._process.stdout.read(size)
+    if len(data) != size:
+      raise IOError('The gcloud worker exited.')
+    return data
+
+  def Run(self, args, env, cwd):
+    """Runs a gcloud command unless the worker is busy.
+
+    Args:
+      args: [string], the command's arguments (not including gcloud).
+      env: {string: string}, the command's whole environment.
+      cwd: string, the folder to run it in.
+
+    Returns:
+      ((stdout, stderr, returncode), float), the result and the seconds the
+        worker took to start the command, or None if the worker is busy.
+
+    Raises:
+      IOError: if the worker exited. It can't be used again.
+      _Crash: if the command crashed the worker. It can't be used again.
+    """
+    if not self._lock.acquire(False):
+      return None
+    try:
+      request = json.dumps({'args': args, 'env': env, 'cwd': cwd})
+      try:
+        self._process.stdin.write(request.encode('utf-8') + b'\n')
+        self._process.stdin.flush()
+      except (IOError, OSError):
+        raise IOError('The gcloud worker exited.')
+      header = self._ReadHeader()
+      if header is None:
+        raise IOError('The gcloud worker exited.')
+      out = self._Read(header['stdout'])
+      err = self._Read(header['stderr'])
+      if header['crashed']:
+        raise _Crash(err)
+      return (out, err, header['code']), header['launch_time']
+    finally:
+      self._lock.release()
+
+  def Close(self):
+    try:
+      self._process.stdin.close()
+      self._process.kill()
+    except (IOError, OSError):
+      # It has already exited.
+      pass
+    self._process.wait()
+    self._process.stdout.close()
+
+
+class _Crash(Exception):
+  """A command raised an exception in the worker instead of exiting."""
+
+
+_enabled = False
+_preload = []
+_fork = False
+_workers = {}
+_workers_lock = threading.Lock()
+_last_launch = threading.local()
+
+
+def Enable(preload, fork=False):
+  """Runs gcloud commands in workers from now on.
+
+  Args:
+    preload: [string], modules each worker imports before its first command.
+    fork: bool, whether workers fork a child for each command. Workers
+      already running are replaced if this changes.
+  """
+  global _enabled, _preload, _fork
+  if fork != _fork:
+    CloseAll()
+  _enabled = True
+  _preload = list(preload)
+  _fork = fork
+
+
+def Disable():
+  """Runs gcloud commands in new processes again and stops every worker."""
+  global _enabled
+  _enabled = False
+  CloseAll()
+
+
+def Enabled():
+  return _enabled
+
+
+def LastLaunch():
+  """Returns how the calling thread's last gcloud command was started.
+
+  Returns:
+    {string: ...}, the mode ('worker' or 'fork'), cold_start_time (see
+      GcloudWorker), launch_time (seconds the worker took to start the
+      command) and saved_time (the difference), or None if the command was
+      run in a new process.
+  """
+  return getattr(_last_launch, 'report', None)
+
+
+def CloseAll():
+  """Stops every worker. Later commands start new ones."""
+  with _workers_lock:
+    workers = list(_workers.values())
+    _workers.clear()
+  for worker in workers:
+    if worker:
+      worker.Close()
+
+
+def _CanRun(args):
+  """Returns whether a gcloud command can run in a worker."""
+  if _fork:
+    return bool(args)
+  for arg in args:
+    if arg in _RELEASE_TRACKS or (arg.startswith('--') and '=' in arg):
+      continue
+    if arg.startswith('-'):
+      # Without knowing the flag, the next argument may be its value (as in
+      # --project foo auth login) rather than the command group.
+      return False
+    return arg not in constants.GCLOUD_WORKER_EXCLUDED_COMMANDS
+  return False
+
+
+def _Key(sdk_dir, python, env):
+  """Returns which worker runs commands with this installation and env."""
+  # Forked commands don't leave anything behind in the worker, so they can
+  # share one whatever their configuration.
+  config = None if _fork else env.get(constants.CONFIG_ENV)
+  return sdk_dir, python, config
+
+
+def _Get(key):
+  """Returns the worker for a _Key, or None if it can't start."""
+  sdk_dir, python, _ = key
+  with _workers_lock:
+    if key not in _workers:
+      try:
+        _workers[key] = GcloudWorker(sdk_dir, python, _preload, _fork)
+      except OSError:
+        # Don't keep trying. Every command will run in a new process.
+        _workers[key] = None
+    return _workers[key]
+
+
+def _Discard(key, worker):
+  with _workers_lock:
+    if _workers.get(key) is worker:
+      del _workers[key]
+  worker.Close()
+
+
+def Run(sdk_dir, python, args, env, cwd):
+  """Runs a gcloud command in the installation's worker if possible.
+
+  Args:
+    sdk_dir: string, the installation.
+    python: string, the Python to run the worker with.
+    args: [string], the command's arguments (not including gcloud).
+    env: {string: string}, the command's whole environment.
+    cwd: string, the folder to run it in.
+
+  Returns:
+    (stdout, stderr, returncode), or None if the command needs to be run in a
+      new process instead.
+  """
+  _last_launch.report = None
+  if not _enabled or not _CanRun(args):
+    return None
+  key = _Key(sdk_dir, python, env)
+  worker = _Get(key)
+  if worker is None:
+    return None
+  try:
+    ran = worker.Run(args, env, cwd)
+  except (IOError, _Crash):
+    # The next command gets a new worker.
+    _Discard(key, worker)
+    return None
+  if ran is None:
+    return None
+  result, launch_time = ran
+  _last_launch.report = {
+      'mode': 'fork' if worker.fork else 'worker',
+      'cold_start_time': worker.cold_start_time,
+      'launch_time': launch_time,
+      'saved_time': worker.cold_start_time - launch_time,
+  }
+  return result
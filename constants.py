@@ -35,15 +35,38 @@ RELEASE_TAR = ('https://dl.google.com/dl/cloudsdk/channels/'
 # Environment variable name constants.
 DRIVER_LOCATION_ENV = 'CLOUDSDK_DRIVER_LOCATION'
 DRIVER_KEEP_LOCATION_ENV = 'CLOUDSDK_DRIVER_KEEP_LOCATION'
+INSTALL_CACHE_ENV = 'CLOUDSDK_DRIVER_INSTALL_CACHE'
+DOWNLOADS_ENV = 'GCLOUD_TEST_DRIVER_DOWNLOADS'
+DOWNLOADS_MAX_BYTES_ENV = 'GCLOUD_TEST_DRIVER_DOWNLOADS_MAX_BYTES'
+INIT_REPORT_ENV = 'GCLOUD_TEST_DRIVER_INIT_REPORT'
 SNAPSHOT_ENV = 'CLOUDSDK_COMPONENT_MANAGER_SNAPSHOT_URL'
 PYTHON_ENV = 'CLOUDSDK_PYTHON'
 CONFIG_ENV = 'CLOUDSDK_CONFIG'
+ACTIVE_CONFIG_ENV = 'CLOUDSDK_ACTIVE_CONFIG_NAME'
 PYTHON_PATH = 'PYTHONPATH'
 
 
 # Static filenames.
 COMPONENTS_FILE = 'components-2.json'
 INSTALLER_FILE = 'google-cloud-sdk.tar.gz'
+# Repo tars recompressed with another format may hold the installer as one of
+# these instead.
+INSTALLER_FILES = [INSTALLER_FILE, 'google-cloud-sdk.tar.xz',
+                   'google-cloud-sdk.tar.zst']
+INSTALL_CACHE_MANIFEST = 'manifest.json'
+# Paths in an installation (relative to google-cloud-sdk) that gcloud writes to,
+# e.g. `gcloud config set --installation` and component updates. These are
+# copied out of the installation cache rather than hardlinked, so writes don't
+# change the cached entry.
+INSTALL_CACHE_COPIED_PATHS = ['properties', '.install']
+DIGEST_MANIFEST_FILE = 'sha256-manifest.json'
+SHA256_SIDECAR_SUFFIX = '.sha256'
+SNAPSHOT_MANIFEST = 'snapshot.json'
+
+
+# Pass as the sha256 argument to Init to read the expected digest of the tar
+# from a sidecar file next to it (tar_location + SHA256_SIDECAR_SUFFIX).
+SHA256_SIDECAR = 'sidecar'
 
 
 # Static directory names.
@@ -51,6 +74,133 @@ SDK_FOLDER = 'google-cloud-sdk'
 REPO_FOLDER = 'repo'
 DOWNLOAD_FOLDER = 'downloads'
 BIN_FOLDER = 'bin'
+# Service accounts are activated once into this folder in the root directory
+# and copied into each SDK configuration using them.
+CREDENTIAL_STORE_FOLDER = '.credentials'
+
+
+# Per-SDK gcloud configuration folders are named CONFIG_NAME_PREFIX followed by
+# random characters, CONFIG_NAME_LENGTH characters in total.
+CONFIG_NAME_PREFIX = 'config'
+CONFIG_NAME_LENGTH = 14
+
+
+# Properties that SDK objects write straight into their configuration instead
+# of running `gcloud config set`. These take any string value (or a boolean for
+# DIRECT_BOOLEAN_PROPERTIES) and gcloud does nothing else when they're set.
+# Other properties are still set with gcloud, which validates them.
+DIRECT_PROPERTIES = [
+    'app/promote_by_default',
+    'compute/region',
+    'compute/zone',
+    'container/cluster',
+    'core/account',
+    'core/project',
+    'functions/region',
+    'run/region',
+]
+DIRECT_BOOLEAN_PROPERTIES = [
+    'app/stop_previous_version',
+    'component_manager/disable_update_check',
+    'core/disable_color',
+    'core/disable_prompts',
+    'core/disable_usage_reporting',
+    'core/log_http',
+    'core/user_output_enabled',
+]
+
+
+# How many initialized configurations driver.EnableSDKCache keeps by default.
+SDK_CACHE_SIZE = 32
+
+# How many ready SDK objects a driver.SDKPool keeps by default.
+SDK_POOL_SIZE = 4
+
+# How many SDK objects driver.SDKsFromConfigs creates at once by default.
+SDK_CREATION_WORKERS = 8
+
+# How many commands SDK.RunMany runs at once by default.
+RUN_MANY_WORKERS = 16
+
+
+# Once driver.EnableOutputSpilling is called, a command's stdout or stderr is
+# moved into a temporary file once it's bigger than this many bytes.
+OUTPUT_SPILL_THRESHOLD = 64 * 1024 * 1024
+
+# Error messages for failed commands include at most this many bytes from the
+# start and from the end of each of their stdout and stderr.
+ERROR_OUTPUT_HEAD = 8 * 1024
+ERROR_OUTPUT_TAIL = 8 * 1024
+
+# Modules a gcloud worker (see driver.EnableGcloudWorker) imports before its
+# first command.
+GCLOUD_WORKER_PRELOAD = ['googlecloudsdk.gcloud_main']
+
+# gcloud command groups that always run in a new process rather than a worker,
+# as they change state a worker would hold on to or need a terminal.
+GCLOUD_WORKER_EXCLUDED_COMMANDS = [
+    'auth',
+    'components',
+    'config',
+    'docker',
+    'feedback',
+    'init',
+    'interactive',
+    'survey',
+]
+
+
+# Suffix for partially downloaded files.
+PARTIAL_SUFFIX = '.part'
+
+
+# Files used to coordinate processes sharing a root directory. The marker holds
+# the tar location and components of a completed installation.
+LOCK_SUFFIX = '.lock'
+USE_LOCK_SUFFIX = '.use.lock'
+INSTALL_LOCK_FILE = '.install.lock'
+INSTALL_MARKER_FILE = '.installed'
+# Init writes this into root directories it creates. Destroy only deletes root
+# directories holding it, once no other process is using them.
+CREATED_MARKER_FILE = '.created'
+
+# Destroy moves root directories into this folder (next to them) to be deleted
+# in the background.
+TRASH_FOLDER = '.cloudsdk-driver-trash'
+
+
+# Download tuning. Tars larger than twice the minimum segment size are fetched
+# as up to DOWNLOAD_SEGMENTS concurrent range requests.
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+# Seconds to wait before the first retry of a failed download. Each later retry
+# waits twice as long as the one before.
+DOWNLOAD_RETRY_DELAY = 1.0
+
+# How many idle keep-alive connections to keep open to each host.
+HTTP_POOL_SIZE = DOWNLOAD_SEGMENTS
+
+# How many downloaded chunks may be buffered ahead of extraction when streaming.
+STREAM_BUFFER_CHUNKS = 64
+
+# Extraction tuning. Files up to EXTRACT_INLINE_SIZE are buffered and written
+# by EXTRACT_WORKERS threads, with at most EXTRACT_BUFFER_BYTES buffered at a
+# time.
+# Bigger files are written directly as they're decompressed.
+EXTRACT_WORKERS = 8
+EXTRACT_BUFFER_BYTES = 64 * 1024 * 1024
+EXTRACT_INLINE_SIZE = 4 * 1024 * 1024
+
+# External decompressors, in order of preference, for each compression format.
+# The first one found on the PATH is used; if none are, decompression falls back
+# to Python. Each command must write the decompressed stdin to stdout.
+DECOMPRESS_COMMANDS = {
+    'gzip': [['pigz', '-dc']],
+    'bzip2': [['lbzip2', '-dc'], ['pbzip2', '-dc']],
+    'xz': [['xz', '-dc', '-T0']],
+    'zstd': [['zstd', '-dc', '-T0']],
+}
 
 
 # These environment variables can't be set by the user as they're used
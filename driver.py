@@ -18,8 +18,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import contextlib
 import copy
+import errno
 import json
 import os
 import random
@@ -28,10 +30,22 @@ import shutil
 import string
 import sys
 import tempfile
+import threading
+import time
 import types
 
+from cloudsdk_test_driver import _background
 from cloudsdk_test_driver import _config
+from cloudsdk_test_driver import _credentials
+from cloudsdk_test_driver import _install_cache
+from cloudsdk_test_driver import _json_stream
+from cloudsdk_test_driver import _lock
+from cloudsdk_test_driver import _output
+from cloudsdk_test_driver import _pool
+from cloudsdk_test_driver import _properties
 from cloudsdk_test_driver import _sdk_tar
+from cloudsdk_test_driver import _snapshot
+from cloudsdk_test_driver import _worker
 from cloudsdk_test_driver import constants
 from cloudsdk_test_driver import error
 
@@ -179,9 +193,418 @@ def _PrepareCommand(command):
       'Command [{cmd}] must be a string, list or tuple.'.format(cmd=command))
 
 
+def _RunInstaller(snapshot_url, additional_components, root_directory,
+                  sdk_dir):
+  """Runs the SDK installer on an unpacked tar."""
+  env = {}
+  if snapshot_url:
+    env[constants.SNAPSHOT_ENV] = snapshot_url
+
+  if sys.executable:
+    env[constants.PYTHON_ENV] = sys.executable
+  # TODO(magimaster): Document that environment will override these.
+  env.update(copy.deepcopy(os.environ))
+
+  if constants.PYTHON_ENV not in env:
+    raise error.InitError('Neither sys.executable nor the {var} '
+                          'environment variable are set.'.format(
+                              var=constants.PYTHON_ENV))
+
+  command = [
+      './install.sh',
+      '--disable-installation-options',
+      '--bash-completion=false',
+      '--path-update=false',
+      '--usage-reporting=false',
+      '--rc-path={path}/.bashrc'.format(path=root_directory)]
+  if additional_components:
+    command.append('--additional-components')
+    command.extend(additional_components)
+
+  p = subprocess.Popen(
+      command, stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE, cwd=sdk_dir, env=env, close_fds=True)
+  out, err = p.communicate()
+  error.HandlePossibleError((out, err, p.returncode),
+                            error.InitError, 'SDK installation failed')
+
+
+def _InstallMarker(tar_location, additional_components):
+  return {
+      'tar_location': tar_location,
+      'additional_components': sorted(additional_components or []),
+  }
+
+
+def _ReadMarker(root_directory):
+  """Returns the marker of the installation in root_directory, or None."""
+  try:
+    marker_path = os.path.join(root_directory, constants.INSTALL_MARKER_FILE)
+    with open(marker_path) as fp:
+      return json.load(fp)
+  except (IOError, ValueError):
+    return None
+
+
+def _IsInstalled(root_directory, marker):
+  """Checks whether root_directory already holds a matching installation."""
+  return _ReadMarker(root_directory) == marker
+
+
+@contextlib.contextmanager
+def _UsingDownload(download_path):
+  """Keeps a downloaded tar from being evicted while it's in use."""
+  if download_path is None:
+    yield
+  else:
+    with _sdk_tar.UseLock(download_path):
+      yield
+
+
+def _Install(tar_location, additional_components, root_directory,
+             cache_directory, stream_download, tar_sha256, download_directory,
+             download_cache_bytes, progress):
+  """Downloads and installs the SDK into root_directory. See Init."""
+  download_path = _sdk_tar.DownloadPath(tar_location, download_directory)
+  with _UsingDownload(download_path):
+    _InstallFromDownload(
+        tar_location, additional_components, root_directory, cache_directory,
+        stream_download, tar_sha256, download_directory, download_cache_bytes,
+        download_path, progress)
+
+
+def _InstallFromDownload(tar_location, additional_components, root_directory,
+                         cache_directory, stream_download, tar_sha256,
+                         download_directory, download_cache_bytes,
+                         download_path, progress):
+  """Does the work of _Install while holding the tar's use lock."""
+  sdk_dir = os.path.join(root_directory, constants.SDK_FOLDER)
+  cache_key = None
+  cached_tree = None
+  stream_download = (stream_download and not cache_directory and
+                     download_path and not os.path.isfile(download_path))
+
+  if stream_download:
+    with progress.Phase('stream') as phase:
+      download_path, snapshot_url = _sdk_tar.StreamTar(
+          tar_location, root_directory, tar_sha256, download_directory,
+          download_cache_bytes, phase=progress.Phase)
+      phase['bytes'] = _FileSize(download_path)
+  else:
+    with progress.Phase('download') as phase:
+      before = _FileKey(download_path or tar_location)
+      download_path = _sdk_tar.DownloadTar(
+          tar_location, download_directory, tar_sha256, download_cache_bytes)
+      # Reusing a downloaded (or local) tar leaves it untouched.
+      phase['cache_hit'] = before is not None and (
+          before == _FileKey(download_path))
+      phase['bytes'] = 0 if phase['cache_hit'] else _FileSize(download_path)
+    if cache_directory:
+      with progress.Phase('cache'):
+        cache_key = _install_cache.CacheKey(
+            _sdk_tar.TarDigest(download_path, download_directory),
+            additional_components)
+        with _CacheLock(cache_directory, cache_key):
+          cached_tree = _install_cache.Lookup(cache_directory, cache_key)
+          if cached_tree:
+            _install_cache.Materialize(cached_tree, sdk_dir)
+    if not cached_tree:
+      with progress.Phase('unpack') as phase:
+        phase['bytes'] = _FileSize(download_path)
+        snapshot_url = _sdk_tar.UnpackTar(
+            download_path, tar_location, root_directory, phase=progress.Phase)
+
+  if not cached_tree:
+    with progress.Phase('install'):
+      _RunInstaller(
+          snapshot_url, additional_components, root_directory, sdk_dir)
+
+  with progress.Phase('verify'):
+    if not os.path.isdir(sdk_dir):
+      raise error.InitError(
+          'SDK installation failed. SDK directory was not created.')
+
+  if cache_key and not cached_tree:
+    try:
+      with progress.Phase('store'), _CacheLock(cache_directory, cache_key):
+        _install_cache.Store(
+            cache_directory, cache_key, sdk_dir, tar_location=tar_location,
+            additional_components=sorted(additional_components or []))
+    except (OSError, IOError, shutil.Error) as err:
+      # A failure to cache the installation shouldn't fail the installation.
+      sys.stderr.write(
+          'Warning: unable to cache the SDK installation: {err}\n'.format(
+              err=err))
+
+
+def _FileKey(path):
+  """Returns what changes when a file is replaced, or None if it's missing."""
+  try:
+    stat = os.stat(path)
+  except (OSError, TypeError):
+    return None
+  return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+def _FileSize(path):
+  try:
+    return os.path.getsize(path)
+  except (OSError, TypeError):
+    return None
+
+
+def _Restore(installation_snapshot, root_directory, progress):
+  """Restores an exported installation into root_directory. See Init."""
+  with progress.Phase('restore') as phase:
+    phase['bytes'] = _FileSize(installation_snapshot)
+    _snapshot.Restore(installation_snapshot, root_directory)
+  if not os.path.isdir(os.path.join(root_directory, constants.SDK_FOLDER)):
+    raise error.InitError(
+        'SDK installation failed. [{path}] holds no SDK directory.'.format(
+            path=installation_snapshot))
+
+
+def ExportInstallation(path):
+  """Packs the installed SDK into an archive that Init can restore.
+
+  The archive holds the SDK folder as left by the installer (without any SDK
+  configurations created since) and a manifest of the tar and additional
+  components it was installed from. Pass it to Init as installation_snapshot to
+  skip downloading and installing the SDK, e.g. on every CI worker.
+
+  Args:
+    path: string, where to write the archive (a gzipped tar).
+
+  Raises:
+    error.InitError: If the driver isn't initialized.
+  """
+  root_directory = os.getenv(constants.DRIVER_LOCATION_ENV)
+  if root_directory is None:
+    raise error.InitError(
+        'Init must be called before the installation can be exported.')
+  marker = _ReadMarker(root_directory)
+  if marker is None:
+    raise error.InitError(
+        'No completed installation found in [{root}].'.format(
+            root=root_directory))
+  _snapshot.Export(
+      os.path.join(root_directory, constants.SDK_FOLDER), path, marker)
+
+
+def _CacheLock(cache_directory, cache_key):
+  return _lock.FileLock(
+      os.path.join(cache_directory, cache_key + constants.LOCK_SUFFIX),
+      name='cache')
+
+
+_last_lock_waits = {}
+_last_init_report = None
+
+
+def LastInitLockWaits():
+  """Returns how long the last Init waited on other processes.
+
+  Processes sharing a root directory (or download and cache folders) take turns
+  downloading and installing, so only one of them does the work. This reports
+  how long the last call to Init in this process spent waiting for its turn.
+
+  Returns:
+    {string: float}, seconds spent waiting for each lock ('install',
+      'download' and 'cache'). Locks that weren't needed are left out.
+  """
+  return dict(_last_lock_waits)
+
+
+def LastInitReport():
+  """Returns where the time went in the last Init in this process.
+
+  If the GCLOUD_TEST_DRIVER_INIT_REPORT environment variable is set, the same
+  report is also written to that path as JSON at the end of every Init.
+
+  Returns:
+    {string: ...}, the 'wall_time' and 'cpu_time' of the whole Init in seconds,
+      its 'phases' (see InitProgress.Phases) and 'lock_waits' (see
+      LastInitLockWaits), or None if Init hasn't run. Failed Inits are reported
+      too, up to the phase that failed.
+  """
+  return copy.deepcopy(_last_init_report)
+
+
+def _ReportInit(progress, wall_time, cpu_time):
+  """Records the report returned by LastInitReport."""
+  global _last_init_report
+  _last_init_report = {
+      'wall_time': wall_time,
+      'cpu_time': cpu_time,
+      'phases': progress.Phases(),
+      'lock_waits': LastInitLockWaits(),
+  }
+  path = os.getenv(constants.INIT_REPORT_ENV)
+  if path:
+    try:
+      with open(path, 'w') as fp:
+        json.dump(_last_init_report, fp, indent=2, sort_keys=True)
+    except (IOError, OSError) as err:
+      sys.stderr.write(
+          'Warning: unable to write the Init report to [{path}]: '
+          '{err}\n'.format(path=path, err=err))
+
+
+def _CpuTime():
+  """Returns the CPU time used by this process and its finished children."""
+  return sum(os.times()[:4])
+
+
+class InitProgress(object):
+  """Records the phases of an Init as they happen.
+
+  The phases are 'wait' (for another process installing to the same root
+  directory), then either 'restore' (from an installation snapshot) or
+  'download', 'cache', 'unpack', 'install', 'verify' and 'store', or 'stream'
+  in place of 'download' and 'unpack'. Phases that aren't needed are skipped.
+  Unpacking (or streaming) the tar is further split into 'extract' and, for repo
+  tars, 'installer' (extracting the nested installer tar) within that.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._phases = []
+    self._running = threading.local()
+
+  @contextlib.contextmanager
+  def Phase(self, name):
+    """Records the body of the with statement as the named phase.
+
+    Yields:
+      {string: ...}, the phase. Its 'bytes' (and any other details) can be
+        filled in by the body.
+    """
+    stack = self._running.__dict__.setdefault('stack', [])
+    phase = {'name': name, 'parent': stack[-1]['name'] if stack else None,
+             'state': 'running', 'wall_time': None, 'cpu_time': None,
+             'bytes': None}
+    start = time.time()
+    cpu_start = _CpuTime()
+    with self._lock:
+      self._phases.append(phase)
+    stack.append(phase)
+    try:
+      yield phase
+    except:
+      phase['state'] = 'failed'
+      raise
+    else:
+      phase['state'] = 'done'
+    finally:
+      stack.pop()
+      phase['wall_time'] = time.time() - start
+      phase['cpu_time'] = _CpuTime() - cpu_start
+
+  def Current(self):
+    """Returns the name of the phase in progress, or None."""
+    with self._lock:
+      for phase in reversed(self._phases):
+        if phase['state'] == 'running':
+          return phase['name']
+    return None
+
+  def Phases(self):
+    """Returns [{string: ...}], each phase so far with its state and duration.
+
+    Each phase is a dict with its 'name', the name of the phase it's part of
+    ('parent', None at the top level), 'state' ('running', 'done' or
+    'failed'), 'wall_time' and 'cpu_time' in seconds (None while running) and
+    'bytes' processed (None if not applicable). CPU time covers the whole
+    process, including finished subprocesses such as the installer. 'download'
+    also has 'cache_hit', whether an already downloaded tar was used.
+    """
+    with self._lock:
+      return [dict(phase) for phase in self._phases]
+
+
+class InitHandle(object):
+  """An Init running in the background. Returned by InitAsync.
+
+  Attributes:
+    progress: InitProgress, the phases of the Init so far.
+  """
+
+  def __init__(self, future, progress):
+    self._future = future
+    self.progress = progress
+
+  def Done(self):
+    """Returns whether the Init has finished (successfully or not)."""
+    return self._future.Done()
+
+  def Wait(self, timeout=None):
+    """Waits for the Init to finish.
+
+    Args:
+      timeout: number, seconds to wait. None waits forever.
+
+    Raises:
+      error.InitError: If the Init didn't finish in time. If it failed,
+        whatever it raised is raised here.
+    """
+    try:
+      self._future.Result(timeout)
+    except _pool.TimeoutError:
+      raise error.InitError(
+          'Init did not finish within {0} seconds (currently in phase '
+          '[{1}]).'.format(timeout, self.progress.Current()))
+
+
+_pending_init = None
+
+
+def InitAsync(*args, **kwargs):
+  """Starts Init on a background thread.
+
+  Takes the same arguments as Init. SDK objects can be created as soon as this
+  returns; SDKFromConfig waits for the installation to finish the first time
+  it's needed. Wait on the returned handle before starting any child processes
+  that use the driver.
+
+  Returns:
+    InitHandle, for following and waiting on the installation.
+
+  Raises:
+    error.InitError: If another Init is still in progress.
+  """
+  global _pending_init
+  if _pending_init and not _pending_init.Done():
+    raise error.InitError('Driver is already being initialized.')
+  progress = InitProgress()
+  pool = _pool.ThreadPool(1)
+  future = pool.Submit(_InitWithArgs, progress, *args, **kwargs)
+  pool.Shutdown(wait=False)
+  _pending_init = InitHandle(future, progress)
+  return _pending_init
+
+
+def _InitWithArgs(progress, tar_location=None, additional_components=None,
+                  root_directory=None, cache_directory=None,
+                  stream_download=False, tar_sha256=None,
+                  installation_snapshot=None, download_directory=None,
+                  download_cache_bytes=None):
+  _Init(progress, tar_location, additional_components, root_directory,
+        cache_directory, stream_download, tar_sha256, installation_snapshot,
+        download_directory, download_cache_bytes)
+
+
+def _WaitForPendingInit():
+  """Waits for an Init started by InitAsync, raising its error if it failed."""
+  if _pending_init:
+    _pending_init.Wait()
+
+
 # TODO(magimaster): Windows.
 # TODO(magimaster): Verify that things are cleaned up if something here fails.
-def Init(tar_location=None, additional_components=None, root_directory=None):
+def Init(tar_location=None, additional_components=None, root_directory=None,
+         cache_directory=None, stream_download=False, tar_sha256=None,
+         installation_snapshot=None, download_directory=None,
+         download_cache_bytes=None):
   """Downloads and installs the SDK.
 
   Initialize the driver by downloading and installing the SDK. This
@@ -191,95 +614,364 @@ def Init(tar_location=None, additional_components=None, root_directory=None):
   installed components and installation properties (config set --installation)
   are tied to the installation.
 
+  Several processes may call Init with the same root_directory at once. One of
+  them will download and install the SDK while the others wait and then reuse
+  that installation. Calling Init again in a process (or a child process) that
+  has already been initialized with the same root_directory does nothing.
+
   Args:
     tar_location: string, where to download the SDK from. If left as None, the
       latest release tar will be used.
     additional_components: [string], a list of additional components to be
       installed with the SDK.
     root_directory: string, where to download and install the SDK to. If left as
-      None, a temporary folder will be created for this purpose.
+      None, a temporary folder will be created for this purpose. If Init
+      creates the folder, Destroy deletes it once no other process uses it.
+    cache_directory: string, a persistent folder for caching installed SDKs.
+      If the same tar has already been installed with the same components, the
+      cached installation is linked into place instead of running the
+      installer. If left as None, the CLOUDSDK_DRIVER_INSTALL_CACHE environment
+      variable is used; if that isn't set either, nothing is cached.
+    stream_download: bool, whether to extract a remote tar while it downloads
+      instead of downloading it first. This is skipped if the tar has already
+      been downloaded or if an installation cache is in use (the cache needs
+      the complete tar to find a cached installation).
+    tar_sha256: string, the expected hex sha256 digest of the tar. The tar is
+      hashed as it downloads and Init fails if it doesn't match. Pass
+      constants.SHA256_SIDECAR to use the digest in the '.sha256' file next to
+      tar_location. If left as None, the tar isn't verified.
+    installation_snapshot: string, the path of an archive written by
+      ExportInstallation. The installation is restored from it instead of
+      downloading and installing the SDK. Can't be combined with tar_location
+      or additional_components, which are taken from the snapshot instead.
+    download_directory: string, where to download the tar to. This can be
+      shared between root directories and processes. If left as None, the
+      GCLOUD_TEST_DRIVER_DOWNLOADS environment variable is used; if that isn't
+      set either, the tar is downloaded into root_directory.
+    download_cache_bytes: int, the most bytes of tars to keep in
+      download_directory. Once it's exceeded, the least recently used tars are
+      deleted. If left as None, the GCLOUD_TEST_DRIVER_DOWNLOADS_MAX_BYTES
+      environment variable is used; if that isn't set either, there's no limit.
 
   Raises:
     error.InitError: If the SDK cannot be downloaded or installed.
   """
+  if _pending_init and not _pending_init.Done():
+    raise error.InitError('Driver is already being initialized.')
+  _Init(InitProgress(), tar_location, additional_components, root_directory,
+        cache_directory, stream_download, tar_sha256, installation_snapshot,
+        download_directory, download_cache_bytes)
+
+
+def _Init(progress, tar_location, additional_components, root_directory,
+          cache_directory, stream_download, tar_sha256, installation_snapshot,
+          download_directory, download_cache_bytes):
+  """Does the work of Init, reporting each phase to progress."""
   if _IsOnWindows():
     raise error.InitError('This driver is not currently Windows compatible.')
 
-  # TODO(magimaster): Make sure this is usable with multiple processes.
   if constants.DRIVER_LOCATION_ENV in os.environ:
+    if root_directory is not None and os.path.realpath(
+        root_directory) == os.path.realpath(
+            os.environ[constants.DRIVER_LOCATION_ENV]):
+      return
     raise error.InitError('Driver is already initialized.')
 
+  if isinstance(additional_components, types.StringTypes):
+    raise error.InitError(
+        'additional_components must be an iterable of strings.')
+
+  if installation_snapshot is not None and (
+      tar_location is not None or additional_components is not None):
+    raise error.InitError(
+        'installation_snapshot cannot be combined with tar_location or '
+        'additional_components.')
+
   if tar_location is None:
     tar_location = constants.RELEASE_TAR
+  if cache_directory is None:
+    cache_directory = os.getenv(constants.INSTALL_CACHE_ENV)
+  # Let go of the root directory of an Init that failed.
+  _ReleaseRootDirectory()
   if root_directory is None:
     root_directory = tempfile.mkdtemp()
-  elif not os.path.isdir(root_directory):
-    os.makedirs(root_directory)
-  else:
-    os.environ[constants.DRIVER_KEEP_LOCATION_ENV] = 'True'
+    open(os.path.join(root_directory, constants.CREATED_MARKER_FILE),
+         'w').close()
+  _UseRootDirectory(root_directory)
+  _ReapTrash(root_directory)
+  if download_directory is None:
+    download_directory = os.getenv(constants.DOWNLOADS_ENV, root_directory)
+  if download_cache_bytes is None and os.getenv(
+      constants.DOWNLOADS_MAX_BYTES_ENV):
+    download_cache_bytes = int(os.getenv(constants.DOWNLOADS_MAX_BYTES_ENV))
 
   # TODO(magimaster): Once some better safeguards are in place, run Destroy if
   # anything in Init fails.
-  download_path = _sdk_tar.DownloadTar(tar_location, root_directory)
+  _lock.ResetWaitTimes()
+  if installation_snapshot is not None:
+    marker = _snapshot.ReadManifest(installation_snapshot)
+  else:
+    marker = _InstallMarker(tar_location, additional_components)
+  install_lock = _lock.FileLock(
+      os.path.join(root_directory, constants.INSTALL_LOCK_FILE),
+      name='install')
+  start = time.time()
+  cpu_start = _CpuTime()
+  try:
+    with progress.Phase('wait'):
+      install_lock.Acquire()
+    try:
+      if not _IsInstalled(root_directory, marker):
+        if installation_snapshot is not None:
+          _Restore(installation_snapshot, root_directory, progress)
+        else:
+          _Install(tar_location, additional_components, root_directory,
+                   cache_directory, stream_download, tar_sha256,
+                   download_directory, download_cache_bytes, progress)
+        with open(os.path.join(
+            root_directory, constants.INSTALL_MARKER_FILE), 'w') as fp:
+          json.dump(marker, fp)
+    finally:
+      install_lock.Release()
+  finally:
+    _last_lock_waits.clear()
+    _last_lock_waits.update(_lock.WaitTimes())
+    _ReportInit(progress, time.time() - start, _CpuTime() - cpu_start)
 
-  snapshot_url = _sdk_tar.UnpackTar(download_path, tar_location, root_directory)
-  env = {}
-  if snapshot_url:
-    env[constants.SNAPSHOT_ENV] = snapshot_url
+  # Store this as an environment variable so subprocesses will have access. Set
+  # this last so that a failed installation won't permit the creation of SDK
+  # objects.
+  os.environ[constants.DRIVER_LOCATION_ENV] = root_directory
+  InvalidateSDKCache()
 
-  if sys.executable:
-    env[constants.PYTHON_ENV] = sys.executable
-  # TODO(magimaster): Document that environment will override these.
-  env.update(copy.deepcopy(os.environ))
 
-  if constants.PYTHON_ENV not in env:
-    raise error.InitError('Neither sys.executable nor the {var} '
-                          'environment variable are set.'.format(
-                              var=constants.PYTHON_ENV))
+_root_use_lock = None
 
-  sdk_dir = os.path.join(root_directory, constants.SDK_FOLDER)
-  command = [
-      './install.sh',
-      '--disable-installation-options',
-      '--bash-completion=false',
-      '--path-update=false',
-      '--usage-reporting=false',
-      '--rc-path={path}/.bashrc'.format(path=root_directory)]
-  if additional_components:
-    if isinstance(additional_components, types.StringTypes):
-      raise error.InitError(
-          'additional_components must be an iterable of strings.')
-    command.append('--additional-components')
-    command.extend(additional_components)
 
-  p = subprocess.Popen(
-      command, stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE, cwd=sdk_dir, env=env)
-  out, err = p.communicate()
-  error.HandlePossibleError((out, err, p.returncode),
-                            error.InitError, 'SDK installation failed')
+def _RootUseLock(root_directory, shared):
+  return _lock.FileLock(
+      os.path.abspath(root_directory) + constants.USE_LOCK_SUFFIX,
+      name='root', shared=shared)
 
-  if not os.path.isdir(sdk_dir):
-    raise error.InitError(
-        'SDK installation failed. SDK directory was not created.')
 
-  # Store this as an environment variable so subprocesses will have access. Set
-  # this last so that a failed installation won't permit the creation of SDK
-  # objects.
-  os.environ[constants.DRIVER_LOCATION_ENV] = root_directory
+def _UseRootDirectory(root_directory):
+  """Creates root_directory if needed and marks it as used by this process.
+
+  Several processes (e.g. test shards, or a process and its children) may use
+  a root directory. Each Init holds a shared lock next to it until Destroy, so
+  that only the last one to finish deletes it. A root directory that already
+  existed (rather than being created by some process's Init) is never deleted.
+  """
+  global _root_use_lock
+  while True:
+    use_lock = _RootUseLock(root_directory, shared=True)
+    # This waits for a Destroy that's deleting the folder to finish.
+    use_lock.Acquire()
+    if use_lock.IsCurrent():
+      break
+    # That Destroy removed the lock file once it was done with it.
+    use_lock.Release()
+  _root_use_lock = use_lock
+  if os.path.isdir(root_directory):
+    if not _CreatedByInit(root_directory):
+      # Let child processes know too.
+      os.environ[constants.DRIVER_KEEP_LOCATION_ENV] = 'True'
+    return
+  # Create the folder together with its marker, so another process never sees
+  # it without one.
+  staging = '{root}.{pid}{suffix}'.format(
+      root=os.path.abspath(root_directory), pid=os.getpid(),
+      suffix=constants.PARTIAL_SUFFIX)
+  # Left over from an earlier process with the same pid.
+  shutil.rmtree(staging, ignore_errors=True)
+  os.mkdir(staging)
+  open(os.path.join(staging, constants.CREATED_MARKER_FILE), 'w').close()
+  try:
+    os.rename(staging, root_directory)
+  except OSError as err:
+    shutil.rmtree(staging, ignore_errors=True)
+    # Another process just created it.
+    if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+      raise
 
 
-def Destroy():
-  """Remove the SDK installation."""
+def _CreatedByInit(root_directory):
+  return os.path.isfile(
+      os.path.join(root_directory, constants.CREATED_MARKER_FILE))
+
+
+def _ClaimRootDirectory(root_directory):
+  """Takes the root directory's lock exclusively unless it's in use elsewhere.
+
+  This doesn't depend on this process holding the shared lock already (a child
+  process that inherited the driver's location doesn't).
+
+  Returns:
+    bool, whether the lock was taken. It's held until _ReleaseRootDirectory.
+  """
+  global _root_use_lock
+  _ReleaseRootDirectory()
+  use_lock = _RootUseLock(root_directory, shared=False)
+  if not use_lock.Acquire(blocking=False):
+    return False
+  _root_use_lock = use_lock
+  return True
+
+
+def _ReleaseRootDirectory(remove_lock_file=False):
+  """Releases the root directory's lock, if this process holds it.
+
+  Args:
+    remove_lock_file: bool, whether to remove the lock file first. Only pass
+      this while holding the lock exclusively; anyone waiting for it then
+      starts over (see _UseRootDirectory).
+  """
+  global _root_use_lock
+  if _root_use_lock:
+    if remove_lock_file:
+      try:
+        os.remove(_root_use_lock.path)
+      except OSError:
+        pass
+    _root_use_lock.Release()
+    _root_use_lock = None
+
+
+def _TrashDirectory(root_directory):
+  """Returns the folder Destroy moves root_directory into before deleting it."""
+  return os.path.join(os.path.dirname(os.path.abspath(root_directory)),
+                      constants.TRASH_FOLDER)
+
+
+# Each path is deleted while holding an exclusive lock on path + LOCK_SUFFIX, so
+# other processes' Inits know to leave it alone.
+_DELETE_SCRIPT = (
+    'import fcntl, os, shutil, sys\n'
+    'for path in sys.argv[1:]:\n'
+    '  with open(path + {lock!r}, "a") as fp:\n'
+    '    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)\n'
+    '    shutil.rmtree(path, True)\n'
+    '    try:\n'
+    '      os.remove(path + {lock!r})\n'
+    '    except OSError:\n'
+    '      pass\n').format(lock=constants.LOCK_SUFFIX)
+
+
+def _DeleteInBackground(paths):
+  """Deletes paths in a detached process that outlives this one."""
+  with open(os.devnull, 'r+') as devnull:
+    subprocess.Popen(
+        [sys.executable or 'python', '-c', _DELETE_SCRIPT] + paths,
+        stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+        preexec_fn=os.setsid)
+
+
+def _TrashLock(path):
+  return _lock.FileLock(path + constants.LOCK_SUFFIX, name='trash')
+
+
+def _ReapTrash(root_directory):
+  """Starts deleting anything an earlier Destroy left in the trash.
+
+  Folders that another process is still deleting (or moving into the trash)
+  are left to it.
+  """
+  trash_directory = _TrashDirectory(root_directory)
+  try:
+    names = os.listdir(trash_directory)
+  except OSError:
+    return
+  leftovers = []
+  for name in names:
+    if name.endswith(constants.LOCK_SUFFIX):
+      continue
+    path = os.path.join(trash_directory, name)
+    trash_lock = _TrashLock(path)
+    if not trash_lock.Acquire(blocking=False):
+      continue
+    try:
+      if os.path.lexists(path):
+        leftovers.append(path)
+      else:
+        # It was deleted while this was listing the trash.
+        os.remove(trash_lock.path)
+    finally:
+      trash_lock.Release()
+  if leftovers:
+    _DeleteInBackground(leftovers)
+
+
+def _MoveToTrash(root_directory):
+  """Atomically moves root_directory into the trash.
+
+  Returns:
+    string, the folder in the trash now holding root_directory.
+
+  Raises:
+    OSError: if it can't be moved (e.g. the trash is on another device).
+  """
+  trash_directory = _TrashDirectory(root_directory)
+  if not os.path.isdir(trash_directory):
+    try:
+      os.makedirs(trash_directory)
+    except OSError:
+      if not os.path.isdir(trash_directory):
+        raise
+  # A fresh folder per Destroy keeps names from colliding.
+  holder = tempfile.mkdtemp(dir=trash_directory)
+  with _TrashLock(holder) as trash_lock:
+    try:
+      os.rename(root_directory,
+                os.path.join(holder, os.path.basename(root_directory)))
+    except OSError:
+      os.rmdir(holder)
+      os.remove(trash_lock.path)
+      raise
+  return holder
+
+
+def Destroy(wait=False):
+  """Remove the SDK installation.
+
+  By default, the installation folder is moved into a trash folder next to it
+  and deleted by a background process, so Destroy returns immediately. Anything
+  left in the trash (e.g. if the machine went down mid-deletion) is deleted by
+  the next Init using a root directory in the same folder.
+
+  Args:
+    wait: bool, whether to delete the installation before returning.
+  """
   # TODO(magimaster): Windows.
   # TODO(magimaster): Add some safeguards here.
+  global _pending_init
+  if _pending_init:
+    # Let a background Init finish (or fail) before deleting its files.
+    try:
+      _pending_init.Wait()
+    except Exception:  # pylint: disable=broad-except
+      # A failed Init leaves nothing to clean up here.
+      pass
+    _pending_init = None
   root_directory = os.getenv(constants.DRIVER_LOCATION_ENV)
   keep_location = os.getenv(constants.DRIVER_KEEP_LOCATION_ENV)
 
+  claimed = False
   if root_directory is not None:
-    if os.path.isdir(root_directory) and not keep_location:
-      shutil.rmtree(root_directory)
+    claimed = _ClaimRootDirectory(root_directory)
+    if claimed and not keep_location and _CreatedByInit(root_directory):
+      if wait:
+        shutil.rmtree(root_directory)
+      else:
+        try:
+          _DeleteInBackground([_MoveToTrash(root_directory)])
+        except OSError:
+          shutil.rmtree(root_directory)
     os.environ.pop(constants.DRIVER_LOCATION_ENV)
+  # With the lock held exclusively, no one else needs its file.
+  _ReleaseRootDirectory(remove_lock_file=claimed)
+  InvalidateSDKCache()
+  _worker.CloseAll()
+  _output.DeleteAll()
 
   if keep_location is not None:
     os.environ.pop(constants.DRIVER_KEEP_LOCATION_ENV)
@@ -304,9 +996,9 @@ class SDK(object):
   created with the same configs should be invisible to the user.
 
   If needed, SDK tar files are downloaded to the directory specified in the
-  GCLOUD_TEST_DRIVER_DOWNLOADS environment variable, if it exists; otherwise,
-  they're downloaded to an sdk_downloads subfolder in the system temporary
-  directory (tempfile.gettempdir()).
+  GCLOUD_TEST_DRIVER_DOWNLOADS environment variable (or the download_directory
+  passed to Init), if it exists; otherwise, they're downloaded to the root
+  directory the SDK is installed to. See Init.
 
   Attributes:
     config: ImmutableConfig, an immutable copy of the Config used to create this
@@ -339,30 +1031,66 @@ class SDK(object):
   def RunInitializationCommands(self):
     """Runs several gcloud commands to finish setting up an SDK."""
     if self.config.service_account_keyfile:
-      # Activating a service account should also set this to the active account.
-      command = ['auth', 'activate-service-account']
-      if self.config.service_account_email:
-        command.append(self.config.service_account_email)
-      command.extend(['--key-file', self.config.service_account_keyfile])
-      result = self.RunGcloudRawOutput(command)
-      error.HandlePossibleError(
-          result, error.SDKError, 'Activating service account failed')
+      self._ActivateServiceAccount()
 
-    # Set project.
+    # Set the project and properties. Most are written straight into the
+    # configuration rather than running gcloud once for each of them.
+    properties = []
     if self.config.project:
-      command = ['config', 'set', 'project', self.config.project]
+      properties.append(('project', self.config.project))
+    if self.config.properties:
+      properties.extend(self.config.properties.items())
+    direct, remaining = _properties.Split(properties)
+    if direct:
+      try:
+        _properties.Write(self._env[constants.CONFIG_ENV], direct,
+                          self._env.get(constants.ACTIVE_CONFIG_ENV))
+      except (IOError, OSError) as err:
+        raise error.SDKError('Setting properties failed: {err}'.format(
+            err=err))
+    for key, value in remaining:
+      command = ['config', 'set', key, value]
       result = self.RunGcloudRawOutput(command)
       error.HandlePossibleError(
-          result, error.SDKError, 'Setting project failed')
+          result, error.SDKError,
+          'Setting property [{prop}] failed'.format(prop=key))
 
-    # Set properties.
-    if self.config.properties:
-      for key, value in self.config.properties.items():
-        command = ['config', 'set', key, value]
-        result = self.RunGcloudRawOutput(command)
-        error.HandlePossibleError(
-            result, error.SDKError,
-            'Setting property [{prop}] failed'.format(prop=key))
+  def _ActivateServiceAccount(self):
+    """Activates the configured service account in this SDK's configuration.
+
+    Each service account is only activated once per installation, into the
+    credential store next to it. Configurations using it are seeded with a copy
+    of the stored credentials.
+    """
+    config_directory = self._env[constants.CONFIG_ENV]
+    store_directory = os.path.join(
+        os.path.dirname(self._sdk_dir), constants.CREDENTIAL_STORE_FOLDER)
+    try:
+      _credentials.Seed(
+          store_directory, self.config.service_account_email,
+          self.config.service_account_keyfile, self._ActivateServiceAccountIn,
+          config_directory)
+    except IOError as err:
+      if not os.path.isfile(self.config.service_account_keyfile):
+        # Let gcloud report a missing key file.
+        self._ActivateServiceAccountIn(config_directory)
+      else:
+        raise error.SDKError(
+            'Activating service account failed: {err}'.format(err=err))
+    except OSError as err:
+      raise error.SDKError(
+          'Activating service account failed: {err}'.format(err=err))
+
+  def _ActivateServiceAccountIn(self, config_directory):
+    # Activating a service account should also set this to the active account.
+    command = ['auth', 'activate-service-account']
+    if self.config.service_account_email:
+      command.append(self.config.service_account_email)
+    command.extend(['--key-file', self.config.service_account_keyfile])
+    result = self.RunGcloudRawOutput(
+        command, env={constants.CONFIG_ENV: config_directory})
+    error.HandlePossibleError(
+        result, error.SDKError, 'Activating service account failed')
 
   def Run(self, command, timeout=None, env=None):
     """Run a command against this SDK installation.
@@ -374,21 +1102,33 @@ class SDK(object):
       env: dict or None, Extra environmental variables use with this command.
 
     Returns:
-      (stdout, stderr, returncode) returned from the command.
+      (stdout, stderr, returncode) returned from the command. If output
+      spilling is enabled (see EnableOutputSpilling), oversized stdout or
+      stderr is an _output.SpilledOutput rather than a string.
 
     Raises:
-      error.SDKError: If the command cannot be run.
+      error.SDKError: If the command cannot be run, or (with output spilling
+        enabled) times out.
     """
-    # Add the passed in variables to the precomputed environment (without
-    # altering either dictionary).
-    if env:
-      env = dict(self._env, **env)
-    else:
-      env = self._env
+    command = _PrepareCommand(command)
+    environ = self._Environ(env)
+    if _output.Enabled():
+      # Workers send back the whole output at once, so they're bypassed when
+      # it has to be spilled as it's read.
+      return self._RunSpilling(command, environ, timeout)
+
+    if (timeout is None and not _IsOnWindows() and command and
+        command[0] == 'gcloud'):
+      result = _worker.Run(
+          self._sdk_dir, environ[constants.PYTHON_ENV], command[1:], environ,
+          os.path.dirname(self._sdk_dir))
+      if result is not None:
+        return result
 
     p = subprocess.Popen(
-        _PrepareCommand(command), stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE, cwd=os.path.dirname(self._sdk_dir), env=env)
+        command, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, cwd=os.path.dirname(self._sdk_dir),
+        env=environ, close_fds=True)
     if TIMEOUT_ENABLED:
       out, err = p.communicate(timeout=timeout)
     else:
@@ -400,6 +1140,191 @@ class SDK(object):
     # TODO(magimaster): Change this to raise an error if returncode isn't 0
     return out, err, p.returncode
 
+  def _RunSpilling(self, command, environ, timeout):
+    """Runs a command, spilling oversized output to disk as it's read."""
+    captures = {'stdout': _output.Capture(), 'stderr': _output.Capture()}
+    streaming = _background.StreamingCommand(
+        command, {'cwd': os.path.dirname(self._sdk_dir), 'env': environ},
+        timeout, lines=False)
+    try:
+      for name, data in streaming:
+        captures[name].Write(data)
+    except:
+      for capture in captures.values():
+        capture.Discard()
+      raise
+    return (captures['stdout'].Result(), captures['stderr'].Result(),
+            streaming.returncode)
+
+  def _Environ(self, env):
+    # Add the passed in variables to the precomputed environment (without
+    # altering either dictionary).
+    if env:
+      return dict(self._env, **env)
+    return self._env
+
+  def RunIter(self, command, timeout=None, env=None, lines=True):
+    """Runs a command, handing over its output as it arrives.
+
+    Unlike Run, the output is never held in memory all at once, and can be
+    checked (or the command stopped) before the command finishes.
+
+    Args:
+      command: string, list or tuple, The command to run (e.g. ['gsutil', 'cp',
+        ...])
+      timeout: number, Seconds to let the command run before killing it.
+      env: dict or None, Extra environmental variables use with this command.
+      lines: bool, whether to hand over the output a line at a time (each with
+        its newline) rather than in chunks as it's read.
+
+    Returns:
+      _background.StreamingCommand, which yields (name, data) as the command
+        writes data to name ('stdout' or 'stderr'). Its returncode is set once
+        it has been iterated over. Stopping early kills the command.
+
+    Raises:
+      error.SDKError: If the command cannot be run. Iterating raises it if the
+        command times out.
+    """
+    return _background.StreamingCommand(
+        _PrepareCommand(command),
+        {'cwd': os.path.dirname(self._sdk_dir), 'env': self._Environ(env)},
+        timeout, lines)
+
+  def RunStreaming(self, command, on_stdout=None, on_stderr=None,
+                   timeout=None, env=None, lines=True):
+    """Runs a command, calling back with its output as it arrives.
+
+    Args:
+      command: string, list or tuple, The command to run (e.g. ['gsutil', 'cp',
+        ...])
+      on_stdout: function(string), called with each line (or chunk) of stdout.
+        Raising an exception kills the command, and the exception propagates.
+      on_stderr: function(string), the same for stderr.
+      timeout: number, Seconds to let the command run before killing it.
+      env: dict or None, Extra environmental variables use with this command.
+      lines: bool, as in RunIter.
+
+    Returns:
+      int, the command's return code.
+
+    Raises:
+      error.SDKError: If the command cannot be run or times out.
+    """
+    callbacks = {'stdout': on_stdout, 'stderr': on_stderr}
+    streaming = self.RunIter(command, timeout, env, lines)
+    try:
+      for name, data in streaming:
+        if callbacks[name]:
+          callbacks[name](data)
+    finally:
+      streaming.Close()
+    return streaming.returncode
+
+  def RunInBackground(self, command, timeout=None, env=None, semaphore=None):
+    """Starts a command against this SDK installation without waiting for it.
+
+    Commands started this way don't each need a thread: a single background
+    thread collects the output of all of them.
+
+    Args:
+      command: string, list or tuple, The command to run (e.g. ['gsutil', 'cp',
+        ...])
+      timeout: number, Seconds to let the command run before killing it.
+      env: dict or None, Extra environmental variables use with this command.
+      semaphore: threading.Semaphore, if given, the command waits to start
+        until it can acquire this, and releases it once it's finished. Share
+        one between commands to limit how many run at once.
+
+    Returns:
+      _background.BackgroundCommand, the command. Poll or Wait on it for
+        (stdout, stderr, returncode), or see WaitAny.
+
+    Raises:
+      error.SDKError: If the command cannot be parsed.
+    """
+    return self._StartInBackground(
+        _PrepareCommand(command), timeout, env, semaphore)
+
+  def _StartInBackground(self, command, timeout, env, semaphore, parse=None):
+    return _background.Submit(_background.BackgroundCommand(
+        command,
+        {'cwd': os.path.dirname(self._sdk_dir), 'env': self._Environ(env)},
+        timeout, semaphore, parse))
+
+  def RunGcloudInBackground(self, command, format_keys=None, filters=None,
+                            timeout=None, env=None, semaphore=None):
+    """Starts a gcloud command without waiting for it.
+
+    Like RunInBackground, but the command's result is parsed as in RunGcloud.
+
+    Returns:
+      _background.BackgroundCommand, the command. Poll or Wait on it for
+        (json_output, stderr, returncode).
+    """
+    return self._StartInBackground(
+        _GcloudCommand(command, _JsonFormat(format_keys), filters), timeout,
+        env, semaphore, parse=_ParseJsonOutput)
+
+  def RunGcloudRawOutputInBackground(self, command, formats=None, filters=None,
+                                     timeout=None, env=None, semaphore=None):
+    """Starts a gcloud command without waiting for it.
+
+    Like RunInBackground, for the command RunGcloudRawOutput would run.
+    """
+    return self._StartInBackground(
+        _GcloudCommand(command, formats, filters), timeout, env, semaphore)
+
+  def RunMany(self, commands, max_workers=constants.RUN_MANY_WORKERS,
+              ordered=True, gcloud=False, format_keys=None, filters=None,
+              timeout=None, env=None, deadline=None, fail_fast=False):
+    """Runs a batch of independent commands in parallel.
+
+    Args:
+      commands: [string, list or tuple], the commands to run.
+      max_workers: int, how many commands to run at once.
+      ordered: bool, whether to wait for every command and return the results
+        in the order of commands, or yield them as the commands finish.
+      gcloud: bool, whether to run the commands as RunGcloud would (parsing
+        their output) rather than as Run would.
+      format_keys: list, passed to RunGcloud if gcloud is set.
+      filters: string, passed to RunGcloud if gcloud is set.
+      timeout: number, Seconds to let each command run before killing it.
+      env: dict or None, Extra environmental variables use with every command.
+      deadline: number, Seconds for the whole batch to finish. Commands still
+        running by then are killed.
+      fail_fast: bool, whether to stop (killing the commands still running) as
+        soon as a command returns a non-zero return code.
+
+    Returns:
+      If ordered, [(stdout, stderr, returncode)], the result of each command.
+      Otherwise, an iterator of (index, stdout, stderr, returncode) as each
+        command finishes, where index is the command's index in commands.
+        Commands still running when iteration stops are killed.
+
+    Raises:
+      error.SDKError: If a command can't be run or times out, the deadline
+        passes or (with fail_fast) a command fails. The commands still running
+        are killed. If ordered is False, this is raised while iterating.
+    """
+    semaphore = threading.Semaphore(max_workers)
+    if gcloud:
+      running = [self.RunGcloudInBackground(
+          command, format_keys, filters, timeout, env, semaphore)
+                 for command in commands]
+    else:
+      running = [self.RunInBackground(command, timeout, env, semaphore)
+                 for command in commands]
+    results = _RunManyResults(
+        running, None if deadline is None else time.time() + deadline,
+        fail_fast)
+    if not ordered:
+      return results
+    ordered_results = [None] * len(running)
+    for index, out, err, code in results:
+      ordered_results[index] = (out, err, code)
+    return ordered_results
+
   def RunGcloud(self, command, format_keys=None,
                 filters=None, timeout=None, env=None):
     """Run a gcloud command against this SDK installation.
@@ -421,22 +1346,40 @@ class SDK(object):
       error.SDKError: If the command cannot be run or returns something that
         cannot be parsed.
     """
-    if format_keys:
-      formats = 'json({keys})'.format(keys=','.join(format_keys))
-    else:
-      formats = 'json'
-
     out, err, code = self.RunGcloudRawOutput(
-        command, formats, filters, timeout, env)
+        command, _JsonFormat(format_keys), filters, timeout, env)
+    return _ParseJsonOutput(out, err, code)
 
-    if out:
-      try:
-        return json.loads(out), err, code
-      except ValueError:
-        # TODO(magimaster): Log failure to decode JSON when logging is added
-        return out, err, code
-    else:
-      return None, err, code
+  def RunGcloudIter(self, command, format_keys=None, filters=None,
+                    timeout=None, env=None):
+    """Runs a gcloud command, parsing its JSON output as it arrives.
+
+    Like RunGcloud, but for commands that list resources: each one is parsed
+    and handed over as soon as it has arrived, so only one is held in memory at
+    a time.
+
+    Args:
+      command: string, list or tuple, The gcloud command to run (no need to
+        start with 'gcloud').
+      format_keys: list, Keys to pass in as part of a format specification (the
+        format will be json).
+      filters: string, Filters to pass to the gcloud command.
+      timeout: number, Seconds to let the command run before killing it.
+      env: dict or None, Extra environmental variables use with this command.
+
+    Returns:
+      _json_stream.JsonItems, which yields the items of the list the command
+        writes (or whatever else it writes, as a whole). Its stderr and
+        returncode are set once it has been iterated over. Stopping early kills
+        the command.
+
+    Raises:
+      error.SDKError: If the command cannot be run. Iterating raises it if the
+        command times out or writes something that isn't JSON.
+    """
+    return _json_stream.JsonItems(self.RunIter(
+        _GcloudCommand(command, _JsonFormat(format_keys), filters), timeout,
+        env, lines=False))
 
   def RunGcloudRawOutput(self, command, formats=None, filters=None,
                          timeout=None, env=None):
@@ -456,21 +1399,242 @@ class SDK(object):
     Raises:
       error.SDKError: If the command cannot be run.
     """
-    command = ['gcloud'] + _PrepareCommand(command)
+    out, err, ret = self.Run(
+        _GcloudCommand(command, formats, filters), timeout, env)
 
-    if formats:
-      command.append('--format={fmt}'.format(fmt=formats))
-    if filters:
-      command.append('--filter={flt}'.format(flt=filters))
+    return out, err, ret
 
-    out, err, ret = self.Run(command, timeout, env)
 
-    return out, err, ret
+def _RunManyResults(commands, deadline, fail_fast):
+  """Yields the results of commands started by RunMany as they finish."""
+  completed = _background.AsCompleted(commands, deadline)
+  try:
+    for index, command in completed:
+      out, err, code = command.Wait()
+      if fail_fast:
+        error.HandlePossibleError(
+            (out, err, code), error.SDKError,
+            'Command [{cmd}] failed'.format(cmd=' '.join(command.command)))
+      yield index, out, err, code
+  finally:
+    # Kills whatever is still running.
+    completed.close()
+
+
+def _JsonFormat(format_keys):
+  """Returns the gcloud --format for JSON output of format_keys (or all)."""
+  if format_keys:
+    return 'json({keys})'.format(keys=','.join(format_keys))
+  return 'json'
+
+
+def _GcloudCommand(command, formats, filters):
+  """Returns the full command line for a gcloud command."""
+  command = ['gcloud'] + _PrepareCommand(command)
+
+  if formats:
+    command.append('--format={fmt}'.format(fmt=formats))
+  if filters:
+    command.append('--filter={flt}'.format(flt=filters))
+  return command
+
+
+def _ParseJsonOutput(out, err, code):
+  """Parses the output of a gcloud command run with a JSON format.
+
+  Output spilled to disk is too big to parse all at once (see RunGcloudIter),
+  so it's returned as is.
+  """
+  if isinstance(out, _output.SpilledOutput):
+    return out, err, code
+  if out:
+    try:
+      return json.loads(out), err, code
+    except ValueError:
+      # TODO(magimaster): Log failure to decode JSON when logging is added
+      return out, err, code
+  else:
+    return None, err, code
+
+
+def WaitAny(commands, timeout=None):
+  """Waits for the first of several background commands to finish.
+
+  Args:
+    commands: [_background.BackgroundCommand], commands started with
+      SDK.RunInBackground (or RunGcloudInBackground).
+    timeout: number, seconds to wait. None waits forever.
+
+  Returns:
+    _background.BackgroundCommand, one of the commands that has finished.
+
+  Raises:
+    error.SDKError: If none of the commands finished in time.
+  """
+  return _background.WaitAny(commands, timeout)
+
+
+class _SDKCache(object):
+  """Initialized SDK configurations, keyed by ImmutableConfig.
+
+  Holds at most max_size entries, evicting the least recently used one.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+
+  def Get(self, key):
+    """Returns the entry for key (marking it as recently used), or None."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._entries[key] = entry
+      return entry
+
+  def Put(self, key, entry):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = entry
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def Invalidate(self, key=None):
+    """Forgets the entry for key, or every entry if key is None."""
+    with self._lock:
+      if key is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(key, None)
+
+
+_sdk_cache = None
+
+
+def EnableSDKCache(max_size=constants.SDK_CACHE_SIZE):
+  """Makes SDKFromConfig reuse configurations for equal configs.
+
+  Once enabled, creating an SDK from a config equal to one used before (see
+  ImmutableConfig) returns an SDK sharing the earlier SDK's gcloud
+  configuration instead of creating and initializing a new one. Only enable
+  this if tests don't change the configuration of their SDKs (e.g. by running
+  `gcloud config set`), as those changes would be seen by every SDK sharing it.
+
+  Args:
+    max_size: int, the most configurations to remember. Beyond that, the least
+      recently used ones are forgotten (but not deleted).
+  """
+  global _sdk_cache
+  if _sdk_cache is None:
+    _sdk_cache = _SDKCache(max_size)
+  else:
+    _sdk_cache.max_size = max_size
+
+
+def DisableSDKCache():
+  """Stops reusing configurations. Every SDK gets a new one again."""
+  global _sdk_cache
+  _sdk_cache = None
+
+
+def InvalidateSDKCache(config=None):
+  """Stops reusing the configuration for config (or for every config).
+
+  Init and Destroy invalidate the whole cache.
+
+  Args:
+    config: Config, the config whose configuration shouldn't be reused. If
+      None, no configuration is reused.
+  """
+  if _sdk_cache is not None:
+    _sdk_cache.Invalidate(
+        None if config is None else _config.ImmutableConfig(config))
+
+
+def EnableGcloudWorker(preload=None, fork=False):
+  """Runs gcloud commands in a long-lived Python process.
+
+  Starting gcloud normally costs a new Python interpreter and importing most
+  of the SDK. Once enabled, SDK.Run (and so RunGcloud) sends gcloud commands to
+  a worker process instead, one for each installation and SDK configuration,
+  which keeps the SDK imported between commands. Commands still run in a new
+  process when they have a timeout, while output spilling is enabled (see
+  EnableOutputSpilling), while the worker is busy with another command, for
+  command groups in constants.GCLOUD_WORKER_EXCLUDED_COMMANDS, and when they
+  crash the worker (which is then replaced).
+
+  With fork set, the worker instead forks a child to run each command, so
+  commands are as isolated from each other as they'd be in new processes (and
+  no command groups are excluded) while still starting with the SDK imported.
+  LastLaunchReport tells how much time that saved.
+
+  Args:
+    preload: [string], modules the worker imports before its first command.
+      Defaults to constants.GCLOUD_WORKER_PRELOAD.
+    fork: bool, whether to fork a child for each command.
+
+  Raises:
+    error.SDKError: if fork is set but this platform can't fork.
+  """
+  if fork and not hasattr(os, 'fork'):
+    raise error.SDKError('Forking is not available on this platform.')
+  _worker.Enable(
+      constants.GCLOUD_WORKER_PRELOAD if preload is None else preload, fork)
+
+
+def DisableGcloudWorker():
+  """Stops running gcloud commands in workers and stops the workers."""
+  _worker.Disable()
+
+
+def LastLaunchReport():
+  """Returns how the calling thread's last gcloud command was started.
+
+  See EnableGcloudWorker.
+
+  Returns:
+    {string: ...}, with mode ('worker' or 'fork'), cold_start_time (seconds
+      the worker took to start, which is about what starting gcloud in a new
+      process costs), launch_time (seconds the worker took to start the
+      command) and saved_time (cold_start_time - launch_time). None if the
+      command ran in a new process.
+  """
+  report = _worker.LastLaunch()
+  return dict(report) if report else None
+
+
+def EnableOutputSpilling(threshold=constants.OUTPUT_SPILL_THRESHOLD,
+                         directory=None):
+  """Keeps oversized command output in temporary files instead of memory.
+
+  Once enabled, SDK.Run (and the methods built on it, and commands run in the
+  background) write a command's stdout or stderr to a temporary file as soon as
+  it's bigger than threshold bytes, and return an _output.SpilledOutput for it
+  instead of a string. Its View method gives a memory map of the output that
+  can be sliced or searched with the re module, and Close deletes the file.
+  Files that aren't closed are deleted by Destroy. RunGcloud returns spilled
+  output unparsed.
+
+  Args:
+    threshold: int, the most bytes of a stream to keep in memory.
+    directory: string, where to create the files. Defaults to the system's
+      temporary folder.
+  """
+  _output.Enable(threshold, directory)
+
+
+def DisableOutputSpilling():
+  """Keeps all command output in memory again."""
+  _output.Disable()
 
 
 def SDKFromConfig(config):
   """Create an SDK from a config. This is the main factory for SDK objects.
 
+  If the SDK cache is enabled (see EnableSDKCache), an SDK created earlier from
+  an equal config shares its configuration with the new one.
+
   Args:
     config: Config, The Config object to use in creating the SDK.
 
@@ -479,18 +1643,86 @@ def SDKFromConfig(config):
 
   Raises:
     error.SDKError: If anything went wrong during creation of the SDK.
+    error.InitError: If a background Init (see InitAsync) failed.
   """
+  driver_location = _DriverLocation()
+
+  cache = _sdk_cache
+  if cache is not None:
+    key = _config.ImmutableConfig(config)
+    entry = cache.Get(key)
+    if entry is not None:
+      sdk_dir, config_name, environ = entry
+      return SDK(config, sdk_dir, config_name, dict(environ))
+
+  sdk = _NewSDK(config, driver_location)
+  if cache is not None:
+    # pylint: disable=protected-access
+    cache.Put(key, (sdk._sdk_dir, sdk._config_name, dict(sdk._env)))
+  return sdk
+
+
+def SDKsFromConfigs(configs, max_workers=None):
+  """Creates an SDK for each of several configs at once.
+
+  Equivalent to calling SDKFromConfig on each config, but the SDKs are created
+  (and gcloud is run to set them up) concurrently.
+
+  Args:
+    configs: [Config], the configs to create SDKs from.
+    max_workers: int, how many SDKs to create at once. Defaults to
+      constants.SDK_CREATION_WORKERS.
+
+  Returns:
+    [SDK], the configured SDK objects, in the same order as configs.
+
+  Raises:
+    error.SDKCreationError: If any of the SDKs couldn't be created. It holds
+      the errors for each of them, and the SDKs that were created.
+    error.SDKError: If the driver isn't initialized.
+    error.InitError: If a background Init (see InitAsync) failed.
+  """
+  configs = list(configs)
+  if not configs:
+    return []
+  # Fail once rather than once for every config.
+  _DriverLocation()
+  with _pool.ThreadPool(min(len(configs), max_workers or
+                            constants.SDK_CREATION_WORKERS)) as pool:
+    futures = pool.Map(SDKFromConfig, configs)
+
+  sdks = []
+  errors = {}
+  for i, future in enumerate(futures):
+    err = future.Exception()
+    if err:
+      errors[i] = err
+      sdks.append(None)
+    else:
+      sdks.append(future.Result())
+  if errors:
+    raise error.SDKCreationError(sdks, errors)
+  return sdks
+
+
+def _DriverLocation():
+  """Returns the root directory of the installed SDK, waiting for InitAsync."""
+  _WaitForPendingInit()
   driver_location = os.getenv(constants.DRIVER_LOCATION_ENV)
   if driver_location is None:
     raise error.SDKError('Unable to locate the SDK. Make sure Init was '
                          'called before creating SDK objects.')
+  return driver_location
+
 
+def _NewSDK(config, driver_location):
+  """Creates an SDK with a new configuration and initializes it."""
   # Generate a random name for this configuration.
-  config_name_length = 14
   rng = random.SystemRandom()
-  config_name = ''.join(['config'] + [
+  config_name = ''.join([constants.CONFIG_NAME_PREFIX] + [
       rng.choice(string.ascii_lowercase + string.digits)
-      for _ in range(config_name_length - len('config'))])
+      for _ in range(constants.CONFIG_NAME_LENGTH -
+                     len(constants.CONFIG_NAME_PREFIX))])
 
   # Prepare the environment variables.
   sdk_dir = os.path.join(driver_location, constants.SDK_FOLDER)
@@ -503,6 +1735,88 @@ def SDKFromConfig(config):
   return sdk
 
 
+class SDKPool(object):
+  """Keeps SDK objects created from one config ready for use.
+
+  Every SDK from the pool has a configuration of its own, as if it came from
+  SDKFromConfig. Taking one out of the pool starts creating a replacement on a
+  background thread, so tests that each need a fresh SDK don't have to wait for
+  gcloud to set one up. The SDK cache (see EnableSDKCache) isn't used.
+
+  Can be used as a context manager, in which case it's closed on exit. Close
+  pools before calling Destroy.
+  """
+
+  def __init__(self, config, size=constants.SDK_POOL_SIZE, max_workers=None):
+    """Starts creating size SDK objects in the background.
+
+    Args:
+      config: Config, the config to create every SDK from. Later changes to it
+        don't affect the pool.
+      size: int, how many SDK objects to keep ready.
+      max_workers: int, how many SDK objects to create at once. Defaults to
+        size.
+
+    Raises:
+      ValueError: If size is less than 1.
+    """
+    if size < 1:
+      raise ValueError('size must be at least 1.')
+    self._config = Config(**dict(config))
+    self._size = size
+    self._lock = threading.Lock()
+    self._closed = False
+    self._workers = _pool.ThreadPool(max_workers or size)
+    self._ready = collections.deque(
+        self._workers.Submit(self._Create) for _ in range(size))
+
+  def _Create(self):
+    return _NewSDK(self._config, _DriverLocation())
+
+  def Get(self, timeout=None):
+    """Takes an SDK out of the pool, waiting for one if none are ready yet.
+
+    Args:
+      timeout: number, seconds to wait. None waits forever.
+
+    Returns:
+      SDK, an SDK that nothing else is using.
+
+    Raises:
+      error.SDKError: If the pool is closed, no SDK was ready in time or
+        creating the SDK failed.
+      error.InitError: If a background Init (see InitAsync) failed.
+    """
+    with self._lock:
+      if self._closed:
+        raise error.SDKError('The SDK pool is closed.')
+      future = self._ready.popleft()
+      # There's one too many if an earlier Get timed out.
+      if len(self._ready) < self._size:
+        self._ready.append(self._workers.Submit(self._Create))
+    try:
+      return future.Result(timeout)
+    except _pool.TimeoutError:
+      # Keep the SDK for the next Get rather than leaking its configuration.
+      with self._lock:
+        self._ready.appendleft(future)
+      raise error.SDKError(
+          'No SDK was ready within {0} seconds.'.format(timeout))
+
+  def Close(self):
+    """Stops creating SDK objects. SDKs already handed out still work."""
+    with self._lock:
+      self._closed = True
+    self._workers.Shutdown(wait=False, cancel_pending=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Close()
+    return False
+
+
 def DefaultSDK():
   return SDKFromConfig(Config())
 
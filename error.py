@@ -18,6 +18,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import types
+
 from cloudsdk_test_driver import constants
 
 
@@ -40,6 +42,26 @@ class SDKError(DriverError):
   pass
 
 
+class SDKCreationError(SDKError):
+  """Raised when some of several SDK objects couldn't be created.
+
+  Attributes:
+    sdks: [SDK], the SDK objects that were created, in the order of their
+      configs, with None for those that failed.
+    errors: {int: Exception}, what each failed creation raised, keyed by the
+      index of its config.
+  """
+
+  def __init__(self, sdks, errors):
+    super(SDKCreationError, self).__init__(
+        '{n} of {total} SDKs could not be created:\n{errors}'.format(
+            n=len(errors), total=len(sdks), errors='\n'.join(
+                '[{i}]: {err}'.format(i=i, err=err)
+                for i, err in sorted(errors.items()))))
+    self.sdks = sdks
+    self.errors = errors
+
+
 def RaiseInvalidKey(key):
   raise ConfigError(
       '[{key}] is not a valid config key.'.format(key=key))
@@ -67,11 +89,39 @@ def ValidateLockedEnvironmentVariables(dictionary):
             'Environment variable [{var}] cannot be set.'.format(var=var))
 
 
+def _Excerpt(output):
+  """Returns the part of a command's stdout or stderr to put in an error.
+
+  Long output is cut down to its start and end, and output spilled to disk
+  (see driver.EnableOutputSpilling) also gives the file holding all of it.
+  Anything else (e.g. parsed JSON) is returned as is.
+  """
+  spilled = hasattr(output, 'path')
+  if not spilled and not isinstance(output, types.StringTypes):
+    return output
+  head_size = constants.ERROR_OUTPUT_HEAD
+  tail_size = constants.ERROR_OUTPUT_TAIL
+  if len(output) <= head_size + tail_size:
+    text = output.Read() if spilled else output
+  else:
+    if spilled:
+      head, tail = output.Head(head_size), output.Tail(tail_size)
+    else:
+      head, tail = output[:head_size], output[len(output) - tail_size:]
+    text = '{head}\n... [{n} bytes omitted] ...\n{tail}'.format(
+        head=head, tail=tail, n=len(output) - head_size - tail_size)
+  if spilled:
+    text = '{text}\n[all {n} bytes are in {path}]'.format(
+        text=text, n=len(output), path=output.path)
+  return text
+
+
 def HandlePossibleError(result_tuple, error_type, msg):
   """Takes the output of Run and raises a formatted exception if needed.
 
   Unpacks the results of a Run command and raises a formatted error if the
-  return code wasn't 0.
+  return code wasn't 0. Only the start and end of long output is included (see
+  constants.ERROR_OUTPUT_HEAD and ERROR_OUTPUT_TAIL).
 
   Args:
     result_tuple: (string, string, int), the tuple generated by a Run command.
@@ -81,5 +131,6 @@ def HandlePossibleError(result_tuple, error_type, msg):
   out, err, code = result_tuple
   if code != 0:
     msg = ('{msg}\nReturn code: {code}\nstdout <<<{out}>>>\n'
-           'stderr <<<{err}>>>'.format(msg=msg, code=code, out=out, err=err))
+           'stderr <<<{err}>>>'.format(msg=msg, code=code, out=_Excerpt(out),
+                                       err=_Excerpt(err)))
     raise error_type(msg)
@@ -17,22 +17,45 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import BaseHTTPServer
+import ConfigParser
 import copy
+import distutils.spawn
+import gc
+import hashlib
 import json
 import os
 import random
 import re
 import shutil
+import socket
+import SocketServer
 import StringIO
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
+import traceback
 import unittest
 import urllib2
 
+from cloudsdk_test_driver import _background
 from cloudsdk_test_driver import _config
+from cloudsdk_test_driver import _decompress
+from cloudsdk_test_driver import _digest
+from cloudsdk_test_driver import _extract
+from cloudsdk_test_driver import _http
+from cloudsdk_test_driver import _install_cache
+from cloudsdk_test_driver import _json_stream
+from cloudsdk_test_driver import _lock
+from cloudsdk_test_driver import _output
+from cloudsdk_test_driver import _pool
+from cloudsdk_test_driver import _properties
 from cloudsdk_test_driver import _sdk_tar
+from cloudsdk_test_driver import _snapshot
+from cloudsdk_test_driver import _worker
 from cloudsdk_test_driver import constants
 from cloudsdk_test_driver import driver
 from cloudsdk_test_driver import error
@@ -132,6 +155,31 @@ class Base(unittest.TestCase):
         '[{command}] not called:\n{calls}'.format(
             command=command, calls='\n'.join([str(c) for c in calls])))
 
+  def MakeTempDir(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    return directory
+
+  def StartRangeServer(self, payload, name='bar.tar'):
+    """Serves payload over HTTP on localhost and returns its URL."""
+    self.server = _RangeServer(('127.0.0.1', 0), _RangeRequestHandler)
+    self.server.payload = payload
+    self.server.ranges = []
+    self.server.supports_ranges = True
+    self.server.truncate_responses = 0
+    self.server.sidecar = None
+    self.server.etag = None
+    self.server.change_after = None
+    self.server.connections = 0
+    thread = threading.Thread(
+        target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    return 'http://127.0.0.1:{port}/{name}'.format(
+        port=self.server.server_address[1], name=name)
+
   def GetSDK(self):
     """Create an SDK with some default values."""
     self.config = driver.Config()
@@ -286,6 +334,8 @@ class GcloudTestDriverSDKConfigTest(Base):
     self.assertEqual(
         os.path.join(self.expected_sdk_dir, self.expected_config_name),
         kwargs['env']['CLOUDSDK_CONFIG'])
+    # Commands run from thread pools mustn't inherit each other's pipes.
+    self.assertTrue(kwargs['close_fds'])
 
   def testSDKServiceAccount(self):
     sdk = driver.SDKFromDict(
@@ -300,14 +350,53 @@ class GcloudTestDriverSDKConfigTest(Base):
         return
     self.RaiseCommandNotCalled('gcloud auth activate-service-account', calls)
 
+  def ReadProperties(self, sdk):
+    config_directory = sdk._env[constants.CONFIG_ENV]
+    with open(os.path.join(config_directory, 'active_config')) as fp:
+      self.assertEqual('default', fp.read())
+    parser = ConfigParser.RawConfigParser()
+    parser.read(os.path.join(
+        config_directory, 'configurations', 'config_default'))
+    return dict(('{0}/{1}'.format(section, name), value)
+                for section in parser.sections()
+                for name, value in parser.items(section))
+
   def testSetProject(self):
+    os.environ[constants.DRIVER_LOCATION_ENV] = self.MakeTempDir()
     sdk = driver.SDKFromArgs(project='foo')
     self.assertEqual('foo', sdk.config.project)
-    calls = self.popen_patch.mock_calls
-    for _, args, _ in calls:
-      if args[0] == ['gcloud', 'config', 'set', 'project', 'foo']:
-        return
-    self.RaiseCommandNotCalled('gcloud config set project', calls)
+    # The project is written straight into the configuration.
+    self.assertEqual(0, len(self.popen_patch.mock_calls))
+    self.assertEqual({'core/project': 'foo'}, self.ReadProperties(sdk))
+
+  def testSetPropertiesDirectly(self):
+    os.environ[constants.DRIVER_LOCATION_ENV] = self.MakeTempDir()
+    sdk = driver.SDKFromArgs(project='foo', properties={
+        'core/project': 'bar',
+        'compute/zone': 'us-central1-a',
+        'disable_prompts': 'True',
+        'foo': 'bar',
+        'core/log_http': 'maybe',
+    })
+    self.assertEqual({
+        'core/project': 'bar',
+        'compute/zone': 'us-central1-a',
+        'core/disable_prompts': 'true',
+    }, self.ReadProperties(sdk))
+    # Properties that need checking are still set with gcloud.
+    self.assertEqual(
+        sorted([['gcloud', 'config', 'set', 'foo', 'bar'],
+                ['gcloud', 'config', 'set', 'core/log_http', 'maybe']]),
+        sorted(args[0] for _, args, _ in self.popen_patch.mock_calls))
+
+  def testSetPropertiesInNamedConfiguration(self):
+    os.environ[constants.DRIVER_LOCATION_ENV] = self.MakeTempDir()
+    sdk = driver.SDKFromArgs(project='foo', environment_variables={
+        constants.ACTIVE_CONFIG_ENV: 'other'})
+    parser = ConfigParser.RawConfigParser()
+    parser.read(os.path.join(sdk._env[constants.CONFIG_ENV], 'configurations',
+                             'config_other'))
+    self.assertEqual('foo', parser.get('core', 'project'))
 
   def testSetProperties(self):
     sdk = driver.SDKFromArgs(properties={'foo': 'bar'})
@@ -319,6 +408,105 @@ class GcloudTestDriverSDKConfigTest(Base):
     self.RaiseCommandNotCalled('gcloud config set', calls)
 
 
+class GcloudTestDriverCredentialsTest(Base):
+
+  def setUp(self):
+    self.MockSDKFactoryDependencies()
+    self.StartObjectPatch(random.SystemRandom, 'choice', side_effect=(
+        lambda unused_self, chars: random.choice(chars)))
+    self.root_directory = self.MakeTempDir()
+    os.environ[constants.DRIVER_LOCATION_ENV] = self.root_directory
+    self.keyfile = os.path.join(self.root_directory, 'key.json')
+    self.WriteKey('key')
+    self.activations = []
+    self.run_patch = self.StartObjectPatch(
+        driver.SDK, 'RunGcloudRawOutput', side_effect=self.Activate)
+
+  def WriteKey(self, contents):
+    with open(self.keyfile, 'w') as fp:
+      fp.write(contents)
+
+  def Activate(self, unused_sdk, command, env=None):
+    config_directory = env[constants.CONFIG_ENV]
+    self.activations.append(command)
+    with open(os.path.join(config_directory, 'credentials.db'), 'w') as fp:
+      fp.write(' '.join(command))
+    return '', '', 0
+
+  def ReadCredentials(self, sdk):
+    with open(os.path.join(
+        sdk._env[constants.CONFIG_ENV], 'credentials.db')) as fp:
+      return fp.read()
+
+  def testActivatedOnce(self):
+    sdks = [driver.SDKFromArgs(service_account_email='foo',
+                               service_account_keyfile=self.keyfile,
+                               project=str(i)) for i in range(3)]
+    self.assertEqual([['auth', 'activate-service-account', 'foo',
+                       '--key-file', self.keyfile]], self.activations)
+    for sdk in sdks:
+      self.assertEqual(
+          'auth activate-service-account foo --key-file ' + self.keyfile,
+          self.ReadCredentials(sdk))
+
+  def testDistinctServiceAccounts(self):
+    driver.SDKFromArgs(service_account_email='foo',
+                       service_account_keyfile=self.keyfile)
+    driver.SDKFromArgs(service_account_email='bar',
+                       service_account_keyfile=self.keyfile)
+    self.WriteKey('new key')
+    driver.SDKFromArgs(service_account_email='bar',
+                       service_account_keyfile=self.keyfile)
+    self.assertEqual(3, len(self.activations))
+
+  def testFailedActivationRetried(self):
+    self.run_patch.side_effect = [('', 'denied', 1)]
+    with self.assertRaisesRegexp(error.SDKError, 'denied'):
+      driver.SDKFromArgs(service_account_keyfile=self.keyfile)
+    self.run_patch.side_effect = self.Activate
+    sdk = driver.SDKFromArgs(service_account_keyfile=self.keyfile)
+    self.assertEqual(
+        'auth activate-service-account --key-file ' + self.keyfile,
+        self.ReadCredentials(sdk))
+
+  def testMissingKeyFile(self):
+    self.run_patch.side_effect = [('', 'no such key', 1)]
+    with self.assertRaisesRegexp(error.SDKError, 'no such key'):
+      driver.SDKFromArgs(service_account_keyfile=self.keyfile + '.missing')
+
+
+class GcloudTestDriverPropertiesTest(Base):
+
+  def testSplit(self):
+    direct, remaining = _properties.Split([
+        ('project', 'foo'), ('account', 'me'), ('core/account', 1),
+        ('account', 'you'), ('compute/zone', ''), ('core/log_http', False)])
+    self.assertEqual(
+        {'core/project': 'foo', 'core/log_http': 'false'}, direct)
+    # Once gcloud has to set a property, later values go through gcloud too.
+    self.assertEqual(
+        [('core/account', 1), ('account', 'you'), ('compute/zone', '')],
+        remaining)
+
+  def testWriteKeepsExistingProperties(self):
+    config_directory = self.MakeTempDir()
+    _properties.Write(config_directory, {'core/account': 'me'})
+    _properties.Write(config_directory, {'core/project': 'foo'})
+    with open(os.path.join(config_directory, 'configurations',
+                           'config_default')) as fp:
+      self.assertEqual(
+          '[core]\naccount = me\nproject = foo\n\n', fp.read())
+
+  def testWriteNamedConfiguration(self):
+    config_directory = self.MakeTempDir()
+    _properties.Write(config_directory, {'core/project': 'foo'}, 'other')
+    with open(os.path.join(config_directory, 'configurations',
+                           'config_other')) as fp:
+      self.assertEqual('[core]\nproject = foo\n\n', fp.read())
+    self.assertFalse(
+        os.path.exists(os.path.join(config_directory, 'active_config')))
+
+
 class GcloudTestDriverSDKErrorTest(unittest.TestCase):
 
   def testNoInit(self):
@@ -326,6 +514,166 @@ class GcloudTestDriverSDKErrorTest(unittest.TestCase):
       driver.DefaultSDK()
 
 
+class GcloudTestDriverSDKCacheTest(Base):
+
+  def setUp(self):
+    self.MockSDKFactoryDependencies()
+    self.StartObjectPatch(random.SystemRandom, 'choice', side_effect=(
+        lambda unused_self, chars: random.choice(chars)))
+    self.init_patch = self.StartObjectPatch(
+        driver.SDK, 'RunInitializationCommands')
+    self.StartObjectPatch(driver, '_sdk_cache', new=None)
+
+  def testDisabledByDefault(self):
+    sdk1 = driver.SDKFromArgs(project='foo')
+    sdk2 = driver.SDKFromArgs(project='foo')
+    self.assertNotEqual(sdk1._config_name, sdk2._config_name)
+    self.assertEqual(2, self.init_patch.call_count)
+
+  def testReuse(self):
+    driver.EnableSDKCache()
+    sdk1 = driver.SDKFromDict({'project': 'foo'})
+    sdk2 = driver.SDKFromDict({'project': 'foo'})
+    sdk3 = driver.SDKFromDict({'project': 'bar'})
+    self.assertEqual(sdk1._config_name, sdk2._config_name)
+    self.assertEqual(sdk1.config, sdk2.config)
+    self.assertNotEqual(sdk1._config_name, sdk3._config_name)
+    self.assertEqual(2, self.init_patch.call_count)
+
+  def testLeastRecentlyUsedEvicted(self):
+    driver.EnableSDKCache(max_size=2)
+    foo = driver.SDKFromArgs(project='foo')
+    bar = driver.SDKFromArgs(project='bar')
+    driver.SDKFromArgs(project='foo')
+    driver.SDKFromArgs(project='baz')
+    self.assertEqual(
+        foo._config_name, driver.SDKFromArgs(project='foo')._config_name)
+    self.assertNotEqual(
+        bar._config_name, driver.SDKFromArgs(project='bar')._config_name)
+    self.assertEqual(4, self.init_patch.call_count)
+
+  def testInvalidate(self):
+    driver.EnableSDKCache()
+    foo = driver.SDKFromArgs(project='foo')
+    bar = driver.SDKFromArgs(project='bar')
+    driver.InvalidateSDKCache(driver.Config(project='foo'))
+    self.assertNotEqual(
+        foo._config_name, driver.SDKFromArgs(project='foo')._config_name)
+    self.assertEqual(
+        bar._config_name, driver.SDKFromArgs(project='bar')._config_name)
+    driver.Destroy()
+    os.environ[constants.DRIVER_LOCATION_ENV] = 'driver_location'
+    self.assertNotEqual(
+        bar._config_name, driver.SDKFromArgs(project='bar')._config_name)
+
+
+class GcloudTestDriverSDKPoolTest(Base):
+
+  def setUp(self):
+    self.MockSDKFactoryDependencies()
+    self.StartObjectPatch(random.SystemRandom, 'choice', side_effect=(
+        lambda unused_self, chars: random.choice(chars)))
+    self.init_patch = self.StartObjectPatch(
+        driver.SDK, 'RunInitializationCommands')
+    self.StartObjectPatch(driver, '_sdk_cache', new=None)
+
+  def WaitForCalls(self, count):
+    for _ in range(200):
+      if self.init_patch.call_count >= count:
+        return
+      time.sleep(0.01)
+    self.fail('Only {0} SDKs were initialized'.format(
+        self.init_patch.call_count))
+
+  def testGet(self):
+    config = driver.Config(project='foo')
+    with driver.SDKPool(config, size=2) as pool:
+      config.project = 'bar'
+      self.WaitForCalls(2)
+      sdks = [pool.Get(timeout=10) for _ in range(3)]
+      # Every SDK taken out is replaced.
+      self.WaitForCalls(5)
+    self.assertEqual(['foo'] * 3, [sdk.config.project for sdk in sdks])
+    self.assertEqual(3, len(set(sdk._config_name for sdk in sdks)))
+
+  def testGetFailure(self):
+    self.init_patch.side_effect = [error.SDKError('init failed'), None]
+    with driver.SDKPool(driver.Config(), size=1) as pool:
+      with self.assertRaisesRegexp(error.SDKError, 'init failed'):
+        pool.Get(timeout=10)
+      self.assertTrue(pool.Get(timeout=10))
+
+  def testGetTimeout(self):
+    created = threading.Event()
+    self.init_patch.side_effect = lambda unused_sdk: created.wait()
+    with driver.SDKPool(driver.Config(), size=1) as pool:
+      with self.assertRaisesRegexp(error.SDKError, 'ready'):
+        pool.Get(timeout=0.01)
+      created.set()
+      # The next Get takes the SDK that was being created.
+      sdk = pool.Get(timeout=10)
+      self.WaitForCalls(2)
+    self.assertIs(sdk, self.init_patch.call_args_list[0][0][0])
+    self.assertEqual(2, self.init_patch.call_count)
+
+  def testClosed(self):
+    pool = driver.SDKPool(driver.Config(), size=1)
+    pool.Close()
+    with self.assertRaises(error.SDKError):
+      pool.Get()
+
+  def testNotInitialized(self):
+    del os.environ[constants.DRIVER_LOCATION_ENV]
+    with driver.SDKPool(driver.Config(), size=1) as pool:
+      with self.assertRaisesRegexp(error.SDKError, 'Init'):
+        pool.Get(timeout=10)
+
+
+class GcloudTestDriverSDKsFromConfigsTest(Base):
+
+  def setUp(self):
+    self.MockSDKFactoryDependencies()
+    self.StartObjectPatch(random.SystemRandom, 'choice', side_effect=(
+        lambda unused_self, chars: random.choice(chars)))
+    self.StartObjectPatch(driver, '_sdk_cache', new=None)
+
+  def testInOrder(self):
+    def Initialize(sdk):
+      # Finish out of order.
+      time.sleep(0.01 * (5 - int(sdk.config.project)))
+    self.StartObjectPatch(driver.SDK, 'RunInitializationCommands',
+                          side_effect=Initialize)
+    sdks = driver.SDKsFromConfigs(
+        [driver.Config(project=str(i)) for i in range(5)], max_workers=5)
+    self.assertEqual([str(i) for i in range(5)],
+                     [sdk.config.project for sdk in sdks])
+    self.assertEqual(5, len(set(sdk._config_name for sdk in sdks)))
+
+  def testEmpty(self):
+    self.assertEqual([], driver.SDKsFromConfigs([]))
+
+  def testFailures(self):
+    def Initialize(sdk):
+      if sdk.config.project != '1':
+        raise error.SDKError('failed ' + sdk.config.project)
+    self.StartObjectPatch(driver.SDK, 'RunInitializationCommands',
+                          side_effect=Initialize)
+    with self.assertRaises(error.SDKCreationError) as context:
+      driver.SDKsFromConfigs(
+          [driver.Config(project=str(i)) for i in range(3)])
+    err = context.exception
+    self.assertEqual([0, 2], sorted(err.errors))
+    self.assertIn('failed 2', str(err))
+    self.assertEqual([None, '1', None],
+                     [sdk and sdk.config.project for sdk in err.sdks])
+
+  def testNotInitialized(self):
+    del os.environ[constants.DRIVER_LOCATION_ENV]
+    with self.assertRaises(error.SDKError) as context:
+      driver.SDKsFromConfigs([driver.Config()] * 3)
+    self.assertNotIsInstance(context.exception, error.SDKCreationError)
+
+
 class GcloudTestDriverSDKConstructionTest(Base):
 
   def setUp(self):
@@ -489,6 +837,453 @@ class GcloudTestDriverSDKMethodsTest(Base):
     self.mock_popen.communicate.assert_called_once_with()
 
 
+class BackgroundBase(Base):
+  """Sets up an SDK whose gcloud prints its arguments as JSON."""
+
+  def setUp(self):
+    driver_location = self.MakeTempDir()
+    sdk_dir = os.path.join(driver_location, constants.SDK_FOLDER)
+    self.bin_dir = os.path.join(sdk_dir, constants.BIN_FOLDER)
+    os.makedirs(self.bin_dir)
+    # A stand-in for gcloud that prints its arguments as JSON.
+    gcloud = os.path.join(self.bin_dir, 'gcloud')
+    with open(gcloud, 'w') as fp:
+      fp.write('#!/bin/sh\nprintf \'["%s"]\' "$*"\n')
+    os.chmod(gcloud, 0o755)
+    self.sdk = driver.SDK(
+        driver.Config(), sdk_dir, 'configxxxxxxxx',
+        _config.PrepareEnviron({}, 'configxxxxxxxx', sdk_dir))
+
+
+class GcloudTestDriverRunInBackgroundTest(BackgroundBase):
+
+  def testRun(self):
+    command = self.sdk.RunInBackground(
+        ['sh', '-c', 'echo out; echo err >&2; exit 3'])
+    self.assertEqual(('out\n', 'err\n', 3), command.Wait(10))
+    self.assertEqual(('out\n', 'err\n', 3), command.Poll())
+
+  def testRunGcloud(self):
+    command = self.sdk.RunGcloudInBackground(
+        ['foo', 'list'], format_keys=['name'], filters='name:bar')
+    self.assertEqual(
+        (['foo list --format=json(name) --filter=name:bar'], '', 0),
+        command.Wait(10))
+
+  def testManyCommands(self):
+    commands = [self.sdk.RunInBackground(['sh', '-c', 'echo {0}'.format(i)])
+                for i in range(50)]
+    self.assertEqual(['{0}\n'.format(i) for i in range(50)],
+                     [command.Wait(10)[0] for command in commands])
+
+  def testTimeoutKills(self):
+    command = self.sdk.RunInBackground(['sleep', '30'], timeout=0.1)
+    with self.assertRaisesRegexp(error.SDKError, 'timed out'):
+      command.Wait(10)
+
+  def testWaitTimeout(self):
+    command = self.sdk.RunInBackground(['sleep', '30'])
+    self.assertIsNone(command.Poll())
+    with self.assertRaisesRegexp(error.SDKError, 'did not finish'):
+      command.Wait(0.05)
+    command.Cancel()
+    with self.assertRaisesRegexp(error.SDKError, 'cancelled'):
+      command.Wait(10)
+
+  def testNotFound(self):
+    command = self.sdk.RunInBackground(['no-such-command-for-the-driver'])
+    with self.assertRaisesRegexp(error.SDKError, 'could not be run'):
+      command.Wait(10)
+
+  def testSemaphore(self):
+    semaphore = threading.Semaphore(1)
+    first = self.sdk.RunInBackground(['sleep', '30'], semaphore=semaphore)
+    second = self.sdk.RunInBackground(['true'], semaphore=semaphore)
+    with self.assertRaises(error.SDKError):
+      second.Wait(0.2)
+    first.Cancel()
+    self.assertEqual(0, second.Wait(10)[2])
+
+  def testReactorFailureKills(self):
+    semaphore = threading.Semaphore(1)
+    command = self.sdk.RunInBackground(['sleep', '30'], semaphore=semaphore)
+    for _ in range(200):
+      if command._process:
+        break
+      time.sleep(0.01)
+    process = command._process
+    wait_for_input = _background._WaitForInput
+    failures = [ValueError('broken')]
+
+    def WaitForInput(fds, timeout):
+      if failures:
+        raise failures.pop()
+      return wait_for_input(fds, timeout)
+    self.StartObjectPatch(_background, '_WaitForInput',
+                          side_effect=WaitForInput)
+    _background._Reactor.Get().Wake()
+    with self.assertRaisesRegexp(error.SDKError, 'abandoned: broken'):
+      command.Wait(10)
+    self.assertIsNotNone(process.returncode)
+    self.assertTrue(process.stdout.closed)
+    self.assertTrue(process.stderr.closed)
+    self.assertTrue(semaphore.acquire(False))
+
+  def testWaitAny(self):
+    slow = self.sdk.RunInBackground(['sleep', '30'])
+    fast = self.sdk.RunInBackground(['true'])
+    self.assertIs(fast, driver.WaitAny([slow, fast], timeout=10))
+    with self.assertRaises(error.SDKError):
+      driver.WaitAny([slow], timeout=0.05)
+    slow.Cancel()
+
+
+class GcloudTestDriverGcloudWorkerTest(Base):
+
+  def setUp(self):
+    driver_location = self.MakeTempDir()
+    sdk_dir = os.path.join(driver_location, constants.SDK_FOLDER)
+    for folder in (constants.BIN_FOLDER, 'lib'):
+      os.makedirs(os.path.join(sdk_dir, folder))
+    gcloud = os.path.join(sdk_dir, constants.BIN_FOLDER, 'gcloud')
+    with open(gcloud, 'w') as fp:
+      fp.write('#!/bin/sh\necho subprocess "$@"\n')
+    os.chmod(gcloud, 0o755)
+    # A stand-in for the gcloud entry point the worker runs.
+    with open(os.path.join(sdk_dir, 'lib', 'gcloud.py'), 'w') as fp:
+      fp.write('import os, sys\n'
+               'if sys.argv[1:] == ["crash"]:\n'
+               '  raise RuntimeError("crashed")\n'
+               'sys.stdout.write("%d %s %s" % (os.getpid(),\n'
+               '                               " ".join(sys.argv[1:]),\n'
+               '                               os.environ.get("FOO", "")))\n'
+               'sys.stderr.write("err")\n'
+               'sys.exit(int(os.environ.get("CODE", "0")))\n')
+    self.sdk = driver.SDK(
+        driver.Config(), sdk_dir, 'configxxxxxxxx',
+        _config.PrepareEnviron({}, 'configxxxxxxxx', sdk_dir))
+    driver.EnableGcloudWorker(preload=[])
+    self.addCleanup(driver.DisableGcloudWorker)
+
+  def Pid(self, result):
+    return result[0].split()[0]
+
+  def testRunsInWorker(self):
+    first = self.sdk.RunGcloudRawOutput(['foo', 'list'])
+    second = self.sdk.RunGcloudRawOutput(['foo', 'describe'])
+    self.assertEqual('foo list ', first[0].split(' ', 1)[1])
+    self.assertEqual(('err', 0), first[1:])
+    self.assertEqual(self.Pid(first), self.Pid(second))
+    self.assertNotEqual(str(os.getpid()), self.Pid(first))
+
+  def testEnvironmentAndReturnCode(self):
+    out, err, code = self.sdk.Run(['gcloud', 'foo'],
+                                  env={'FOO': 'bar', 'CODE': '3'})
+    self.assertTrue(out.endswith(' foo bar'))
+    self.assertEqual(('err', 3), (err, code))
+
+  def testWorkerPerConfig(self):
+    sdk_dir = self.sdk._sdk_dir
+    other = driver.SDK(
+        driver.Config(), sdk_dir, 'configyyyyyyyy',
+        _config.PrepareEnviron({}, 'configyyyyyyyy', sdk_dir))
+    first = self.sdk.RunGcloudRawOutput(['foo'])
+    second = other.RunGcloudRawOutput(['foo'])
+    self.assertNotEqual(self.Pid(first), self.Pid(second))
+    self.assertEqual(self.Pid(first),
+                     self.Pid(self.sdk.RunGcloudRawOutput(['foo'])))
+
+  def testExcludedCommands(self):
+    self.assertEqual(
+        ('subprocess config set a b\n', '', 0),
+        self.sdk.RunGcloudRawOutput(['config', 'set', 'a', 'b']))
+    self.assertEqual(
+        ('subprocess --quiet beta auth list\n', '', 0),
+        self.sdk.RunGcloudRawOutput(['--quiet', 'beta', 'auth', 'list']))
+    self.assertEqual(
+        ('subprocess --project foo auth login\n', '', 0),
+        self.sdk.RunGcloudRawOutput(['--project', 'foo', 'auth', 'login']))
+    self.assertEqual(
+        ('subprocess --project=foo auth login\n', '', 0),
+        self.sdk.RunGcloudRawOutput(['--project=foo', 'auth', 'login']))
+    out, _, _ = self.sdk.RunGcloudRawOutput(['--project=foo', 'foo', 'list'])
+    self.assertEqual('--project=foo foo list ', out.split(' ', 1)[1])
+
+  def testCrashFallsBack(self):
+    first = self.sdk.RunGcloudRawOutput(['foo'])
+    self.assertEqual(('subprocess crash\n', '', 0),
+                     self.sdk.RunGcloudRawOutput(['crash']))
+    self.assertNotEqual(self.Pid(first),
+                        self.Pid(self.sdk.RunGcloudRawOutput(['foo'])))
+
+  def testWorkerDoesNotStart(self):
+    self.assertEqual(
+        ('subprocess foo\n', '', 0),
+        self.sdk.RunGcloudRawOutput(
+            ['foo'], env={constants.PYTHON_ENV: 'false'}))
+
+  def testLaunchReport(self):
+    self.sdk.RunGcloudRawOutput(['foo'])
+    report = driver.LastLaunchReport()
+    self.assertEqual('worker', report['mode'])
+    self.assertAlmostEqual(report['cold_start_time'] - report['launch_time'],
+                           report['saved_time'])
+    self.sdk.RunGcloudRawOutput(['config', 'list'])
+    self.assertIsNone(driver.LastLaunchReport())
+
+  def testFork(self):
+    driver.EnableGcloudWorker(preload=[], fork=True)
+    first = self.sdk.RunGcloudRawOutput(['foo'])
+    second = self.sdk.RunGcloudRawOutput(['config', 'list'],
+                                         env={'CODE': '4'})
+    self.assertNotEqual(self.Pid(first), self.Pid(second))
+    self.assertEqual(('config list ', 'err', 4),
+                     (second[0].split(' ', 1)[1],) + second[1:])
+    self.assertEqual('fork', driver.LastLaunchReport()['mode'])
+
+  def testForkCrash(self):
+    driver.EnableGcloudWorker(preload=[], fork=True)
+    out, err, code = self.sdk.RunGcloudRawOutput(['crash'])
+    self.assertEqual(('', 1), (out, code))
+    self.assertIn('RuntimeError: crashed', err)
+    self.assertEqual(0, self.sdk.RunGcloudRawOutput(['foo'])[2])
+
+  def testDisabled(self):
+    driver.DisableGcloudWorker()
+    self.assertEqual(('subprocess foo\n', '', 0),
+                     self.sdk.RunGcloudRawOutput(['foo']))
+
+
+class GcloudTestDriverStreamingTest(BackgroundBase):
+
+  def testRunIter(self):
+    streaming = self.sdk.RunIter(
+        ['sh', '-c', 'echo a; echo b; echo c >&2; printf d; exit 2'])
+    output = list(streaming)
+    self.assertEqual(['a\n', 'b\n', 'd'],
+                     [data for name, data in output if name == 'stdout'])
+    self.assertEqual([('stderr', 'c\n')],
+                     [item for item in output if item[0] == 'stderr'])
+    self.assertEqual(2, streaming.returncode)
+
+  def testChunks(self):
+    streaming = self.sdk.RunIter(['sh', '-c', 'echo a; echo b'], lines=False)
+    self.assertEqual('a\nb\n', ''.join(data for _, data in streaming))
+
+  def testLongLines(self):
+    self.StartObjectPatch(_background, '_MAX_LINE', new=10)
+    streaming = self.sdk.RunIter(
+        ['sh', '-c', 'printf 0123456789abcdef; sleep 0.2; printf gh'])
+    self.assertEqual(['0123456789abcdef', 'gh'],
+                     [data for _, data in streaming])
+
+  def testArrivesEarly(self):
+    streaming = iter(self.sdk.RunIter(['sh', '-c', 'echo ready; sleep 30']))
+    start = time.time()
+    self.assertEqual(('stdout', 'ready\n'), next(streaming))
+    streaming.close()
+    self.assertLess(time.time() - start, 10)
+
+  def testRunStreaming(self):
+    out = []
+    err = []
+    self.assertEqual(0, self.sdk.RunStreaming(
+        ['sh', '-c', 'echo a; echo b >&2; echo c'], on_stdout=out.append,
+        on_stderr=err.append))
+    self.assertEqual((['a\n', 'c\n'], ['b\n']), (out, err))
+
+  def testCallbackStops(self):
+    def Stop(unused_line):
+      raise ValueError('enough')
+    start = time.time()
+    with self.assertRaisesRegexp(ValueError, 'enough'):
+      self.sdk.RunStreaming(['sh', '-c', 'echo a; sleep 30'], on_stdout=Stop)
+    self.assertLess(time.time() - start, 10)
+
+  def testTimeout(self):
+    with self.assertRaisesRegexp(error.SDKError, 'timed out after 0.2'):
+      self.sdk.RunStreaming(['sleep', '30'], timeout=0.2)
+
+  def testNotFound(self):
+    with self.assertRaisesRegexp(error.SDKError, 'could not be run'):
+      self.sdk.RunIter(['no-such-command-here'])
+
+  def testRunGcloudIter(self):
+    items = self.sdk.RunGcloudIter(
+        ['foo', 'list'], format_keys=['name'], filters='name:bar')
+    self.assertEqual(['foo list --format=json(name) --filter=name:bar'],
+                     list(items))
+    self.assertEqual(('', 0), (items.stderr, items.returncode))
+
+  def testRunGcloudIterStops(self):
+    with open(os.path.join(self.bin_dir, 'gcloud'), 'w') as fp:
+      fp.write('#!/bin/sh\nprintf \'[{"a": 1},\'\nsleep 30\n')
+    start = time.time()
+    items = iter(self.sdk.RunGcloudIter(['foo', 'list']))
+    self.assertEqual({'a': 1}, next(items))
+    items.close()
+    self.assertLess(time.time() - start, 10)
+
+  def testRunGcloudIterInvalid(self):
+    with open(os.path.join(self.bin_dir, 'gcloud'), 'w') as fp:
+      fp.write('#!/bin/sh\necho \'[1, oops]\'\n')
+    with self.assertRaisesRegexp(error.SDKError, 'not valid JSON'):
+      list(self.sdk.RunGcloudIter(['foo', 'list']))
+
+
+class GcloudTestDriverJsonStreamTest(Base):
+
+  LIST = ('[\n  {"name": "a", "size": 10, "tags": ["x", "y"]},\n'
+          '  {"name": "caf\xc3\xa9", "nested": {"n": [1, 2.5e3, null]}},\n'
+          '  12345, true, "s\\"]"\n]\n')
+
+  def Chunks(self, text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+  def testItems(self):
+    for size in (1, 2, 7, len(self.LIST)):
+      self.assertEqual(
+          json.loads(self.LIST),
+          list(_json_stream.Items(self.Chunks(self.LIST, size))))
+
+  def testEmpty(self):
+    self.assertEqual([], list(_json_stream.Items(['[', ' ]\n'])))
+    self.assertEqual([], list(_json_stream.Items([])))
+
+  def testNotAList(self):
+    self.assertEqual([{'a': 1}],
+                     list(_json_stream.Items(self.Chunks('{"a": 1}\n', 3))))
+    self.assertEqual([12], list(_json_stream.Items(['1', '2'])))
+
+  def testItemsArriveEarly(self):
+    def Chunks():
+      yield '[{"a": 1}, '
+      raise AssertionError('Read too far')
+    self.assertEqual({'a': 1}, next(_json_stream.Items(Chunks())))
+
+  def testLargeItem(self):
+    item = {'values': [{'s': 'x\\"]} \\', 'n': i} for i in range(100000)]}
+    text = '[' + json.dumps(item) + ', "' + 'y' * 1024 * 1024 + '"]'
+    self.assertGreater(len(text), 4 * 1024 * 1024)
+    self.assertEqual([item, 'y' * 1024 * 1024],
+                     list(_json_stream.Items(self.Chunks(text, 4096))))
+
+  def testInvalid(self):
+    for text in ('[1, 2', '[1 2]', '[1, }', '[1] 2', 'nope'):
+      with self.assertRaises(ValueError):
+        list(_json_stream.Items(self.Chunks(text, 1)))
+
+
+class GcloudTestDriverOutputSpillingTest(BackgroundBase):
+
+  def setUp(self):
+    super(GcloudTestDriverOutputSpillingTest, self).setUp()
+    self.spill_dir = self.MakeTempDir()
+    driver.EnableOutputSpilling(threshold=10, directory=self.spill_dir)
+    self.addCleanup(driver.DisableOutputSpilling)
+    self.addCleanup(_output.DeleteAll)
+
+  def testSmallOutput(self):
+    self.assertEqual(('hi\n', '', 0), self.sdk.Run(['sh', '-c', 'echo hi']))
+
+  def testSpills(self):
+    out, err, code = self.sdk.Run(
+        ['sh', '-c', 'printf 0123; printf 456789abcdef; echo err >&2'])
+    self.assertEqual(('err\n', 0), (err, code))
+    self.assertIsInstance(out, _output.SpilledOutput)
+    self.assertEqual(self.spill_dir, os.path.dirname(out.path))
+    self.assertEqual(16, len(out))
+    self.assertEqual('0123456789abcdef', out.Read())
+    self.assertEqual(('0123', 'cdef'), (out.Head(4), out.Tail(4)))
+    view = out.View()
+    self.assertEqual('234', view[2:5])
+    self.assertEqual(9, re.search('9a', view).start())
+    out.Close()
+    self.assertFalse(os.path.exists(out.path))
+    self.assertEqual('0123', view[:4])
+
+  def testErrorOutlivesResult(self):
+    result = self.sdk.Run(['sh', '-c', 'printf 0123456789abcdef; exit 1'])
+    path = result[0].path
+    with self.assertRaises(error.SDKError) as context:
+      error.HandlePossibleError(result, error.SDKError, 'Failed')
+    del result
+    gc.collect()
+    # The file the error refers to is still there to look at.
+    self.assertIn(path, str(context.exception))
+    self.assertTrue(os.path.exists(path))
+    _output.DeleteAll()
+    self.assertFalse(os.path.exists(path))
+
+  def testBackground(self):
+    out, _, _ = self.sdk.RunInBackground(
+        ['sh', '-c', 'printf 0123456789abcdef']).Wait(10)
+    self.assertEqual('0123456789abcdef', out.Read())
+
+  def testRunGcloudDoesNotParse(self):
+    out, _, _ = self.sdk.RunGcloud(['0123456789'])
+    self.assertEqual('["0123456789 --format=json"]', out.Read())
+
+  def testBypassesWorker(self):
+    driver.EnableGcloudWorker(preload=[])
+    self.addCleanup(driver.DisableGcloudWorker)
+    run_patch = self.StartObjectPatch(_worker, 'Run')
+    out, _, _ = self.sdk.Run(['gcloud', '0123456789'])
+    self.assertEqual('["0123456789"]', out.Read())
+    run_patch.assert_not_called()
+
+  def testTimeout(self):
+    with self.assertRaisesRegexp(error.SDKError, 'timed out'):
+      self.sdk.Run(['sleep', '30'], timeout=0.2)
+
+
+class GcloudTestDriverRunManyTest(BackgroundBase):
+
+  def Sleeper(self, seconds, code=0):
+    return ['sh', '-c', 'sleep {0}; echo {0}; exit {1}'.format(seconds, code)]
+
+  def testOrdered(self):
+    self.assertEqual(
+        [('0.2\n', '', 0), ('0\n', '', 0), ('0.1\n', '', 1)],
+        self.sdk.RunMany([self.Sleeper(0.2), self.Sleeper(0),
+                          self.Sleeper(0.1, code=1)]))
+
+  def testUnordered(self):
+    results = self.sdk.RunMany(
+        [self.Sleeper(0.4), self.Sleeper(0), self.Sleeper(0.2)], ordered=False)
+    self.assertEqual([1, 2, 0], [result[0] for result in results])
+
+  def testGcloud(self):
+    self.assertEqual(
+        [(['a --format=json(name)'], '', 0),
+         (['b --format=json(name)'], '', 0)],
+        self.sdk.RunMany(['a', 'b'], gcloud=True, format_keys=['name']))
+
+  def testMaxWorkers(self):
+    start = time.time()
+    self.sdk.RunMany([self.Sleeper(0.2)] * 3, max_workers=1)
+    self.assertGreaterEqual(time.time() - start, 0.6)
+
+  def testDeadline(self):
+    start = time.time()
+    with self.assertRaisesRegexp(error.SDKError, '1 of 2 commands'):
+      self.sdk.RunMany([self.Sleeper(0), self.Sleeper(30)], deadline=0.2)
+    self.assertLess(time.time() - start, 10)
+
+  def testFailFast(self):
+    results = self.sdk.RunMany(
+        [self.Sleeper(30), self.Sleeper(0, code=2)], ordered=False,
+        fail_fast=True)
+    with self.assertRaisesRegexp(error.SDKError, 'Return code: 2'):
+      list(results)
+
+  def testStopIterating(self):
+    results = self.sdk.RunMany(
+        [self.Sleeper(0), self.Sleeper(30)], ordered=False)
+    self.assertEqual(0, next(results)[0])
+    results.close()
+
+
 class GcloudTestDriverRunGcloudTest(Base):
 
   def setUp(self):
@@ -605,10 +1400,37 @@ class GcloudTestDriverErrorTest(Base):
   def testNoError(self):
     error.HandlePossibleError(('out', 'err', 0), ValueError, 'foo')
 
+  def testLongOutput(self):
+    self.StartObjectPatch(constants, 'ERROR_OUTPUT_HEAD', new=3)
+    self.StartObjectPatch(constants, 'ERROR_OUTPUT_TAIL', new=2)
+    with self.assertRaises(ValueError) as context:
+      error.HandlePossibleError(('abcdefghij', 'err', 1), ValueError, 'foo')
+    self.assertIn('<<<abc\n... [5 bytes omitted] ...\nij>>>',
+                  str(context.exception))
+    self.assertIn('<<<err>>>', str(context.exception))
+
+  def testSpilledOutput(self):
+    self.StartObjectPatch(constants, 'ERROR_OUTPUT_HEAD', new=3)
+    self.StartObjectPatch(constants, 'ERROR_OUTPUT_TAIL', new=2)
+    _output.Enable(5, self.MakeTempDir())
+    self.addCleanup(_output.Disable)
+    out = _output.Limit('abcdefghij')
+    with self.assertRaises(ValueError) as context:
+      error.HandlePossibleError((out, 'err', 1), ValueError, 'foo')
+    self.assertIn(
+        '<<<abc\n... [5 bytes omitted] ...\nij\n'
+        '[all 10 bytes are in {0}]>>>'.format(out.path),
+        str(context.exception))
+
+  def testParsedOutput(self):
+    with self.assertRaisesRegexp(ValueError, re.escape("<<<[{'a': 1}]>>>")):
+      error.HandlePossibleError(([{'a': 1}], 'err', 1), ValueError, 'foo')
+
 
 class GcloudTestDriverInstallTest(Base):
 
   def setUp(self):
+    self.StartObjectPatch(tempfile, 'tempdir', new=self.MakeTempDir())
     self.StartDictPatch(os.environ)
     self.dir_patch = self.StartObjectPatch(os.path, 'isdir', return_value=True)
     self.rm_patch = self.StartObjectPatch(shutil, 'rmtree')
@@ -665,16 +1487,544 @@ class GcloudTestDriverInstallTest(Base):
   def testDestroy(self):
     driver.Init()
     root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
-    driver.Destroy()
+    driver.Destroy(wait=True)
     self.assertNotIn(constants.DRIVER_LOCATION_ENV, os.environ)
     self.rm_patch.assert_called_once_with(root_directory)
 
+  def testInstallCacheHit(self):
+    self.StartObjectPatch(_sdk_tar, 'TarDigest', return_value='digest')
+    self.StartObjectPatch(_install_cache, 'Lookup', return_value='cached')
+    materialize_patch = self.StartObjectPatch(_install_cache, 'Materialize')
+    store_patch = self.StartObjectPatch(_install_cache, 'Store')
+    driver.Init(cache_directory=self.MakeTempDir())
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    materialize_patch.assert_called_once_with(
+        'cached', os.path.join(root_directory, constants.SDK_FOLDER))
+    self.popen_patch.assert_not_called()
+    store_patch.assert_not_called()
+
+  def testInstallCacheMiss(self):
+    self.StartObjectPatch(_sdk_tar, 'TarDigest', return_value='digest')
+    self.StartObjectPatch(_install_cache, 'Lookup', return_value=None)
+    store_patch = self.StartObjectPatch(_install_cache, 'Store')
+    cache_directory = self.MakeTempDir()
+    driver.Init(additional_components=['foo'], cache_directory=cache_directory)
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    self.assertEqual(1, len(self.popen_patch.mock_calls))
+    store_patch.assert_called_once_with(
+        cache_directory, _install_cache.CacheKey('digest', ['foo']),
+        os.path.join(root_directory, constants.SDK_FOLDER),
+        tar_location=constants.RELEASE_TAR, additional_components=['foo'])
+
+  def testInstallStreamDownloadWithCache(self):
+    stream_patch = self.StartObjectPatch(
+        _sdk_tar, 'StreamTar', return_value=('downloads', 'http://foo'))
+    self.StartObjectPatch(_sdk_tar, 'TarDigest', return_value='digest')
+    self.StartObjectPatch(
+        _install_cache, 'Lookup', side_effect=[None, 'cached'])
+    materialize_patch = self.StartObjectPatch(_install_cache, 'Materialize')
+    store_patch = self.StartObjectPatch(_install_cache, 'Store')
+    cache_directory = self.MakeTempDir()
+    driver.Init(tar_location='http://foo/bar.tar', stream_download=True,
+                cache_directory=cache_directory)
+    store_patch.assert_called_once_with(
+        cache_directory, mock.ANY, mock.ANY, tar_location='http://foo/bar.tar',
+        additional_components=[])
+    driver.Destroy(wait=True)
+    driver.Init(tar_location='http://foo/bar.tar', stream_download=True,
+                cache_directory=cache_directory)
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    materialize_patch.assert_called_once_with(
+        'cached', os.path.join(root_directory, constants.SDK_FOLDER))
+    stream_patch.assert_not_called()
+    self.assertEqual(1, len(self.popen_patch.mock_calls))
+
+  def testInstallStreamDownload(self):
+    stream_patch = self.StartObjectPatch(
+        _sdk_tar, 'StreamTar', return_value=('downloads', 'http://foo'))
+    self.StartObjectPatch(_sdk_tar, 'DownloadPath', return_value=os.path.join(
+        self.MakeTempDir(), 'bar.tar'))
+    self.StartObjectPatch(os.path, 'isfile', return_value=False)
+    driver.Init(tar_location='http://foo/bar.tar', stream_download=True)
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    stream_patch.assert_called_once_with(
+        'http://foo/bar.tar', root_directory, None, root_directory, None,
+        phase=mock.ANY)
+    _sdk_tar.DownloadTar.assert_not_called()
+    _sdk_tar.UnpackTar.assert_not_called()
+    self.assertEqual(1, len(self.popen_patch.mock_calls))
+
+  def testInstallTarSha256(self):
+    driver.Init(tar_sha256='abc')
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    _sdk_tar.DownloadTar.assert_called_once_with(
+        constants.RELEASE_TAR, root_directory, 'abc', None)
+
+  def testInstallSharedDownloadDirectory(self):
+    download_directory = self.MakeTempDir()
+    os.environ[constants.DOWNLOADS_ENV] = download_directory
+    os.environ[constants.DOWNLOADS_MAX_BYTES_ENV] = '1000'
+    driver.Init()
+    _sdk_tar.DownloadTar.assert_called_once_with(
+        constants.RELEASE_TAR, download_directory, None, 1000)
+
+  def testInstallReusesMarkedRootDirectory(self):
+    root_directory = self.MakeTempDir()
+    driver.Init(root_directory=root_directory)
+    driver.Destroy()
+    driver.Init(root_directory=root_directory)
+    self.assertEqual(1, len(self.popen_patch.mock_calls))
+    self.assertEqual(1, _sdk_tar.DownloadTar.call_count)
+
+  def testInstallMarkerMismatch(self):
+    root_directory = self.MakeTempDir()
+    driver.Init(root_directory=root_directory)
+    driver.Destroy()
+    driver.Init(root_directory=root_directory, additional_components=['foo'])
+    self.assertEqual(2, len(self.popen_patch.mock_calls))
+
+  def testInstallTwiceSameRootDirectory(self):
+    root_directory = self.MakeTempDir()
+    driver.Init(root_directory=root_directory)
+    driver.Init(root_directory=root_directory)
+    self.assertEqual(1, len(self.popen_patch.mock_calls))
+    with self.assertRaises(error.InitError):
+      driver.Init(root_directory=self.MakeTempDir())
+
+  def testInstallLockWaits(self):
+    driver.Init()
+    self.assertIn('install', driver.LastInitLockWaits())
+
+  def testInitReport(self):
+    report_path = os.path.join(self.MakeTempDir(), 'report.json')
+    os.environ[constants.INIT_REPORT_ENV] = report_path
+    driver.Init()
+    report = driver.LastInitReport()
+    self.assertEqual(
+        ['wait', 'download', 'unpack', 'install', 'verify'],
+        [phase['name'] for phase in report['phases']])
+    for phase in report['phases']:
+      self.assertEqual('done', phase['state'])
+      self.assertGreaterEqual(phase['wall_time'], 0)
+      self.assertGreaterEqual(phase['cpu_time'], 0)
+    self.assertIn('install', report['lock_waits'])
+    with open(report_path) as fp:
+      self.assertEqual(report, json.load(fp))
+
+  def testInitReportFailure(self):
+    self.dir_patch.return_value = False
+    with self.assertRaises(error.InitError):
+      driver.Init()
+    last_phase = driver.LastInitReport()['phases'][-1]
+    self.assertEqual('verify', last_phase['name'])
+    self.assertEqual('failed', last_phase['state'])
+
+
+class GcloudTestDriverInitAsyncTest(Base):
+
+  def setUp(self):
+    self.StartObjectPatch(tempfile, 'tempdir', new=self.MakeTempDir())
+    self.StartDictPatch(os.environ)
+    self.StartObjectPatch(driver, '_pending_init', new=None)
+    self.unblock = threading.Event()
+    self.StartObjectPatch(_sdk_tar, 'DownloadTar', side_effect=(
+        lambda *args: self.unblock.wait(10)))
+    self.StartObjectPatch(_sdk_tar, 'UnpackTar', return_value='http://foo')
+    self.install_patch = self.StartObjectPatch(driver, '_RunInstaller')
+    self.StartObjectPatch(os.path, 'isdir', return_value=True)
+    self.StartObjectPatch(driver.SDK, 'RunInitializationCommands')
+    self.addCleanup(self.unblock.set)
+
+  def WaitForPhase(self, handle, name):
+    for _ in range(200):
+      if handle.progress.Current() == name:
+        return
+      time.sleep(0.01)
+    self.fail('Init never reached phase [{0}]'.format(name))
+
+  def testInitAsync(self):
+    handle = driver.InitAsync(additional_components=['foo'])
+    self.WaitForPhase(handle, 'download')
+    self.assertFalse(handle.Done())
+    self.assertNotIn(constants.DRIVER_LOCATION_ENV, os.environ)
+
+    self.unblock.set()
+    driver.DefaultSDK()
+    self.assertTrue(handle.Done())
+    self.assertIn(constants.DRIVER_LOCATION_ENV, os.environ)
+    self.assertEqual(
+        ['wait', 'download', 'unpack', 'install', 'verify'],
+        [phase['name'] for phase in handle.progress.Phases()])
+    self.assertTrue(all(phase['state'] == 'done'
+                        for phase in handle.progress.Phases()))
+    self.assertEqual(1, self.install_patch.call_count)
+
+  def testInitWhileInitAsyncPending(self):
+    handle = driver.InitAsync()
+    with self.assertRaises(error.InitError):
+      driver.Init()
+    with self.assertRaises(error.InitError):
+      driver.InitAsync()
+    self.unblock.set()
+    handle.Wait()
+
+  def testWaitTimeout(self):
+    handle = driver.InitAsync()
+    self.WaitForPhase(handle, 'download')
+    with self.assertRaisesRegexp(error.InitError, 'download'):
+      handle.Wait(timeout=0.01)
+    self.unblock.set()
+    handle.Wait()
+
+  def testInitAsyncFailure(self):
+    self.install_patch.side_effect = error.InitError('install failed')
+    self.unblock.set()
+    handle = driver.InitAsync()
+    with self.assertRaisesRegexp(error.InitError, 'install failed'):
+      driver.DefaultSDK()
+    self.assertEqual('failed', handle.progress.Phases()[-1]['state'])
+    # Destroy doesn't raise Init's error again.
+    driver.Destroy()
+
+  def testDestroyWaitsForInitAsync(self):
+    handle = driver.InitAsync()
+    self.unblock.set()
+    driver.Destroy(wait=True)
+    self.assertTrue(handle.Done())
+    self.assertNotIn(constants.DRIVER_LOCATION_ENV, os.environ)
+
+
+class GcloudTestDriverDestroyTest(Base):
+
+  def setUp(self):
+    self.temp_dir = self.MakeTempDir()
+    self.StartObjectPatch(tempfile, 'tempdir', new=self.temp_dir)
+    self.StartDictPatch(os.environ)
+    self.StartObjectPatch(_sdk_tar, 'DownloadTar')
+    self.StartObjectPatch(_sdk_tar, 'UnpackTar')
+    self.StartObjectPatch(driver, '_RunInstaller')
+    self.StartObjectPatch(driver, '_Install')
+    self.delete_in_background = driver._DeleteInBackground
+    self.delete_patch = self.StartObjectPatch(driver, '_DeleteInBackground')
+    self.trash = os.path.join(self.temp_dir, constants.TRASH_FOLDER)
+
+  def DestroyInChild(self):
+    # A child process inherits the driver's location, but not its lock.
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.check_call(
+        [sys.executable, '-c',
+         'from cloudsdk_test_driver import driver; driver.Destroy(wait=True)'],
+        env=env)
+
+  def testDestroyInBackground(self):
+    driver.Init()
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    driver.Destroy()
+    self.assertFalse(os.path.exists(root_directory))
+    (holder,), = self.delete_patch.call_args[0]
+    self.assertEqual(self.trash, os.path.dirname(holder))
+    self.assertEqual([os.path.basename(root_directory)], os.listdir(holder))
+
+  def testDestroyWait(self):
+    driver.Init()
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    driver.Destroy(wait=True)
+    self.assertFalse(os.path.exists(root_directory))
+    self.assertFalse(os.path.exists(self.trash))
+    self.delete_patch.assert_not_called()
+
+  def testDestroyCreatedRootDirectory(self):
+    root_directory = os.path.join(self.temp_dir, 'root')
+    driver.Init(root_directory=root_directory)
+    self.assertNotIn(constants.DRIVER_KEEP_LOCATION_ENV, os.environ)
+    driver.Destroy(wait=True)
+    self.assertFalse(os.path.exists(root_directory))
+    self.assertFalse(
+        os.path.exists(root_directory + constants.USE_LOCK_SUFFIX))
+
+  def testDestroyKeepsExistingRootDirectory(self):
+    root_directory = self.MakeTempDir()
+    driver.Init(root_directory=root_directory)
+    self.assertEqual('True', os.environ[constants.DRIVER_KEEP_LOCATION_ENV])
+    driver.Destroy(wait=True)
+    self.assertTrue(os.path.isdir(root_directory))
+    self.assertNotIn(constants.DRIVER_KEEP_LOCATION_ENV, os.environ)
+    self.assertFalse(
+        os.path.exists(root_directory + constants.USE_LOCK_SUFFIX))
+
+  def testChildDestroyKeepsExistingRootDirectory(self):
+    root_directory = self.MakeTempDir()
+    driver.Init(root_directory=root_directory)
+    self.DestroyInChild()
+    self.assertTrue(os.path.isdir(root_directory))
+    driver.Destroy(wait=True)
+    self.assertTrue(os.path.isdir(root_directory))
+
+  def testChildDestroyKeepsRootDirectoryInUse(self):
+    root_directory = os.path.join(self.temp_dir, 'root')
+    driver.Init(root_directory=root_directory)
+    self.DestroyInChild()
+    self.assertTrue(os.path.isdir(root_directory))
+    driver.Destroy(wait=True)
+    self.assertFalse(os.path.exists(root_directory))
+
+  def testChildDestroyKeepsTemporaryRootDirectory(self):
+    driver.Init()
+    root_directory = os.environ[constants.DRIVER_LOCATION_ENV]
+    self.DestroyInChild()
+    self.assertTrue(os.path.isdir(root_directory))
+    driver.Destroy(wait=True)
+    self.assertFalse(os.path.exists(root_directory))
+
+  def testDestroyKeepsRootDirectoryInUse(self):
+    # This process creates the root directory, but another shard still uses it.
+    root_directory = os.path.join(self.temp_dir, 'root')
+    driver.Init(root_directory=root_directory)
+    with _lock.FileLock(root_directory + constants.USE_LOCK_SUFFIX,
+                        shared=True):
+      driver.Destroy(wait=True)
+    self.assertTrue(os.path.isdir(root_directory))
+    driver.Init(root_directory=root_directory)
+    driver.Destroy(wait=True)
+    self.assertFalse(os.path.exists(root_directory))
+
+  def testLastUserDestroysRootDirectory(self):
+    # Another shard created the root directory and has finished with it.
+    root_directory = os.path.join(self.temp_dir, 'root')
+    os.makedirs(root_directory)
+    open(os.path.join(root_directory, constants.CREATED_MARKER_FILE),
+         'w').close()
+    driver.Init(root_directory=root_directory)
+    driver.Destroy(wait=True)
+    self.assertFalse(os.path.exists(root_directory))
+
+  def testInitReapsTrash(self):
+    os.makedirs(os.path.join(self.trash, 'leftover'))
+    driver.Init()
+    self.delete_patch.assert_called_once_with(
+        [os.path.join(self.trash, 'leftover')])
+
+  def testInitSkipsTrashBeingDeleted(self):
+    leftover = os.path.join(self.trash, 'leftover')
+    os.makedirs(leftover)
+    with _lock.FileLock(leftover + constants.LOCK_SUFFIX):
+      driver.Init()
+    self.delete_patch.assert_not_called()
+
+  def testDeleteInBackground(self):
+    path = self.MakeTempDir()
+    self.delete_in_background([path])
+    for _ in range(100):
+      if not (os.path.exists(path) or
+              os.path.exists(path + constants.LOCK_SUFFIX)):
+        break
+      time.sleep(0.05)
+    self.assertFalse(os.path.exists(path))
+    self.assertFalse(os.path.exists(path + constants.LOCK_SUFFIX))
+
+
+class GcloudTestDriverSnapshotTest(Base):
+
+  def setUp(self):
+    self.StartDictPatch(os.environ)
+    self.MockPopen()
+    self.download_patch = self.StartObjectPatch(_sdk_tar, 'DownloadTar')
+
+    self.root_directory = self.MakeTempDir()
+    sdk_dir = os.path.join(self.root_directory, constants.SDK_FOLDER)
+    os.makedirs(os.path.join(sdk_dir, 'bin'))
+    os.makedirs(os.path.join(sdk_dir, 'configabc12345'))
+    with open(os.path.join(sdk_dir, 'bin', 'gcloud'), 'w') as fp:
+      fp.write('gcloud')
+    os.chmod(os.path.join(sdk_dir, 'bin', 'gcloud'), 0o755)
+    self.marker = {'tar_location': 'foo.tar', 'additional_components': ['bar']}
+    with open(os.path.join(
+        self.root_directory, constants.INSTALL_MARKER_FILE), 'w') as fp:
+      json.dump(self.marker, fp)
+    self.snapshot = os.path.join(self.MakeTempDir(), 'sdk.tar.gz')
+
+  def Export(self):
+    os.environ[constants.DRIVER_LOCATION_ENV] = self.root_directory
+    driver.ExportInstallation(self.snapshot)
+    del os.environ[constants.DRIVER_LOCATION_ENV]
+
+  def testExportAndRestore(self):
+    self.Export()
+    self.assertEqual(self.marker, _snapshot.ReadManifest(self.snapshot))
+
+    root_directory = self.MakeTempDir()
+    driver.Init(root_directory=root_directory,
+                installation_snapshot=self.snapshot)
+    sdk_dir = os.path.join(root_directory, constants.SDK_FOLDER)
+    gcloud = os.path.join(sdk_dir, 'bin', 'gcloud')
+    with open(gcloud) as fp:
+      self.assertEqual('gcloud', fp.read())
+    self.assertTrue(os.access(gcloud, os.X_OK))
+    self.assertEqual(['bin'], os.listdir(sdk_dir))
+    self.popen_patch.assert_not_called()
+    self.download_patch.assert_not_called()
+
+    # The restored installation counts as installed from the original tar.
+    driver.Destroy()
+    driver.Init(root_directory=root_directory, tar_location='foo.tar',
+                additional_components=['bar'])
+    self.popen_patch.assert_not_called()
+
+  def testExportMode(self):
+    self.addCleanup(os.umask, os.umask(0o022))
+    self.Export()
+    self.assertEqual(0o644, os.stat(self.snapshot).st_mode & 0o777)
+
+  def testExportNotInitialized(self):
+    with self.assertRaises(error.InitError):
+      driver.ExportInstallation(self.snapshot)
+
+  def testSnapshotWithTarLocation(self):
+    self.Export()
+    with self.assertRaises(error.InitError):
+      driver.Init(tar_location='foo.tar', installation_snapshot=self.snapshot)
+
+  def testNotASnapshot(self):
+    with open(self.snapshot, 'wb') as fp:
+      fp.write(_MakeTar({'foo': 'bar'}))
+    with self.assertRaisesRegexp(error.InitError, 'no manifest'):
+      driver.Init(installation_snapshot=self.snapshot)
+
+
+class GcloudTestDriverLockTest(Base):
+
+  def setUp(self):
+    self.path = os.path.join(self.MakeTempDir(), 'sub', 'foo.lock')
+
+  def testExclusive(self):
+    with _lock.FileLock(self.path):
+      self.assertFalse(_lock.FileLock(self.path).Acquire(blocking=False))
+    lock = _lock.FileLock(self.path)
+    self.assertTrue(lock.Acquire(blocking=False))
+    lock.Release()
+
+  def testShared(self):
+    with _lock.FileLock(self.path, shared=True):
+      shared = _lock.FileLock(self.path, shared=True)
+      self.assertTrue(shared.Acquire(blocking=False))
+      self.assertFalse(_lock.FileLock(self.path).Acquire(blocking=False))
+      shared.Release()
+
+  def testWaitTimesRecorded(self):
+    _lock.ResetWaitTimes()
+    held = _lock.FileLock(self.path)
+    held.Acquire()
+    timer = threading.Timer(0.1, held.Release)
+    timer.start()
+    with _lock.FileLock(self.path, name='foo') as lock:
+      self.assertGreater(lock.wait_time, 0)
+    timer.join()
+    self.assertEqual(lock.wait_time, _lock.WaitTimes()['foo'])
+
+
+class GcloudTestDriverThreadPoolTest(Base):
+
+  def testResultKeepsTraceback(self):
+    def Fail():
+      raise ValueError('failed')
+    with _pool.ThreadPool(1) as pool:
+      future = pool.Submit(Fail)
+      try:
+        future.Result()
+      except ValueError:
+        frames = traceback.extract_tb(sys.exc_info()[2])
+    self.assertEqual('Fail', frames[-1][2])
+
+
+class GcloudTestDriverInstallCacheTest(Base):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.temp_dir)
+    self.cache_dir = os.path.join(self.temp_dir, 'cache')
+    self.sdk_dir = os.path.join(self.temp_dir, 'installed')
+    os.makedirs(os.path.join(self.sdk_dir, 'bin'))
+    with open(os.path.join(self.sdk_dir, 'bin', 'gcloud'), 'w') as fp:
+      fp.write('gcloud')
+    os.symlink('gcloud', os.path.join(self.sdk_dir, 'bin', 'link'))
+
+  def testCacheKey(self):
+    self.assertEqual(_install_cache.CacheKey('digest', ['b', 'a']),
+                     _install_cache.CacheKey('digest', ['a', 'b']))
+    self.assertEqual(_install_cache.CacheKey('digest', None),
+                     _install_cache.CacheKey('digest', []))
+    self.assertNotEqual(_install_cache.CacheKey('digest', ['a']),
+                        _install_cache.CacheKey('other', ['a']))
+
+  def testLookupMissing(self):
+    self.assertIsNone(_install_cache.Lookup(self.cache_dir, 'key'))
+
+  def testStoreAndMaterialize(self):
+    _install_cache.Store(self.cache_dir, 'key', self.sdk_dir)
+    tree = _install_cache.Lookup(self.cache_dir, 'key')
+    self.assertIsNotNone(tree)
+
+    destination = os.path.join(self.temp_dir, 'root', constants.SDK_FOLDER)
+    _install_cache.Materialize(tree, destination)
+    with open(os.path.join(destination, 'bin', 'gcloud')) as fp:
+      self.assertEqual('gcloud', fp.read())
+    self.assertEqual(
+        'gcloud', os.readlink(os.path.join(destination, 'bin', 'link')))
+
+  def testWritableFilesCopied(self):
+    os.makedirs(os.path.join(self.sdk_dir, '.install'))
+    for name in ('properties', os.path.join('.install', 'state')):
+      with open(os.path.join(self.sdk_dir, name), 'w') as fp:
+        fp.write('cached')
+    _install_cache.Store(self.cache_dir, 'key', self.sdk_dir)
+    tree = _install_cache.Lookup(self.cache_dir, 'key')
+
+    destination = os.path.join(self.temp_dir, 'root', constants.SDK_FOLDER)
+    _install_cache.Materialize(tree, destination)
+    for name in ('properties', os.path.join('.install', 'state')):
+      with open(os.path.join(destination, name), 'w') as fp:
+        fp.write('changed')
+      with open(os.path.join(tree, name)) as fp:
+        self.assertEqual('cached', fp.read())
+    self.assertEqual(tree, _install_cache.Lookup(self.cache_dir, 'key'))
+    # Everything else is still linked.
+    self.assertTrue(os.path.samefile(
+        os.path.join(tree, 'bin', 'gcloud'),
+        os.path.join(destination, 'bin', 'gcloud')))
+
+  def testStoreTwice(self):
+    _install_cache.Store(self.cache_dir, 'key', self.sdk_dir)
+    _install_cache.Store(self.cache_dir, 'key', self.sdk_dir)
+    self.assertEqual(['key'], os.listdir(self.cache_dir))
+
+  def testCorruptEntryRemoved(self):
+    _install_cache.Store(self.cache_dir, 'key', self.sdk_dir)
+    tree = _install_cache.Lookup(self.cache_dir, 'key')
+    with open(os.path.join(tree, 'bin', 'extra'), 'w') as fp:
+      fp.write('corrupt')
+    self.assertIsNone(_install_cache.Lookup(self.cache_dir, 'key'))
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'key')))
+
+  def testRewriteWithinSecondDetected(self):
+    _install_cache.Store(self.cache_dir, 'key', self.sdk_dir)
+    gcloud = os.path.join(
+        _install_cache.Lookup(self.cache_dir, 'key'), 'bin', 'gcloud')
+    mtime = os.stat(gcloud).st_mtime
+    with open(gcloud, 'w') as fp:
+      fp.write('GCLOUD')
+    # Same size, and the same modification time to the second.
+    os.utime(gcloud, (mtime, int(mtime) + (0.5 if mtime % 1 < 0.25 else 0.1)))
+    self.assertIsNone(_install_cache.Lookup(self.cache_dir, 'key'))
+
 
 class GcloudTestDriverDownloadTarTest(Base):
 
   def setUp(self):
-    self.url_patch = self.StartObjectPatch(urllib2, 'urlopen', autospec=False)
-    self.copy_patch = self.StartObjectPatch(shutil, 'copyfileobj')
+    self.url_patch = self.StartObjectPatch(_http, 'Open', autospec=False)
+    headers = mock.Mock(getheader=mock.Mock(return_value=None))
+    self.url_patch.return_value = mock.MagicMock(
+        read=StringIO.StringIO('tar').read, getcode=mock.Mock(return_value=200),
+        info=mock.Mock(return_value=headers))
     self.temp_dir = tempfile.mkdtemp()
     self.addCleanup(self.Cleanup)
 
@@ -687,7 +2037,11 @@ class GcloudTestDriverDownloadTarTest(Base):
     self.assertEqual(
         os.path.join(self.temp_dir, constants.DOWNLOAD_FOLDER, 'bar.tar'),
         download_path)
-    self.url_patch.assert_called_once_with(location)
+    self.assertEqual(1, self.url_patch.call_count)
+    request = self.url_patch.call_args[0][0]
+    self.assertEqual(location, request.get_full_url())
+    with open(download_path) as fp:
+      self.assertEqual('tar', fp.read())
 
   def testDownloadTwice(self):
     location = 'http://foo/bar.tar'
@@ -713,6 +2067,516 @@ class GcloudTestDriverDownloadTarTest(Base):
       _sdk_tar.DownloadTar(location, self.temp_dir)
 
 
+class _RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the server's payload, honoring single byte range requests."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections += 1
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    server = self.server
+    if self.path.endswith(constants.SHA256_SIDECAR_SUFFIX):
+      self.ServeSidecar()
+      return
+    if server.change_after is not None and (
+        len(server.ranges) == server.change_after):
+      # A new version of the file is published.
+      server.payload = server.payload[::-1]
+      server.etag = '"changed"'
+    payload = server.payload
+    range_header = self.headers.getheader('Range')
+    server.ranges.append(range_header)
+    if_range = self.headers.getheader('If-Range')
+    if if_range and if_range != server.etag:
+      range_header = None
+
+    if server.etag and (
+        self.headers.getheader('If-None-Match') == server.etag):
+      self.send_response(304)
+      self.end_headers()
+      return
+
+    start, end = 0, len(payload)
+    if range_header and server.supports_ranges:
+      first, last = range_header[len('bytes='):].split('-')
+      start = int(first)
+      end = int(last) + 1 if last else len(payload)
+      if start >= len(payload):
+        self.send_response(416)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+          start, end - 1, len(payload)))
+    else:
+      self.send_response(200)
+    self.send_header('Content-Length', str(end - start))
+    if server.etag:
+      self.send_header('ETag', server.etag)
+    self.end_headers()
+
+    body = payload[start:end]
+    if server.truncate_responses > 0:
+      server.truncate_responses -= 1
+      body = body[:len(body) // 2]
+      self.close_connection = 1
+    self.wfile.write(body)
+
+  def ServeSidecar(self):
+    if self.server.sidecar is None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(self.server.sidecar)))
+    self.end_headers()
+    self.wfile.write(self.server.sidecar)
+
+  def log_message(self, *unused_args):
+    pass
+
+
+class _RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    # Clients close idle keep-alive connections whenever they like.
+    if not isinstance(sys.exc_info()[1], socket.error):
+      BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class GcloudTestDriverRangeDownloadTest(Base):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    self.url = self.StartRangeServer(
+        ''.join(chr(i % 256) for i in range(4500)))
+    self.download_path = os.path.join(
+        self.temp_dir, constants.DOWNLOAD_FOLDER, 'bar.tar')
+    self.StartObjectPatch(constants, 'DOWNLOAD_MIN_SEGMENT_SIZE', new=1000)
+    self.StartObjectPatch(constants, 'DOWNLOAD_RETRY_DELAY', new=0)
+
+  def WritePartial(self, data, etag):
+    os.makedirs(os.path.dirname(self.download_path))
+    with open(self.download_path + constants.PARTIAL_SUFFIX + '0', 'wb') as fp:
+      fp.write(data)
+    with open(self.download_path + constants.PARTIAL_SUFFIX + '.json',
+              'w') as fp:
+      json.dump({'etag': etag}, fp)
+
+  def assertDownloaded(self):
+    with open(self.download_path, 'rb') as fp:
+      self.assertEqual(self.server.payload, fp.read())
+    self.assertEqual(
+        sorted(['bar.tar', 'bar.tar' + constants.LOCK_SUFFIX,
+                constants.DIGEST_MANIFEST_FILE,
+                constants.DIGEST_MANIFEST_FILE + constants.LOCK_SUFFIX]),
+        sorted(os.listdir(os.path.dirname(self.download_path))))
+    self.assertEqual(
+        hashlib.sha256(self.server.payload).hexdigest(),
+        _sdk_tar.TarDigest(self.download_path, self.temp_dir))
+
+  def testSegmentedDownload(self):
+    self.assertEqual(
+        self.download_path, _sdk_tar.DownloadTar(self.url, self.temp_dir))
+    self.assertDownloaded()
+    self.assertEqual(
+        ['bytes=0-', 'bytes=1125-2249', 'bytes=2250-3374', 'bytes=3375-4499'],
+        sorted(self.server.ranges))
+
+  def testSmallDownloadNotSegmented(self):
+    self.server.payload = 'small tar'
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    self.assertEqual(['bytes=0-'], self.server.ranges)
+
+  def testResumeDownload(self):
+    self.server.payload = 'x' * 500
+    self.server.etag = '"v1"'
+    self.WritePartial('x' * 100, '"v1"')
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    self.assertEqual(['bytes=100-'], self.server.ranges)
+
+  def testResumeChangedDownload(self):
+    self.server.payload = 'y' * 500
+    self.server.etag = '"v2"'
+    self.WritePartial('x' * 100, '"v1"')
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    self.assertEqual(['bytes=100-'], self.server.ranges)
+
+  def testPartialWithoutValidatorsDiscarded(self):
+    self.server.payload = 'y' * 500
+    os.makedirs(os.path.dirname(self.download_path))
+    with open(self.download_path + constants.PARTIAL_SUFFIX + '0', 'wb') as fp:
+      fp.write('x' * 100)
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    self.assertEqual(['bytes=0-'], self.server.ranges)
+
+  def testChangeDuringDownload(self):
+    # The file changes after the first request of the first attempt, so its
+    # other segments come from the new version.
+    self.server.etag = '"v1"'
+    self.server.change_after = 1
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+
+  def testConcurrentDownloadsShareOneFetch(self):
+    self.server.payload = 'small tar'
+    threads = [threading.Thread(target=_sdk_tar.DownloadTar,
+                                args=(self.url, self.temp_dir))
+               for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertDownloaded()
+    self.assertEqual(['bytes=0-'], self.server.ranges)
+
+  def testRetryTruncatedDownload(self):
+    self.server.truncate_responses = 2
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+
+  def testClientErrorNotRetried(self):
+    attempt = self.StartObjectPatch(
+        _sdk_tar, '_DownloadAttempt', side_effect=urllib2.HTTPError(
+            self.url, 404, 'Not Found', {}, None))
+    with self.assertRaises(urllib2.HTTPError):
+      _sdk_tar._Download(self.url, self.download_path)
+    self.assertEqual(1, attempt.call_count)
+
+  def testServerErrorRetried(self):
+    attempt = self.StartObjectPatch(
+        _sdk_tar, '_DownloadAttempt', side_effect=urllib2.HTTPError(
+            self.url, 503, 'Unavailable', {}, None))
+    with self.assertRaises(urllib2.HTTPError):
+      _sdk_tar._Download(self.url, self.download_path)
+    self.assertEqual(constants.DOWNLOAD_RETRIES + 1, attempt.call_count)
+
+  def testNoRangeSupport(self):
+    self.server.supports_ranges = False
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    self.assertEqual(1, len(self.server.ranges))
+
+  def testFailedDownloadNotCached(self):
+    self.server.supports_ranges = False
+    self.server.truncate_responses = constants.DOWNLOAD_RETRIES + 1
+    with self.assertRaises(error.InitError):
+      _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertFalse(os.path.exists(self.download_path))
+
+  def testExpectedSha256(self):
+    sha256 = hashlib.sha256(self.server.payload).hexdigest()
+    _sdk_tar.DownloadTar(self.url, self.temp_dir, sha256=sha256.upper())
+    self.assertDownloaded()
+
+  def testSha256Mismatch(self):
+    with self.assertRaisesRegexp(error.InitError, 'expected sha256 abc'):
+      _sdk_tar.DownloadTar(self.url, self.temp_dir, sha256='abc')
+    self.assertFalse(os.path.exists(self.download_path))
+    self.assertFalse(os.path.exists(
+        self.download_path + constants.PARTIAL_SUFFIX + '0'))
+
+  def testSha256Sidecar(self):
+    self.server.sidecar = '{digest}  bar.tar\n'.format(
+        digest=hashlib.sha256(self.server.payload).hexdigest())
+    _sdk_tar.DownloadTar(
+        self.url, self.temp_dir, sha256=constants.SHA256_SIDECAR)
+    self.assertDownloaded()
+
+  def testSha256SidecarMissing(self):
+    with self.assertRaises(error.InitError):
+      _sdk_tar.DownloadTar(
+          self.url, self.temp_dir, sha256=constants.SHA256_SIDECAR)
+    self.assertEqual([], self.server.ranges)
+
+  def testVerifiedFromManifestWithoutRehashing(self):
+    sha256 = hashlib.sha256(self.server.payload).hexdigest()
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    requests = len(self.server.ranges)
+    digest_patch = self.StartObjectPatch(_digest, 'FileDigest')
+    _sdk_tar.DownloadTar(self.url, self.temp_dir, sha256=sha256)
+    digest_patch.assert_not_called()
+    self.assertEqual(requests, len(self.server.ranges))
+
+  def testEvictLeastRecentlyUsed(self):
+    self.server.payload = 'x' * 100
+    folder = os.path.dirname(self.download_path)
+    os.makedirs(folder)
+    for i, name in enumerate(['old.tar', 'in_use.tar', 'new.tar']):
+      path = os.path.join(folder, name)
+      with open(path, 'wb') as fp:
+        fp.write('x' * 100)
+      os.utime(path, (i, i))
+    with _sdk_tar.UseLock(os.path.join(folder, 'in_use.tar')):
+      _sdk_tar.DownloadTar(self.url, self.temp_dir, max_bytes=250)
+    self.assertEqual(
+        ['bar.tar', 'in_use.tar'],
+        sorted(name for name in os.listdir(folder)
+               if name.endswith('.tar')))
+
+  def testEvictUsesLastUse(self):
+    self.server.payload = 'x' * 100
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    other = os.path.join(os.path.dirname(self.download_path), 'other.tar')
+    with open(other, 'wb') as fp:
+      fp.write('x' * 100)
+    # Reusing bar.tar makes it more recently used than other.tar.
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertEqual(
+        [other], _sdk_tar.EvictDownloads(self.temp_dir, 100))
+    self.assertTrue(os.path.isfile(self.download_path))
+
+  def testRevalidateNotModified(self):
+    self.server.payload = 'small tar'
+    self.server.etag = '"v1"'
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    self.assertEqual(['bytes=0-', None], self.server.ranges)
+
+  def testRevalidateReplacesStaleDownload(self):
+    self.server.payload = 'old tar'
+    self.server.etag = '"v1"'
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.server.payload = 'new tar'
+    self.server.etag = '"v2"'
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    # The new validators are recorded, so the next check is a cheap one.
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+    self.assertEqual(3, len(self.server.ranges))
+
+  def testRevalidateUnreachableKeepsDownload(self):
+    self.server.payload = 'small tar'
+    self.server.etag = '"v1"'
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.StartObjectPatch(
+        _http, 'Open', side_effect=urllib2.URLError('offline'))
+    self.StartObjectPatch(sys, 'stderr')
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+
+  def testNoRevalidationWithExpectedSha256(self):
+    self.server.payload = 'small tar'
+    self.server.etag = '"v1"'
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    _sdk_tar.DownloadTar(self.url, self.temp_dir, sha256=hashlib.sha256(
+        self.server.payload).hexdigest())
+    self.assertEqual(1, len(self.server.ranges))
+
+  def testConnectionsKeptAlive(self):
+    self.server.payload = 'small tar'
+    self.server.etag = '"v1"'
+    for _ in range(3):
+      _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertEqual(3, len(self.server.ranges))
+    self.assertEqual(1, self.server.connections)
+
+  def testChangedDownloadReplaced(self):
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    with open(self.download_path, 'ab') as fp:
+      fp.write('corrupt')
+    _sdk_tar.DownloadTar(self.url, self.temp_dir)
+    self.assertDownloaded()
+
+  def testUnrecordedDownloadWithWrongDigestReplaced(self):
+    os.makedirs(os.path.dirname(self.download_path))
+    with open(self.download_path, 'wb') as fp:
+      fp.write('stale')
+    sha256 = hashlib.sha256(self.server.payload).hexdigest()
+    _sdk_tar.DownloadTar(self.url, self.temp_dir, sha256=sha256)
+    self.assertDownloaded()
+
+
+def _MakeTar(files, compress_command=None):
+  """Returns the bytes of a tar containing {name: contents}.
+
+  The tar is gzipped unless a command to compress it with is given.
+  """
+  data = StringIO.StringIO()
+  mode = 'w' if compress_command else 'w:gz'
+  with tarfile.open(fileobj=data, mode=mode) as tar:
+    for name, contents in sorted(files.items()):
+      info = tarfile.TarInfo(name)
+      info.size = len(contents)
+      tar.addfile(info, StringIO.StringIO(contents))
+  if compress_command:
+    p = subprocess.Popen(
+        compress_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return p.communicate(data.getvalue())[0]
+  return data.getvalue()
+
+
+def _Available(command):
+  return distutils.spawn.find_executable(command) is not None
+
+
+class GcloudTestDriverDecompressTest(Base):
+
+  def setUp(self):
+    self.files = {'foo': 'foo', 'bar/baz': 'baz' * 1000}
+    self.temp_dir = self.MakeTempDir()
+
+  def Read(self, **kwargs):
+    with _decompress.OpenTar(**kwargs) as tar:
+      return dict((member.name, tar.extractfile(member).read())
+                  for member in tar if member.isfile())
+
+  def ReadBoth(self, data):
+    path = os.path.join(self.temp_dir, 'foo.tar')
+    with open(path, 'wb') as fp:
+      fp.write(data)
+    self.assertEqual(self.files, self.Read(name=path))
+    self.assertEqual(
+        self.files, self.Read(fileobj=StringIO.StringIO(data)))
+
+  def testDetectFormat(self):
+    self.assertEqual(_decompress.GZIP, _decompress.DetectFormat(
+        _MakeTar(self.files)))
+    self.assertEqual(_decompress.BZIP2, _decompress.DetectFormat('BZh91AY'))
+    self.assertEqual(_decompress.XZ, _decompress.DetectFormat(
+        '\xfd7zXZ\x00\x00'))
+    self.assertEqual(_decompress.ZSTD, _decompress.DetectFormat(
+        '\x28\xb5\x2f\xfd\x00'))
+    self.assertIsNone(_decompress.DetectFormat('foo'))
+
+  def testStdlibGzip(self):
+    self.StartObjectPatch(constants, 'DECOMPRESS_COMMANDS', new={})
+    self.ReadBoth(_MakeTar(self.files))
+
+  def testUncompressed(self):
+    self.ReadBoth(_MakeTar(self.files, compress_command=['cat']))
+
+  def testExternalGzip(self):
+    self.StartObjectPatch(
+        constants, 'DECOMPRESS_COMMANDS', new={'gzip': [['gzip', '-dc']]})
+    popen_patch = self.StartObjectPatch(
+        subprocess, 'Popen', side_effect=subprocess.Popen, autospec=False)
+    self.ReadBoth(_MakeTar(self.files))
+    self.assertEqual(2, popen_patch.call_count)
+
+  def testExternalFailure(self):
+    self.StartObjectPatch(
+        constants, 'DECOMPRESS_COMMANDS', new={'gzip': [['gzip', '-dc']]})
+    data = _MakeTar(self.files)
+    with self.assertRaises(tarfile.TarError):
+      self.Read(fileobj=StringIO.StringIO(data[:len(data) // 2]))
+
+  def testStopReadingEarly(self):
+    self.StartObjectPatch(
+        constants, 'DECOMPRESS_COMMANDS', new={'gzip': [['gzip', '-dc']]})
+    self.files['big'] = os.urandom(4 * 1024 * 1024)
+    with _decompress.OpenTar(fileobj=StringIO.StringIO(
+        _MakeTar(self.files))) as tar:
+      self.assertEqual('bar/baz', tar.next().name)
+
+  @unittest.skipUnless(_Available('xz'), 'xz is not installed')
+  def testXz(self):
+    self.ReadBoth(_MakeTar(self.files, compress_command=['xz', '-c']))
+
+  @unittest.skipUnless(_Available('zstd'), 'zstd is not installed')
+  def testZstd(self):
+    self.ReadBoth(_MakeTar(self.files, compress_command=['zstd', '-c']))
+
+  def testMissingBackend(self):
+    self.StartObjectPatch(constants, 'DECOMPRESS_COMMANDS', new={})
+    self.StartObjectPatch(_decompress, 'zstandard', new=None)
+    with self.assertRaisesRegexp(tarfile.CompressionError, 'zstd'):
+      self.Read(fileobj=StringIO.StringIO('\x28\xb5\x2f\xfd\x00'))
+
+
+class GcloudTestDriverStreamTarTest(Base):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.temp_dir)
+    self.download_path = os.path.join(
+        self.temp_dir, constants.DOWNLOAD_FOLDER, 'bar.tar.gz')
+    self.installer = _MakeTar({
+        constants.SDK_FOLDER + '/install.sh': 'install',
+        constants.SDK_FOLDER + '/bin/gcloud': 'gcloud',
+    })
+
+  def ReadFile(self, *path):
+    with open(os.path.join(self.temp_dir, *path), 'rb') as fp:
+      return fp.read()
+
+  def testStreamInstallerTar(self):
+    url = self.StartRangeServer(self.installer, 'bar.tar.gz')
+    download_path, snapshot_url = _sdk_tar.StreamTar(url, self.temp_dir)
+    self.assertIsNone(snapshot_url)
+    self.assertEqual(self.download_path, download_path)
+    self.assertEqual(self.installer, self.ReadFile(download_path))
+    self.assertEqual(
+        'gcloud', self.ReadFile(constants.SDK_FOLDER, 'bin', 'gcloud'))
+
+  def testStreamRepoTar(self):
+    repo = _MakeTar({
+        constants.COMPONENTS_FILE: '{}',
+        constants.INSTALLER_FILE: self.installer,
+    })
+    url = self.StartRangeServer(repo, 'bar.tar.gz')
+    download_path, snapshot_url = _sdk_tar.StreamTar(url, self.temp_dir)
+    self.assertEqual(
+        'file://' + os.path.join(
+            self.temp_dir, constants.REPO_FOLDER, constants.COMPONENTS_FILE),
+        snapshot_url)
+    self.assertEqual(repo, self.ReadFile(download_path))
+    self.assertEqual(
+        'gcloud', self.ReadFile(constants.SDK_FOLDER, 'bin', 'gcloud'))
+    # The nested installer is extracted from the stream, not written to disk.
+    self.assertFalse(os.path.exists(os.path.join(
+        self.temp_dir, constants.REPO_FOLDER, constants.INSTALLER_FILE)))
+
+  def testStreamTruncated(self):
+    url = self.StartRangeServer(self.installer, 'bar.tar.gz')
+    self.server.truncate_responses = 1
+    with self.assertRaises(error.InitError):
+      _sdk_tar.StreamTar(url, self.temp_dir)
+    self.assertFalse(os.path.exists(self.download_path))
+
+  def testStreamSha256(self):
+    url = self.StartRangeServer(self.installer, 'bar.tar.gz')
+    sha256 = hashlib.sha256(self.installer).hexdigest()
+    download_path, _ = _sdk_tar.StreamTar(url, self.temp_dir, sha256)
+    self.assertEqual(sha256, _sdk_tar.TarDigest(download_path, self.temp_dir))
+
+  def testStreamWriteError(self):
+    url = self.StartRangeServer(self.installer, 'bar.tar.gz')
+    self.StartObjectPatch(_extract.Extractor, 'Extract',
+                          side_effect=OSError(28, 'No space left on device'))
+    with self.assertRaisesRegexp(error.InitError, 'No space left'):
+      _sdk_tar.StreamTar(url, self.temp_dir)
+
+  def testStreamEvicts(self):
+    url = self.StartRangeServer(self.installer, 'bar.tar.gz')
+    folder = os.path.dirname(self.download_path)
+    os.makedirs(folder)
+    old = os.path.join(folder, 'old.tar.gz')
+    with open(old, 'wb') as fp:
+      fp.write('x' * 100)
+    _sdk_tar.StreamTar(url, self.temp_dir, max_bytes=len(self.installer))
+    self.assertFalse(os.path.exists(old))
+    self.assertTrue(os.path.exists(self.download_path))
+
+  def testStreamSha256Mismatch(self):
+    url = self.StartRangeServer(self.installer, 'bar.tar.gz')
+    with self.assertRaisesRegexp(error.InitError, 'expected sha256'):
+      _sdk_tar.StreamTar(url, self.temp_dir, 'abc')
+    self.assertFalse(os.path.exists(self.download_path))
+
+
 class GcloudTestDriverUnpackTarTest(Base):
 
   def setUp(self):
@@ -724,70 +2588,188 @@ class GcloudTestDriverUnpackTarTest(Base):
     self.repo_dir = os.path.join(self.temp_dir, constants.REPO_FOLDER)
     self.components = os.path.join(self.repo_dir, constants.COMPONENTS_FILE)
     self.installer = os.path.join(self.repo_dir, constants.INSTALLER_FILE)
-
-    self.tar_patch = self.StartObjectPatch(tarfile, 'open')
+    self.installer_tar = _MakeTar({
+        constants.SDK_FOLDER + '/install.sh': 'install',
+        constants.SDK_FOLDER + '/bin/gcloud': 'gcloud',
+    })
 
   def Cleanup(self):
     shutil.rmtree(self.temp_dir)
 
+  def WriteTar(self, files, compress_command=None):
+    os.makedirs(os.path.dirname(self.download_path))
+    with open(self.download_path, 'wb') as fp:
+      fp.write(_MakeTar(files, compress_command))
+
+  def WriteInstallerTar(self):
+    os.makedirs(os.path.dirname(self.download_path))
+    with open(self.download_path, 'wb') as fp:
+      fp.write(self.installer_tar)
+
+  def assertInstallerExtracted(self):
+    gcloud = os.path.join(self.temp_dir, constants.SDK_FOLDER, 'bin', 'gcloud')
+    with open(gcloud) as fp:
+      self.assertEqual('gcloud', fp.read())
+
   def testUnpackRepoTar(self):
     # A tar containing the entire repository will contain the components json
     # file. The resulting url should point to that file.
-    self.StartObjectPatch(os.path, 'isfile', return_value=True)
+    self.WriteTar({
+        constants.COMPONENTS_FILE: '{}',
+        constants.INSTALLER_FILE: self.installer_tar,
+        'components/foo.tar.gz': 'foo',
+    })
     url = _sdk_tar.UnpackTar(
         self.download_path, 'http://foo/bar.tar', self.temp_dir)
     self.assertEqual('file://{0}'.format(self.components), url)
-    self.tar_patch.assert_has_calls(
-        [mock.call(name=self.download_path), mock.call(name=self.installer)],
-        any_order=True)
+    self.assertInstallerExtracted()
+    self.assertTrue(
+        os.path.isfile(os.path.join(self.repo_dir, 'components', 'foo.tar.gz')))
+    # The installer is extracted in the same pass, without being written out.
+    self.assertFalse(os.path.exists(self.installer))
+
+  def testUnpackRepoTarPhases(self):
+    self.WriteTar({
+        constants.COMPONENTS_FILE: '{}',
+        constants.INSTALLER_FILE: self.installer_tar,
+    })
+    progress = driver.InitProgress()
+    with progress.Phase('unpack'):
+      _sdk_tar.UnpackTar(self.download_path, 'http://foo/bar.tar',
+                         self.temp_dir, phase=progress.Phase)
+    self.assertEqual(
+        [('unpack', None, None), ('extract', 'unpack', 2),
+         ('installer', 'extract', len('install') + len('gcloud'))],
+        [(phase['name'], phase['parent'], phase['bytes'])
+         for phase in progress.Phases()])
+
+  @unittest.skipUnless(_Available('zstd') and _Available('xz'),
+                       'zstd or xz is not installed')
+  def testUnpackRecompressedRepoTar(self):
+    self.WriteTar({
+        constants.COMPONENTS_FILE: '{}',
+        'google-cloud-sdk.tar.xz': _MakeTar({
+            constants.SDK_FOLDER + '/bin/gcloud': 'gcloud',
+        }, compress_command=['xz', '-c']),
+    }, compress_command=['zstd', '-c'])
+    url = _sdk_tar.UnpackTar(
+        self.download_path, 'http://foo/bar.tar.zst', self.temp_dir)
+    self.assertEqual('file://{0}'.format(self.components), url)
+    self.assertInstallerExtracted()
 
   def testUnpackInstaller(self):
     # A tar only containing the installer won't contain the components json.
     # The driver shouldn't set a components url and instead let the installer
     # use its default.
-    self.StartObjectPatch(os.path, 'isfile', return_value=False)
+    self.WriteInstallerTar()
     url = _sdk_tar.UnpackTar(
         self.download_path, 'http://foo/bar.tar', self.temp_dir)
     self.assertEqual(None, url)
-    self.assertEqual(
-        [mock.call(name=self.download_path)], self.tar_patch.call_args_list)
+    self.assertInstallerExtracted()
 
   def testUnpackLocalInstallerWithComponents(self):
     # A local installer tar will need its path converted into a file url if the
     # components json is available locally.
-    self.StartObjectPatch(os.path, 'isfile', side_effect=[False, True])
+    self.WriteInstallerTar()
+    local_components = os.path.join(
+        os.path.dirname(self.download_path), constants.COMPONENTS_FILE)
+    with open(local_components, 'w') as fp:
+      fp.write('{}')
     url = _sdk_tar.UnpackTar(
         self.download_path, self.download_path, self.temp_dir)
-    self.assertEqual(
-        'file://' + os.path.join(
-            os.path.dirname(self.download_path), constants.COMPONENTS_FILE),
-        url)
-    self.tar_patch.assert_called_with(name=self.download_path)
-    for call in self.tar_patch.call_args_list:
-      self.assertNotEqual(call, mock.call(name=self.installer))
+    self.assertEqual('file://' + local_components, url)
+    self.assertInstallerExtracted()
 
   def testUnpackLocalInstallerNoComponents(self):
     # A local installer tar without the components file should return None so
     # the installer can use its baked in location for the components.
-    self.StartObjectPatch(os.path, 'isfile', return_value=False)
+    self.WriteInstallerTar()
     url = _sdk_tar.UnpackTar(
         self.download_path, self.download_path, self.temp_dir)
     self.assertEqual(None, url)
-    self.tar_patch.assert_called_with(name=self.download_path)
-    for call in self.tar_patch.call_args_list:
-      self.assertNotEqual(call, mock.call(name=self.installer))
+    self.assertInstallerExtracted()
 
   def testUnpackInstallerMove(self):
-    # Files are extracted into a folder to contain the repository. If this was
-    # only an installer, there is no repo, so these files need to be moved up a
-    # level.
-    self.StartObjectPatch(os.path, 'isfile', return_value=False)
-    self.StartObjectPatch(os, 'listdir', return_value=['foo'])
-    move_patch = self.StartObjectPatch(shutil, 'move')
+    # The SDK folder of an installer tar is extracted directly into the root
+    # directory. Anything else is extracted into a folder to contain the
+    # repository. If this was only an installer, there is no repo, so these
+    # files need to be moved up a level.
+    self.WriteTar({
+        constants.SDK_FOLDER + '/install.sh': 'install',
+        'foo': 'foo',
+    })
     _sdk_tar.UnpackTar(
         self.download_path, self.download_path, self.temp_dir)
-    move_patch.assert_called_once_with(
-        os.path.join(self.repo_dir, 'foo'), self.temp_dir)
+    self.assertEqual([], os.listdir(self.repo_dir))
+    self.assertTrue(os.path.isfile(os.path.join(self.temp_dir, 'foo')))
+
+  def testUnpackDoesNotOverwrite(self):
+    self.WriteInstallerTar()
+    gcloud = os.path.join(self.temp_dir, constants.SDK_FOLDER, 'bin', 'gcloud')
+    os.makedirs(os.path.dirname(gcloud))
+    with open(gcloud, 'w') as fp:
+      fp.write('existing')
+    _sdk_tar.UnpackTar(
+        self.download_path, 'http://foo/bar.tar', self.temp_dir)
+    with open(gcloud) as fp:
+      self.assertEqual('existing', fp.read())
+
+  def testUnpackCorruptTar(self):
+    os.makedirs(os.path.dirname(self.download_path))
+    with open(self.download_path, 'wb') as fp:
+      fp.write(self.installer_tar[:len(self.installer_tar) // 2])
+    with self.assertRaises(error.InitError):
+      _sdk_tar.UnpackTar(
+          self.download_path, 'http://foo/bar.tar', self.temp_dir)
+
+
+class GcloudTestDriverExtractTest(Base):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.temp_dir)
+
+  def Extract(self, tar_bytes, **kwargs):
+    with tarfile.open(fileobj=StringIO.StringIO(tar_bytes), mode='r|*') as tar:
+      return _extract.Extractor(**kwargs).Extract(
+          tar, lambda _: self.temp_dir)
+
+  def testExtractLinksAndModes(self):
+    data = StringIO.StringIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+      info = tarfile.TarInfo('bin/tool')
+      info.size = 4
+      info.mode = 0o755
+      info.mtime = 1000
+      tar.addfile(info, StringIO.StringIO('tool'))
+      link = tarfile.TarInfo('bin/symlink')
+      link.type = tarfile.SYMTYPE
+      link.linkname = 'tool'
+      tar.addfile(link)
+      hardlink = tarfile.TarInfo('bin/hardlink')
+      hardlink.type = tarfile.LNKTYPE
+      hardlink.linkname = 'bin/tool'
+      tar.addfile(hardlink)
+
+    self.assertEqual(4, self.Extract(data.getvalue()))
+    tool = os.path.join(self.temp_dir, 'bin', 'tool')
+    self.assertEqual(0o755, os.stat(tool).st_mode & 0o777)
+    self.assertEqual(1000, os.stat(tool).st_mtime)
+    self.assertEqual(
+        'tool', os.readlink(os.path.join(self.temp_dir, 'bin', 'symlink')))
+    with open(os.path.join(self.temp_dir, 'bin', 'hardlink')) as fp:
+      self.assertEqual('tool', fp.read())
+
+  def testExtractManyFilesWithSmallBuffer(self):
+    files = {'dir/file{0}'.format(i): 'x' * i for i in range(50)}
+    self.Extract(_MakeTar(files), workers=3, buffer_bytes=100)
+    for name, contents in files.items():
+      with open(os.path.join(self.temp_dir, name)) as fp:
+        self.assertEqual(contents, fp.read())
+
+  def testExtractRefusesEscapingPaths(self):
+    with self.assertRaises(tarfile.TarError):
+      self.Extract(_MakeTar({'../escape': 'x'}))
 
 
 if __name__ == '__main__':